@@ -6,44 +6,127 @@ Modtager postback webhooks fra Voluum og sender notifikationer til Telegram.
 """
 
 import os
-import json
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
 from dotenv import load_dotenv
 
-# Load environment variables
+# Load environment variables – før de lokale moduler, der læser deres config ved import
 load_dotenv()
 
+import http_clients
+import metrics
+import tracing
+from conversion_poller import get_conversion_poller
+from dedup import DedupIndex, dedup_key
+from ftd_digest import DIGEST_DAILY, DIGEST_HOURLY, FTD_COALESCE_SECONDS, FTD_LEDGER_HOURS, PERIODS, FtdBuffer
+from job_scheduler import get_job_scheduler
+from outbox import Outbox
+from postback_batch import coalesce, expand, is_ndjson, parse_batch, unwrap
+from postback_fields import PostbackFields, extract_fields, extractor, is_ftd_type
+from postback_recorder import get_recorder
+from report_cache import get_report_cache, get_report_ttl_cache
+from report_rows import newest_first, report_rows
+from state_store import SCOPE_POLL_FTD, get_state_store
+from telegram_scheduler import PRIORITY_ALERT, PRIORITY_FTD, get_scheduler
+from timeseries import load_series, save_series, series_stats
+from voluum_auth import get_token_manager
+from voluum_forward import get_forwarder
+from voluum_reports import get_report_fetcher, hour_window, today_window
+from workqueue import WorkQueue
+from zero_revenue_rules import ColumnarReport, RuleEngine, default_rules, load_rules
+
 # Configuration
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 VOLUUM_FORWARD_URL = os.getenv("VOLUUM_FORWARD_URL", "").rstrip("/")  # fx https://lowasteisranime.com
-VOLUUM_EMAIL = os.getenv("VOLUUM_EMAIL")
-VOLUUM_PASSWORD = os.getenv("VOLUUM_PASSWORD")
 CRON_SECRET = os.getenv("CRON_SECRET", "")  # Beskytter /cron/* – sæt til et hemmeligt ord
 CLICK_THRESHOLD = int(os.getenv("CLICK_THRESHOLD", "60"))
 WAIT_HOURS = float(os.getenv("WAIT_HOURS", "1.5"))
 # Regel 2: 125+ clicks siden sidste omsætning, 1 time ventetid
 CLICK_THRESHOLD_HIGH = int(os.getenv("CLICK_THRESHOLD_HIGH", "125"))
 WAIT_HOURS_HIGH = float(os.getenv("WAIT_HOURS_HIGH", "1"))
-
-# State-filer for zero-revenue (i projektmappen)
+# Flere/andre regler (scope, cooldown): ZERO_REVENUE_RULES / ZERO_REVENUE_RULES_FILE (se zero_revenue_rules.py)
+ZERO_REVENUE_RULES = load_rules(default_rules(CLICK_THRESHOLD, WAIT_HOURS, CLICK_THRESHOLD_HIGH, WAIT_HOURS_HIGH))
+# Asynkron postback: svar 202 med det samme, lever forward + Telegram i baggrunden
+POSTBACK_ASYNC = os.getenv("POSTBACK_ASYNC", "false").lower() == "true"
+POSTBACK_WORKERS = int(os.getenv("POSTBACK_WORKERS", "4"))
+POSTBACK_QUEUE_SIZE = int(os.getenv("POSTBACK_QUEUE_SIZE", "1000"))
+# Hvor længe en synkron Telegram-afsendelse venter på scheduleren (rate limit / retry_after)
+TELEGRAM_SEND_TIMEOUT = float(os.getenv("TELEGRAM_SEND_TIMEOUT", "30"))
+# Persistent outbox: beskeder gemmes før afsendelse og prøves igen ved fejl (også efter genstart)
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() == "true"
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "20"))
+# Idempotente postbacks: gensendte postbacks (samme txid/click ID) ignoreres i DEDUP_TTL_HOURS
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_TTL_HOURS = float(os.getenv("DEDUP_TTL_HOURS", "72"))
+DEDUP_LRU_SIZE = int(os.getenv("DEDUP_LRU_SIZE", "10000"))
+# /poll-new-ftds: "totals" diffe kampagne-totaler, "conversions" læs konverteringsloggen med cursor
+POLL_MODE = os.getenv("POLL_MODE", "totals").lower()
+# Indbygget scheduler (erstatter cron-job.org): interval i sekunder per job, 0 = slået fra
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() == "true"
+SCHEDULE_POLL_NEW_FTDS = float(os.getenv("SCHEDULE_POLL_NEW_FTDS", "60"))
+SCHEDULE_ZERO_REVENUE = float(os.getenv("SCHEDULE_ZERO_REVENUE", "600"))
+SCHEDULE_FETCH_FTDS = float(os.getenv("SCHEDULE_FETCH_FTDS", "0"))
+# Poll-reports bygges af cachede time-buckets (se report_cache.py)
+REPORT_CACHE_ENABLED = os.getenv("REPORT_CACHE_ENABLED", "true").lower() == "true"
+
+# State for zero-revenue og poll-new-ftds ligger i .state.db (se state_store.py)
 _DATA_DIR = Path(__file__).parent
-ZERO_SENT_FILE = _DATA_DIR / ".zero_revenue_sent.json"
-ZERO_PENDING_FILE = _DATA_DIR / ".zero_revenue_pending.json"
-ZERO_LAST_FILE = _DATA_DIR / ".zero_revenue_last.json"
-ZERO_DATE_FILE = _DATA_DIR / ".zero_revenue_date.txt"  # Ny dag = nulstil sent
-POLL_FTD_STATE_FILE = _DATA_DIR / ".poll_ftd_state.json"  # State for poll-new-ftds
+OUTBOX_FILE = _DATA_DIR / ".outbox.db"  # Persistent outbox (SQLite, WAL)
+STATE_DB_FILE = _DATA_DIR / ".state.db"  # Deles med state_store (dedup-index)
 
 # Flask app
 app = Flask(__name__)
 
+_outbox = Outbox(
+    OUTBOX_FILE,
+    lambda chat_id, text, priority: get_scheduler().submit(chat_id, text, priority),
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+) if OUTBOX_ENABLED else None
+
+_dedup = DedupIndex(STATE_DB_FILE, ttl=DEDUP_TTL_HOURS * 3600, capacity=DEDUP_LRU_SIZE) if DEDUP_ENABLED else None
+_zero_rules = RuleEngine(ZERO_REVENUE_RULES)
+
+
+@app.before_request
+def _start_outbox():
+    """Start outbox-levering i denne worker, så ikke-sendte beskeder fra før en genstart kommer ud."""
+    if _outbox is not None:
+        _outbox.ensure_started()
+    if SCHEDULER_ENABLED:
+        get_job_scheduler().ensure_started()
+    if metrics.METRICS_ENABLED:
+        metrics.registry.ensure_started()
+    if tracing.TRACE_SAMPLE_RATE > 0:
+        tracing.buffer.ensure_started()
+    if get_recorder() is not None:
+        get_recorder().ensure_started()
+    if get_forwarder() is not None:
+        get_forwarder().ensure_started()  # Retry af gemte forwards, også efter genstart
+    if _ftd_buffer is not None:
+        _ftd_buffer.ensure_started()
+
+
+@app.teardown_request
+def _end_trace(exc=None):
+    """Workerens tråd genbruges – næste request må ikke skrive spans i denne trace."""
+    tracing.use(None)
+
+
 # Sidste postback-resultat (til fejlfinding)
 _last_postback = {"status": None, "message": None, "at": None}
 
+
+def record_postback(status: str, message, reason: str = "", **extra):
+    """Opdater sidste postback-resultat (/diagnose), tæl udfaldet (/metrics) og afslut request-tracen."""
+    _last_postback.update({"status": status, "message": message, "at": datetime.utcnow().isoformat(), **extra})
+    metrics.postback_outcome(status, reason)
+    tracing.finish(status, reason, message)
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -52,37 +135,76 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def send_telegram_message(message: str) -> tuple[bool, str]:
-    """Send a message to Telegram. Returns (success, error_message)."""
+def send_telegram_message(message: str, priority: int = PRIORITY_FTD, wait: bool = True,
+                          durable: bool = True) -> tuple[bool, str]:
+    """Send a message to Telegram via the rate-limited scheduler. Returns (success, error_message).
+
+    wait=False lægger beskeden i køen og returnerer med det samme (til bulk-afsendelse).
+    durable=True skriver beskeden til outboxen først, så den prøves igen hvis afsendelsen fejler.
+    """
+    err = _telegram_config_error()
+    if err:
+        return False, err
+
+    scheduler = get_scheduler()
+    outbox = _outbox if durable else None
+    if not wait:
+        if outbox is None or outbox.append(TELEGRAM_CHAT_ID, message, priority) is None:
+            scheduler.submit(TELEGRAM_CHAT_ID, message, priority)
+        return True, ""
+
+    return send_telegram_messages([message], priority, durable)[0]
+
+
+def send_telegram_messages(messages: list, priority: int = PRIORITY_FTD, durable: bool = True) -> list:
+    """Send flere beskeder og vent på dem samlet (højst TELEGRAM_SEND_TIMEOUT). [(success, error_message), ...]"""
+    err = _telegram_config_error()
+    if err:
+        return [(False, err)] * len(messages)
+
+    scheduler = get_scheduler()
+    outbox = _outbox if durable else None
+    # Claim rækkerne selv og send med det samme – outboxen tager over hvis det fejler
+    with metrics.stage("telegram_send"):
+        jobs = []
+        for message in messages:
+            msg_id = outbox.append(TELEGRAM_CHAT_ID, message, priority, claim=True) if outbox else None
+            job = scheduler.submit(TELEGRAM_CHAT_ID, message, priority)
+            if msg_id is not None:
+                outbox.track(msg_id, 0, job)
+            jobs.append(job)
+        deadline = time.monotonic() + TELEGRAM_SEND_TIMEOUT
+        for job in jobs:
+            job.wait(max(0.0, deadline - time.monotonic()))
+    return [telegram_job_result(job) for job in jobs]
+
+
+def _telegram_config_error():
+    """Fejlbesked hvis bot token/chat ID ikke er sat, ellers None."""
     if not TELEGRAM_BOT_TOKEN or TELEGRAM_BOT_TOKEN == "din_bot_token_her":
-        return False, "Bot token mangler - opdater TELEGRAM_BOT_TOKEN i .env"
+        return "Bot token mangler - opdater TELEGRAM_BOT_TOKEN i .env"
     if not TELEGRAM_CHAT_ID or TELEGRAM_CHAT_ID == "your_chat_id_here":
-        return False, "Chat ID mangler - opdater TELEGRAM_CHAT_ID i .env"
-    
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
-        "text": message,
-        "parse_mode": "HTML"
-    }
-    
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        data = response.json()
-        
-        if not response.ok:
-            err = data.get("description", str(response.status_code))
-            if "unauthorized" in err.lower() or response.status_code == 401:
-                return False, "Ugyldigt bot token - tjek at du har kopieret det korrekt fra BotFather"
-            if "chat not found" in err.lower() or response.status_code == 400:
-                return False, "Chat ikke fundet - send en besked til botten først (Start), så prøv igen"
-            return False, f"Telegram fejl: {err}"
-        
-        logger.info("Telegram message sent successfully")
+        return "Chat ID mangler - opdater TELEGRAM_CHAT_ID i .env"
+    return None
+
+
+def telegram_job_result(job) -> tuple[bool, str]:
+    """(success, error_message) for et scheduler-job med danske fejlbeskeder."""
+    if not job.done:
+        # Ligger stadig i køen (rate limit) – den sendes, men vi venter ikke længere
         return True, ""
-    except requests.RequestException as e:
-        logger.error(f"Failed to send Telegram message: {e}")
-        return False, str(e)
+    if not job.ok:
+        err = job.description or str(job.status_code)
+        if job.status_code is None:
+            return False, err
+        if "unauthorized" in err.lower() or job.status_code == 401:
+            return False, "Ugyldigt bot token - tjek at du har kopieret det korrekt fra BotFather"
+        if "chat not found" in err.lower() or job.status_code == 400:
+            return False, "Chat ikke fundet - send en besked til botten først (Start), så prøv igen"
+        return False, f"Telegram fejl: {err}"
+
+    logger.info("Telegram message sent successfully")
+    return True, ""
 
 
 def country_to_flag(code: str) -> str:
@@ -130,71 +252,118 @@ def format_zero_revenue_message(offer: str, country: str, clicks: int) -> str:
 
 def format_ftd_message(data: dict) -> str:
     """Format FTD – flag, offer, payout på én linje."""
-    offer = (data.get("offer") or data.get("offerName") or data.get("offer_id")
-        or data.get("lander") or data.get("Lander name") or data.get("Campaign name") or "?")
-    country = (data.get("country") or data.get("countryCode") or data.get("geo") or data.get("cc") or "")
-    # Brug Revenue (foretrækkes) eller Payout – første positive værdi
-    def _first_positive(*vals):
-        for v in vals:
-            if v is None or v == "":
-                continue
-            try:
-                n = float(str(v).replace("$", "").replace(",", ".").strip())
-                if n > 0:
-                    return v
-            except (TypeError, ValueError):
-                pass
-        return 0
-    payout = _first_positive(
-        data.get("Revenue"), data.get("revenue"), data.get("Revenue (USD)"),
-        data.get("allConversionsRevenue"), data.get("conversionRevenue"),
-        data.get("payout"), data.get("Payout"), data.get("amount")
-    )
-    try:
-        p = f"${float(payout):.2f}"
-    except (TypeError, ValueError):
-        p = str(payout) if payout else "0"
-    if not str(p).startswith("$"):
-        p = f"${p}"
+    return format_ftd_fields(extract_fields(data, "internal"))
+
+
+def format_ftd_fields(fields: PostbackFields) -> str:
+    """Format FTD ud fra allerede udtrukne felter (Revenue foretrækkes frem for Payout)."""
+    p = f"${fields.revenue:.2f}" if fields.revenue > 0 else "$0"
+    offer = fields.offer or "?"
+    country = fields.country
     flag = country_to_flag(str(country).strip() if country else "")
     return f"{p} - {offer} - {flag}"
 
 
+# FTD-buffer i .state.db: samlede beskeder (FTD_COALESCE_SECONDS) og ledger til digests (ftd_digest.py)
+_ftd_buffer = FtdBuffer(
+    STATE_DB_FILE, FTD_COALESCE_SECONDS, country_to_owner, lambda c: country_to_flag(str(c).strip()),
+    lambda text: send_telegram_message(text, wait=False), FTD_LEDGER_HOURS,
+) if FTD_COALESCE_SECONDS > 0 or DIGEST_HOURLY or DIGEST_DAILY else None
+
+
+def coalesce_ftds(items: list, conn=None) -> bool:
+    """Læg FTD'er [(offer, land, revenue, antal), ...] i den fælles buffer.
+
+    False hvis coalescing er slået fra eller Telegram ikke er konfigureret – så melder den direkte vej fejlen.
+    """
+    if _ftd_buffer is None or not _ftd_buffer.coalescing or _telegram_config_error():
+        return False
+    _ftd_buffer.add(items, conn)
+    return True
+
+
+def ledger_ftds(items: list, conn=None):
+    """Registrér FTD'er der er sendt direkte, så de kommer med i digests."""
+    if _ftd_buffer is not None:
+        _ftd_buffer.add(items, conn, sent=True)
+
+
 @app.route("/", methods=["GET"])
 def index():
     """Health check endpoint."""
+    forwarder = get_forwarder()
     return jsonify({
         "status": "ok",
         "service": "Voluum FTD Telegram Bot",
-        "telegram_configured": bool(TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID)
+        "telegram_configured": bool(TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID),
+        "voluum_forward": forwarder.health() if forwarder is not None else None,
     })
 
 
-def _forward_to_voluum():
-    """Videresend request til Voluum så de stadig modtager konverteringen."""
-    if not VOLUUM_FORWARD_URL:
+def _capture_forward_request() -> dict:
+    """Kopiér de dele af requesten som forward skal bruge (så den kan sendes fra en anden tråd)."""
+    return {
+        "method": request.method,
+        "args": list(request.args.items(multi=True)),
+        "form": request.form.to_dict() if request.form else None,
+        "json": request.get_json(silent=True) if request.is_json else None,
+    }
+
+
+def _forward_to_voluum(fwd: dict = None):
+    """Videresend request til Voluum så de stadig modtager konverteringen.
+
+    Lægges i forward-køen (voluum_forward.py) – postbacken venter ikke på Voluum, og fejlede
+    forwards gemmes og prøves igen.
+    """
+    forwarder = get_forwarder()
+    if forwarder is None:
         return
-    url = f"{VOLUUM_FORWARD_URL}/postback"
-    try:
-        if request.method == "GET":
-            r = requests.get(url, params=request.args, timeout=10)
-        else:
-            r = requests.post(url, data=request.form or None, json=request.json if request.is_json else None, params=request.args, timeout=10)
-        logger.info(f"Forwarded to Voluum: {r.status_code}")
-    except Exception as e:
-        logger.error(f"Voluum forward fejl: {e}")
+    forwarder.submit(fwd if fwd is not None else _capture_forward_request())
+
+
+def _deliver_postback(job: dict):
+    """Baggrundslevering af en postbacks Telegram-besked."""
+    tracing.use(job.get("trace"))  # Spans lægges i postbackens trace, også efter svaret er sendt
+    message = job["message"]
+    with tracing.span("telegram"):
+        ok, err = send_telegram_message(message)
+    if not ok:
+        record_postback("error", err, "telegram")
+        logger.error(f"Telegram fejl (async): {err}")
+        return
+    record_postback("ok", "Sent")
 
 
-def _normalize_postback_data(raw: dict) -> dict:
-    """Gør data case-insensitive og understøt Zapier/Voluum feltnavne."""
-    if not isinstance(raw, dict):
-        return {}
-    data = {}
-    for k, v in raw.items():
-        key = str(k).strip()
-        if key:
-            data[key.lower()] = v
-    return data
+_postback_queue = WorkQueue("postback", _deliver_postback, workers=POSTBACK_WORKERS, maxsize=POSTBACK_QUEUE_SIZE)
+
+
+def _enqueue_postback(message: str) -> bool:
+    """Læg levering i baggrundskøen. Falder tilbage til synkron levering hvis køen er fuld."""
+    job = {"message": message, "trace": tracing.current()}
+    if _postback_queue.submit(job):
+        return True
+    logger.warning("Postback-kø fuld - leverer synkront")
+    _deliver_postback(job)
+    return False
+
+
+def postback_data(method: str, payload, args: dict) -> dict:
+    """Flad dict med str-keys fra en POST-body (Zapier JSON eller form) eller Voluums GET-args."""
+    if method != "POST":
+        return {str(k): v for k, v in args.items()}
+    # Zapier/Voluum: liste, nested {"conversion": {...}}, {"data": {...}}, eller flad obj
+    return unwrap(payload[0] if isinstance(payload, list) and payload else payload)
+
+
+def _normalize_payload() -> tuple[str, dict]:
+    """(kilde, flad dict med str-keys) fra Zapier JSON, form POST eller Voluum GET."""
+    if request.method == "POST":
+        source = "zapier_json" if request.is_json else "form"
+        payload = request.json or request.form.to_dict()
+    else:
+        source, payload = "voluum_get", None
+    return source, postback_data(request.method, payload, dict(request.args))
 
 
 @app.route("/postback", methods=["GET", "POST"])
@@ -204,85 +373,274 @@ def postback():
     Zapier POST til denne URL med Voluum Conversions data.
     KUN konverteringer med Revenue > 0 sendes til Telegram (springer Registration/$0 over).
     """
-    if request.method == "POST":
-        payload = request.json or request.form.to_dict() or {}
-        raw = payload[0] if isinstance(payload, list) and payload else payload
-        # Zapier/Voluum: nested {"conversion": {...}}, {"data": {...}}, eller flad obj
-        if isinstance(raw, dict):
-            raw = raw.get("conversion") or raw.get("data") or raw
-    else:
-        raw = dict(request.args)
-
-    if not isinstance(raw, dict):
-        raw = {}
-    data = {str(k): v for k, v in raw.items()}
-    data_lower = _normalize_postback_data(data)
-
+    recorder = get_recorder()
+    if recorder is not None:
+        # Rå request til bench/replay_postbacks.py (body caches, så form/json stadig kan læses)
+        recorder.record(request.method, list(request.args.items(multi=True)), request.get_data(cache=True),
+                        request.headers)
+    if request.method == "POST" and (is_ndjson(request.content_type)
+                                     or expand(request.get_json(silent=True)) is not None):
+        # Zapier batcher: flere konverteringer i én request – alle håndteres, svar per element
+        return _postback_batch_response()
+    parse_started = time.perf_counter()
+    tracing.start("postback", method=request.method)
+    with tracing.span("normalize"):
+        source, data = _normalize_payload()
+    # Ét gennemløb: offer, land, revenue, type, click ID (alias-plan caches per kilde)
+    with tracing.span("revenue"):
+        fields = extract_fields(data, source)
+    metrics.observe_stage("postback_parse", time.perf_counter() - parse_started)
+    tracing.annotate(source=source, offer=fields.offer, revenue=fields.revenue)
+    body, status = process_postback(source, data, fields)
+    return jsonify(body), status
+
+
+def postback_steps(source: str, data: dict, fields: PostbackFields, fwd: dict = None):
+    """Reglerne for én postback – fælles for /postback her og i asgi_app.
+
+    Generator: al I/O yieldes som (trin, *argumenter) og resultatet sendes tilbage, så Flask kan køre
+    trinnene blokerende (process_postback) og asgi_app await'e dem på event loopet. Trin: claim/release
+    (dedup-key), forward (fwd), coalesce/ledger (FTD'er), send (besked, vent), enqueue (besked).
+    Returnerer (svar, HTTP-status).
+    """
     logger.info(f"Received postback: {data}")
 
     if not data:
-        _last_postback.update({"status": "error", "message": "No data", "at": datetime.utcnow().isoformat()})
-        return jsonify({"error": "No data received"}), 400
+        record_postback("error", "No data", "no_data")
+        return {"error": "No data received"}, 400
+
+    # Gensendt postback (Zapier/affiliate retry)? Så er den allerede forwardet og annonceret
+    key = dedup_key(data, fields) if _dedup is not None else None
+    with tracing.span("dedup"):
+        duplicate = key is not None and not (yield "claim", key)
+    if duplicate:
+        record_postback("duplicate", key)
+        logger.info(f"Dublet postback ({key}) - springer over")
+        return {"status": "duplicate"}, 200
+
+    yield "forward", fwd
 
     # Revenue (foretrækkes) eller Payout fra Voluum – spring over 0, brug første positive værdi
-    def _parse_num(val):
-        if val is None or val == "":
-            return 0
-        try:
-            s = str(val).replace("$", "").replace(",", ".").strip()
-            return float(s) if s else 0
-        except (TypeError, ValueError):
-            return 0
-
-    def _get_revenue(d):
-        keys = ("Revenue", "revenue", "Revenue (USD)", "Revenue(USD)", "allConversionsRevenue",
-                "conversionRevenue", "totalRevenue", "payout", "Payout", "amount", "Amount")
-        for key in keys:
-            v = d.get(key)
-            if v is not None and v != "" and _parse_num(v) > 0:
-                return v
-        for k, v in d.items():
-            if v is not None and v != "" and ("revenue" in k.lower() or "payout" in k.lower()):
-                if _parse_num(v) > 0:
-                    return v
-        return None
-
-    payout_val = _get_revenue(data) or _get_revenue(data_lower)
-    payout_num = 0
-    if payout_val is not None and payout_val != "":
-        try:
-            s = str(payout_val).replace("$", "").replace(",", ".").strip()
-            if s:
-                payout_num = float(s)
-        except (TypeError, ValueError):
-            pass
-
-    _forward_to_voluum()
-
-    if payout_num <= 0:
-        _last_postback.update({"status": "skipped", "message": "No payout", "at": datetime.utcnow().isoformat(), "debug_keys": list(data.keys())})
+    if fields.revenue <= 0:
+        record_postback("skipped", "No payout", "no_payout", debug_keys=list(data.keys()))
         logger.info(f"Ingen payout - springer Telegram over. Data: {data}")
-        return jsonify({"status": "skipped", "message": "No payout", "debug_received": data}), 200
+        return {"status": "skipped", "message": "No payout", "debug_received": data}, 200
 
     # Kun spring over ved tydelig lead/reg - DEPOSIT/FTD sendes altid
-    conv_type = str(
-        data.get("conversionType") or data.get("conversion_type") or data.get("Conversion type")
-        or data.get("et") or data.get("type") or ""
-    ).upper()
-    if conv_type and any(x in conv_type for x in ("LEAD", "REG", "REGISTRATION", "CLICK")):
-        if "FTD" not in conv_type and "CUSTOM" not in conv_type and "SALE" not in conv_type and "DEPOSIT" not in conv_type:
-            _last_postback.update({"status": "skipped", "message": f"Not FTD (type={conv_type})", "at": datetime.utcnow().isoformat()})
-            logger.info(f"Ikke FTD (type={conv_type}) - springer Telegram over")
-            return jsonify({"status": "skipped", "message": "Not FTD", "debug_received": data}), 200
-
-    message = format_ftd_message(data)
-    ok, err = send_telegram_message(message)
+    conv_type = str(fields.conv_type or "").upper()
+    if not is_ftd_type(conv_type):
+        record_postback("skipped", f"Not FTD (type={conv_type})", "not_ftd")
+        logger.info(f"Ikke FTD (type={conv_type}) - springer Telegram over")
+        return {"status": "skipped", "message": "Not FTD", "debug_received": data}, 200
+
+    with tracing.span("format"):
+        message = format_ftd_fields(fields)
+    ftd = [(fields.offer, fields.country, fields.revenue, 1)]
+    if (yield "coalesce", ftd):
+        # Sendes sammen med de andre FTD'er i vinduet (FTD_COALESCE_SECONDS)
+        record_postback("queued", message, "coalesced")
+        return {"status": "queued"}, 202
+    if POSTBACK_ASYNC and _outbox is not None:
+        # Telegram leveres af outboxen (gemt durable før vi svarer)
+        with tracing.span("telegram"):
+            ok, err = yield "send", message, False
+        if ok:
+            yield "ledger", ftd
+            record_postback("queued", message)
+            return {"status": "queued"}, 202
+    elif POSTBACK_ASYNC:
+        queued = yield "enqueue", message
+        yield "ledger", ftd
+        record_postback("queued", message)
+        return {"status": "queued" if queued else "ok"}, 202 if queued else 200
+    else:
+        with tracing.span("telegram"):
+            ok, err = yield "send", message, True
+        # Med outbox ligger beskeden der og prøves igen – afsenderen skal ikke gensende
+        durable = _outbox is not None and TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID
+        if ok or durable:
+            yield "ledger", ftd
+        if not ok and durable:
+            record_postback("retrying", err, "telegram")
+            logger.error(f"Telegram fejl (prøves igen fra outbox): {err}")
+            return {"status": "retrying", "message": err}, 202
     if not ok:
-        _last_postback.update({"status": "error", "message": err, "at": datetime.utcnow().isoformat()})
+        if key is not None:
+            yield "release", key  # Afsenderen må gerne prøve igen
+        record_postback("error", err, "telegram")
         logger.error(f"Telegram fejl: {err}")
-        return jsonify({"status": "error", "message": err, "debug_received": data}), 500
-    _last_postback.update({"status": "ok", "message": "Sent", "at": datetime.utcnow().isoformat()})
-    return jsonify({"status": "ok"}), 200
+        return {"status": "error", "message": err, "debug_received": data}, 500
+    record_postback("ok", "Sent")
+    return {"status": "ok"}, 200
+
+
+_POSTBACK_IO = {
+    "claim": lambda key: _dedup.claim(key),
+    "release": lambda key: _dedup.release(key),
+    "forward": lambda fwd: _forward_to_voluum(fwd),
+    "coalesce": lambda ftd: coalesce_ftds(ftd),
+    "ledger": lambda ftd: ledger_ftds(ftd),
+    "send": lambda message, wait: send_telegram_message(message, wait=wait),
+    "enqueue": lambda message: _enqueue_postback(message),
+}
+
+
+def process_postback(source: str, data: dict, fields: PostbackFields, fwd: dict = None) -> tuple[dict, int]:
+    """Kør postback_steps med blokerende I/O. fwd=None: forward kopierer den aktuelle Flask-request."""
+    steps = postback_steps(source, data, fields, fwd)
+    result = None
+    try:
+        while True:
+            step, *args = steps.send(result)
+            result = _POSTBACK_IO[step](*args)
+    except StopIteration as done:
+        return done.value
+
+
+@app.route("/postback/batch", methods=["POST"])
+def postback_batch():
+    """Batch af konverteringer: JSON-liste, {"conversions": [...]} eller NDJSON. Svarer med udfald per element."""
+    recorder = get_recorder()
+    if recorder is not None:
+        recorder.record(request.method, list(request.args.items(multi=True)), request.get_data(cache=True),
+                        request.headers)
+    return _postback_batch_response()
+
+
+def _postback_batch_response():
+    tracing.start("postback_batch", method=request.method)
+    try:
+        with tracing.span("normalize"):
+            items = parse_batch(request.get_data(cache=True), request.content_type)
+    except ValueError as e:
+        record_postback("error", str(e), "invalid_batch")
+        return jsonify({"error": str(e)}), 400
+    body, status = process_postback_batch(items, list(request.args.items(multi=True)))
+    return jsonify(body), status
+
+
+def process_postback_batch(items: list, args: list = ()) -> tuple[dict, int]:
+    """Håndtér en batch af konverteringer (fra postback_batch.parse_batch) i ét gennemløb.
+
+    Samme regler som /postback per element, men dedup sker i én SQLite-transaktion, forwards lægges
+    samlet i forward-køen (sendes samtidigt af dens workers), og FTD'erne samles i så få
+    Telegram-beskeder som muligt. Returnerer (svar, HTTP-status) med udfald per element.
+    """
+    parse_started = time.perf_counter()
+    results = [None] * len(items)
+    entries = []  # (index, data, fields)
+    with tracing.span("revenue"):
+        for i, raw in enumerate(items):
+            data = unwrap(raw)
+            if raw is None:
+                results[i] = {"status": "error", "reason": "invalid_json"}
+            elif not data:
+                results[i] = {"status": "error", "reason": "no_data"}
+            else:
+                entries.append((i, data, extract_fields(data, "zapier_json")))
+    metrics.observe_stage("postback_parse", time.perf_counter() - parse_started)
+    tracing.annotate(items=len(items))
+    logger.info(f"Received postback batch: {len(items)} konverteringer")
+
+    if not entries:
+        _record_batch(results)
+        return {"error": "No data received", "results": _indexed(results)}, 400
+
+    # Dedup: først inden for batchen, derefter mod index'et i én transaktion
+    fresh, in_batch = [], set()
+    for i, data, fields in entries:
+        key = dedup_key(data, fields)
+        if key in in_batch:
+            results[i] = {"status": "duplicate", "key": key, "in_batch": True}
+            continue
+        in_batch.add(key)
+        fresh.append((i, fields, key))
+    with tracing.span("dedup"):
+        claimed = _dedup.claim_many([key for _, _, key in fresh]) if _dedup is not None else [True] * len(fresh)
+    accepted = []
+    for (i, fields, key), ok in zip(fresh, claimed):
+        if ok:
+            accepted.append((i, fields, key))
+        else:
+            results[i] = {"status": "duplicate", "key": key}
+
+    forwarder = get_forwarder()
+    if forwarder is not None and accepted:
+        forwarder.submit_many([{"method": "POST", "args": list(args), "form": None, "json": items[i]}
+                               for i, _, _ in accepted])
+
+    ftds = []
+    for i, fields, key in accepted:
+        if fields.revenue <= 0:
+            results[i] = {"status": "skipped", "reason": "no_payout"}
+        elif not is_ftd_type(str(fields.conv_type or "").upper()):
+            results[i] = {"status": "skipped", "reason": "not_ftd"}
+        else:
+            ftds.append((i, fields, key))
+
+    items_ftd = [(fields.offer, fields.country, fields.revenue, 1) for _, fields, _ in ftds]
+    chunks = []
+    if coalesce_ftds(items_ftd):
+        # Samles med FTD'er fra andre requests i vinduet (FTD_COALESCE_SECONDS)
+        for i, _, _ in ftds:
+            results[i] = {"status": "queued"}
+    else:
+        with tracing.span("format"):
+            chunks = coalesce([format_ftd_fields(fields) for _, fields, _ in ftds])
+        with tracing.span("telegram"):
+            outcomes = _deliver_batch([text for text, _ in chunks])
+        delivered = []
+        for (_, indexes), (status, err) in zip(chunks, outcomes):
+            for n in indexes:
+                i, _, key = ftds[n]
+                results[i] = {"status": status, "reason": "telegram", "message": err} if err else {"status": status}
+                if status == "error" and _dedup is not None:
+                    _dedup.release(key)  # Afsenderen må gerne prøve netop disse igen
+                elif status != "error":
+                    delivered.append(items_ftd[n])
+        ledger_ftds(delivered)
+
+    summary = _record_batch(results)
+    if any(r["status"] == "error" and r.get("reason") == "telegram" for r in results):
+        code = 500  # Zapier prøver igen; dedup sørger for at kun de fejlede sendes igen
+    elif summary.get("queued"):
+        code = 202
+    else:
+        code = 200
+    return {"status": "ok" if code != 500 else "error", "count": len(items), "messages": len(chunks),
+            "summary": summary, "results": _indexed(results)}, code
+
+
+def _deliver_batch(messages: list) -> list:
+    """Send de samlede FTD-beskeder. [(status, fejl), ...]
+
+    Med outbox gemmes de durable og sendes i baggrunden – en stor batch er flere beskeder, og svaret
+    skal ikke vente på Telegrams rate limit for hver af dem. Uden outbox som /postback.
+    """
+    if _outbox is not None:
+        return [("queued", "") if ok else ("error", err)
+                for ok, err in (send_telegram_message(m, wait=False) for m in messages)]
+    if POSTBACK_ASYNC:
+        return [("queued" if _enqueue_postback(m) else "ok", "") for m in messages]
+    return [("ok", "") if ok else ("error", err) for ok, err in send_telegram_messages(messages)]
+
+
+def _indexed(results: list) -> list:
+    return [{"index": i, **r} for i, r in enumerate(results)]
+
+
+def _record_batch(results: list) -> dict:
+    """Tæl udfald per element (/metrics), opdater /diagnose og afslut batch-tracen. Returnerer {status: antal}."""
+    summary = {}
+    for r in results:
+        metrics.postback_outcome(r["status"], r.get("reason", ""))
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+    status = "error" if summary.get("error") == len(results) else "ok"
+    message = f"Batch: {summary}"
+    _last_postback.update({"status": status, "message": message, "at": datetime.utcnow().isoformat(),
+                           "batch": summary})
+    tracing.finish(status, "batch", message)
+    return summary
 
 
 @app.route("/fetch-ftds", methods=["GET"])
@@ -297,58 +655,35 @@ def fetch_ftds():
     if err:
         return err
 
-    if not VOLUUM_EMAIL or not VOLUUM_PASSWORD:
-        return jsonify({"error": "VOLUUM_EMAIL og VOLUUM_PASSWORD mangler"}), 500
+    body, status = run_fetch_ftds()
+    return jsonify(body), status
 
-    # Auth
-    try:
-        r = requests.post("https://api.voluum.com/auth/session",
-            json={"email": VOLUUM_EMAIL, "password": VOLUUM_PASSWORD},
-            headers={"Content-Type": "application/json"}, timeout=15)
-        r.raise_for_status()
-        token = r.json().get("token")
-    except requests.RequestException as e:
-        logger.error(f"Voluum auth fejl: {e}")
-        return jsonify({"error": str(e)}), 500
+
+def run_fetch_ftds():
+    """Send de 3 nyeste kampagner med revenue. Returnerer (svar, HTTP-status)."""
+    voluum = get_token_manager()
+    if not voluum.has_credentials():
+        return {"error": "VOLUUM_EMAIL og VOLUUM_PASSWORD mangler"}, 500
 
     # Hent kampagner med konverteringer (sidste 24t)
-    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-    from_t = (now - timedelta(hours=24)).strftime("%Y-%m-%dT%H:00:00.000Z")
-    to_t = now.strftime("%Y-%m-%dT%H:00:00.000Z")
-    url = f"https://api.voluum.com/report?from={from_t}&to={to_t}&tz=UTC&groupBy=campaign&limit=500"
     try:
-        resp = requests.get(url, headers={"cwauth-token": token, "Content-Type": "application/json"}, timeout=30)
-        resp.raise_for_status()
-        rows = resp.json().get("rows", [])
+        rows = get_report_ttl_cache().fetch_rows("campaign", *hour_window(24))
     except requests.RequestException as e:
         logger.error(f"Voluum report fejl: {e}")
-        return jsonify({"error": str(e)}), 500
-
-    def _revenue(row):
-        r1 = float(row.get("allConversionsRevenue", 0) or row.get("revenue", 0) or 0)
-        r2 = float(row.get("customRevenue1", 0) or 0)
-        r3 = float(row.get("customRevenue2", 0) or 0)
-        return r1 + r2 + r3
+        return {"error": str(e)}, 500
 
     # Kun kampagner med revenue, sorteret efter opdateret (nyeste først)
-    with_rev = [r for r in rows if _revenue(r) > 0]
-    with_rev.sort(key=lambda r: r.get("updated") or r.get("created") or "", reverse=True)
-    top3 = with_rev[:3]
+    top3 = newest_first([r for r in report_rows(rows) if r.revenue > 0])[:3]
 
     sent_count = 0
     for row in top3:
-        data = {
-            "offer": row.get("offerName") or row.get("offer") or row.get("campaignNamePostfix") or row.get("campaignName") or "?",
-            "country": row.get("offerCountry") or row.get("campaignCountry") or row.get("countryCode") or "",
-            "revenue": _revenue(row),
-            "payout": _revenue(row),
-        }
+        data = {"offer": row.offer, "country": row.country, "revenue": row.revenue, "payout": row.revenue}
         msg = format_ftd_message(data)
         ok, _ = send_telegram_message(msg)
         if ok:
             sent_count += 1
 
-    return jsonify({"status": "ok", "ftds_sent": sent_count, "message": f"Sendt {sent_count} af {len(top3)} til Telegram"}), 200
+    return {"status": "ok", "ftds_sent": sent_count, "message": f"Sendt {sent_count} af {len(top3)} til Telegram"}, 200
 
 
 @app.route("/poll-new-ftds", methods=["GET"])
@@ -363,121 +698,227 @@ def poll_new_ftds():
     if err:
         return err
 
-    if not VOLUUM_EMAIL or not VOLUUM_PASSWORD:
-        return jsonify({"error": "VOLUUM_EMAIL og VOLUUM_PASSWORD mangler"}), 500
+    body, status = run_poll_new_ftds(test_n=request.args.get("test", type=int))
+    return jsonify(body), status
 
-    try:
-        r = requests.post("https://api.voluum.com/auth/session",
-            json={"email": VOLUUM_EMAIL, "password": VOLUUM_PASSWORD},
-            headers={"Content-Type": "application/json"}, timeout=15)
-        r.raise_for_status()
-        token = r.json().get("token")
-    except requests.RequestException as e:
-        logger.error(f"Voluum auth fejl: {e}")
-        return jsonify({"error": str(e)}), 500
 
-    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-    from_t = (now - timedelta(hours=24)).strftime("%Y-%m-%dT%H:00:00.000Z")
-    to_t = now.strftime("%Y-%m-%dT%H:00:00.000Z")
-    url = f"https://api.voluum.com/report?from={from_t}&to={to_t}&tz=UTC&groupBy=campaign&limit=500"
+def run_poll_new_ftds(test_n: int = None):
+    """Én poll-runde. Returnerer (svar, HTTP-status) – kaldes af endpointet og job_scheduler."""
+    voluum = get_token_manager()
+    if not voluum.has_credentials():
+        return {"error": "VOLUUM_EMAIL og VOLUUM_PASSWORD mangler"}, 500
+
+    if POLL_MODE == "conversions":
+        return _poll_conversions()
+
     try:
-        resp = requests.get(url, headers={"cwauth-token": token, "Content-Type": "application/json"}, timeout=30)
-        resp.raise_for_status()
-        rows = resp.json().get("rows", [])
+        if REPORT_CACHE_ENABLED:
+            # Afsluttede timer genbruges fra .state.db – kun de seneste REPORT_CACHE_SETTLE_HOURS hentes hver tick
+            rows = get_report_cache().fetch("campaign", hours_back=24)
+        else:
+            rows = get_report_ttl_cache().fetch_rows("campaign", *hour_window(24))
     except requests.RequestException as e:
         logger.error(f"Voluum report fejl: {e}")
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500
 
-    def get_conv(row):
-        return int(row.get("conversions", 0) or 0) + int(row.get("customConversions1", 0) or 0) + int(row.get("customConversions2", 0) or 0)
-
-    def get_rev(row):
-        r1 = float(row.get("allConversionsRevenue", 0) or row.get("revenue", 0) or 0)
-        r2 = float(row.get("customRevenue1", 0) or 0)
-        r3 = float(row.get("customRevenue2", 0) or 0)
-        return r1 + r2 + r3
+    # Dicts (bucket-cachen) læses ind i ReportRow – fra TTL-cachen er de allerede bygget
+    rows = report_rows(rows)
 
     # Test: send de N seneste FTD'er (baseret på kampagner med revenue, sorteret efter opdateret)
-    test_n = request.args.get("test", type=int)
     if test_n and test_n > 0:
-        with_rev = [row for row in rows if get_conv(row) > 0 and get_rev(row) > 0]
-        with_rev.sort(key=lambda r: r.get("updated") or r.get("created") or "", reverse=True)
+        with_rev = newest_first([row for row in rows if row.conversions > 0 and row.revenue > 0])
         messages_to_send = []
         for row in with_rev:
             if len(messages_to_send) >= test_n:
                 break
-            n_conv = get_conv(row)
-            total_rev = get_rev(row)
-            rev_per = total_rev / n_conv
-            offer = row.get("offerName") or row.get("offer") or row.get("campaignNamePostfix") or row.get("campaignName") or "?"
-            country = row.get("offerCountry") or row.get("campaignCountry") or row.get("countryCode") or ""
-            for _ in range(min(n_conv, test_n - len(messages_to_send))):
-                messages_to_send.append({"offer": offer, "country": country, "revenue": rev_per})
+            rev_per = row.revenue / row.conversions
+            for _ in range(min(row.conversions, test_n - len(messages_to_send))):
+                messages_to_send.append({"offer": row.offer, "country": row.country, "revenue": rev_per})
         sent_count = 0
         for data in messages_to_send:
             msg = format_ftd_message({**data, "payout": data["revenue"]})
             ok, _ = send_telegram_message(msg)
             if ok:
                 sent_count += 1
-        return jsonify({"status": "ok", "ftds_sent": sent_count, "test": True, "message": f"Sendt {sent_count} seneste FTD'er til Telegram"}), 200
-
-    last_state = {}
-    if POLL_FTD_STATE_FILE.exists():
-        try:
-            last_state = json.loads(POLL_FTD_STATE_FILE.read_text())
-        except Exception:
-            pass
+        return {"status": "ok", "ftds_sent": sent_count, "test": True, "message": f"Sendt {sent_count} seneste FTD'er til Telegram"}, 200
 
-    new_state = {}
     sent_count = 0
-    is_first = len(last_state) == 0
+    rows = [row for row in rows if row.campaign_id]
+    now = datetime.utcnow().timestamp()
+
+    # Hele ticket i én transaktion: samtidige kald (flere workers) serialiseres,
+    # og baseline skrives kun hvis alle beskeder er lagt i køen
+    with get_state_store().transaction() as tx:
+        # Plads til hele reporten – en kampagne uden baseline ville ellers blive meldt igen hver tick
+        series = load_series(tx, SCOPE_POLL_FTD, max_keys=len(rows))
+        legacy = tx.load_campaign_totals(SCOPE_POLL_FTD)
+        if legacy:
+            # Engangs-import af totalerne fra før tidsserierne
+            series.reserve(len(legacy))
+            if not len(series):
+                series.record(list(legacy), now, [v["conversions"] for v in legacy.values()],
+                              [v["revenue"] for v in legacy.values()])
+            tx.clear_campaign_totals(SCOPE_POLL_FTD)
+        is_first = len(series) == 0
+
+        # Totaler fra forrige tick (0 for nye kampagner)
+        cids = [row.campaign_id for row in rows]
+        prev_conv, prev_rev = series.latest(cids)
+        recorded = series.record(cids, now, [row.conversions for row in rows], [row.revenue for row in rows])
+        untracked = recorded < 0
+        if untracked.any():
+            logger.warning(f"Poll: {int(untracked.sum())} kampagner fik ingen baseline (tidsserien er fuld) - springes over")
+
+        for i, row in enumerate(rows):
+            total_conv = row.conversions
+            total_rev = row.revenue
+            if total_conv <= 0 or total_rev <= 0 or untracked[i]:
+                continue
 
-    for row in rows:
-        cid = row.get("campaignId")
-        if not cid:
-            continue
-        total_conv = get_conv(row)
-        total_rev = get_rev(row)
-        new_state[cid] = {"conversions": total_conv, "revenue": total_rev}
+            delta_conv = total_conv - int(prev_conv[i])
+            delta_rev = total_rev - float(prev_rev[i])
 
-        if total_conv <= 0 or total_rev <= 0:
-            continue
+            if is_first or delta_conv <= 0 or delta_rev <= 0:
+                continue
 
-        prev = last_state.get(cid, {"conversions": 0, "revenue": 0})
-        delta_conv = total_conv - prev.get("conversions", 0)
-        delta_rev = total_rev - prev.get("revenue", 0)
+            rev_per_conv = delta_rev / delta_conv
+            offer, country = row.offer, row.country
 
-        if is_first or delta_conv <= 0 or delta_rev <= 0:
-            continue
-
-        rev_per_conv = delta_rev / delta_conv
-        offer = row.get("offerName") or row.get("offer") or row.get("campaignNamePostfix") or row.get("campaignName") or "?"
-        country = row.get("offerCountry") or row.get("campaignCountry") or row.get("countryCode") or ""
+            # Samles med andre FTD'er (FTD_COALESCE_SECONDS) – i samme transaktion som baseline
+            if coalesce_ftds([(offer, country, delta_rev, delta_conv)], tx.conn):
+                sent_count += delta_conv
+                continue
+            # Lægges i scheduler-køen – rate limits/429 håndteres der, så burst ikke taber beskeder
+            for _ in range(delta_conv):
+                data = {"offer": offer, "country": country, "revenue": rev_per_conv, "payout": rev_per_conv}
+                msg = format_ftd_message(data)
+                ok, _ = send_telegram_message(msg, wait=False)
+                if ok:
+                    sent_count += 1
+            ledger_ftds([(offer, country, delta_rev, delta_conv)], tx.conn)
+
+        save_series(tx, SCOPE_POLL_FTD, series)
+
+    return {"status": "ok", "ftds_sent": sent_count, "first_run": is_first,
+            "telegram_backlog": get_scheduler().backlog()["queued"]}, 200
+
+
+def _poll_conversions():
+    """POLL_MODE=conversions: én besked per konvertering i loggen, med præcist beløb/offer/land."""
+    poller = get_conversion_poller()
+    store = get_state_store()
+    with store.transaction() as tx:
+        cursor = poller.load_cursor(tx)
+    try:
+        convs = poller.fetch(cursor)
+    except requests.RequestException as e:
+        logger.error(f"Voluum konverteringslog fejl: {e}")
+        return {"error": str(e)}, 500
 
-        for _ in range(delta_conv):
-            data = {"offer": offer, "country": country, "revenue": rev_per_conv, "payout": rev_per_conv}
-            msg = format_ftd_message(data)
-            ok, _ = send_telegram_message(msg)
+    sent_count = 0
+    skipped = 0
+    # Cursoren flyttes kun hvis alle beskeder er lagt i køen (samme transaktion)
+    with store.transaction() as tx:
+        new, is_first = poller.take_new(tx, convs)
+        for conv in new:
+            if conv.fields.revenue <= 0 or not is_ftd_type(conv.fields.conv_type):
+                skipped += 1
+                continue
+            ftd = [(conv.fields.offer, conv.fields.country, conv.fields.revenue, 1)]
+            if coalesce_ftds(ftd, tx.conn):
+                sent_count += 1
+                continue
+            ok, _ = send_telegram_message(format_ftd_fields(conv.fields), wait=False)
             if ok:
                 sent_count += 1
-
-    try:
-        POLL_FTD_STATE_FILE.write_text(json.dumps(new_state))
-    except Exception as e:
-        logger.warning(f"Kunne ikke gemme state: {e}")
-
-    return jsonify({"status": "ok", "ftds_sent": sent_count, "first_run": is_first}), 200
+                ledger_ftds(ftd, tx.conn)
+        cursor = poller.load_cursor(tx)
+
+    return {"status": "ok", "mode": "conversions", "ftds_sent": sent_count, "skipped": skipped,
+            "first_run": is_first, "cursor": cursor,
+            "telegram_backlog": get_scheduler().backlog()["queued"]}, 200
+
+
+# Kødybder til /metrics – postback-kø og Telegram-kø er per worker, outboxen er fælles
+metrics.registry.gauge(
+    "ftd_postback_queue_depth", "Postbacks i baggrundskøen (POSTBACK_ASYNC)", (),
+    lambda: {(): _postback_queue.depth()})
+metrics.registry.gauge(
+    "ftd_telegram_queue_depth", "Beskeder i Telegram-schedulerens kø per prioritet", ("priority",),
+    lambda: {(name,): n for name, n in get_scheduler().backlog()["by_priority"].items()})
+if get_forwarder() is not None:
+    metrics.registry.gauge(
+        "ftd_forward_queue_depth", "Voluum forwards i forward-køen", (),
+        lambda: {(): get_forwarder()._queue.depth()})
+    metrics.registry.gauge(
+        "ftd_forward_breaker_state", "Workers per breaker-tilstand for Voluum forward (closed, open, half_open)",
+        ("state",), lambda: {(get_forwarder().breaker.state,): 1})
+    metrics.registry.gauge(
+        "ftd_forward_retry_backlog", "Gemte Voluum forwards per status (pending, sending, dead)", ("status",),
+        lambda: {(status,): get_forwarder().counts().get(status, 0) for status in ("pending", "sending", "dead")},
+        per_process=False)
+if _outbox is not None:
+    metrics.registry.gauge(
+        "ftd_outbox_messages", "Beskeder i outboxen per status", ("status",),
+        lambda: {(status,): n for status, n in _outbox.counts().items()}, per_process=False)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus metrics (summeret over alle workers)."""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "METRICS_ENABLED=false"}), 404
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/diagnose", methods=["GET"])
 def diagnose():
-    """Se sidste postback-resultat – brug til fejlfinding."""
+    """Se sidste postback-resultat og de seneste traces fra alle workers – brug til fejlfinding.
+
+    ?status=skipped|error|ok|... filtrerer traces, ?limit=N (standard 20).
+    """
+    status = request.args.get("status") or None
+    limit = request.args.get("limit", default=20, type=int)
     return jsonify({
         "last_postback": _last_postback,
+        "recent_postbacks": tracing.buffer.recent(status=status, limit=limit) if tracing.TRACE_SAMPLE_RATE > 0 else None,
+        "postback_async": POSTBACK_ASYNC,
+        "postback_queue": _postback_queue.stats(),
+        "voluum_forward": get_forwarder().stats() if get_forwarder() is not None else None,
+        "http_clients": http_clients.stats(),
+        "telegram_backlog": get_scheduler().backlog(),
+        "dedup": _dedup.stats() if _dedup is not None else None,
+        "postback_fields": extractor.stats(),
+        "voluum_reports": get_report_fetcher().stats(),
+        "report_cache": get_report_cache().stats() if REPORT_CACHE_ENABLED else None,
+        "report_ttl_cache": get_report_ttl_cache().stats(),
+        "poll_mode": POLL_MODE,
+        "jobs": get_job_scheduler().status() if SCHEDULER_ENABLED else None,
+        "conversion_poller": get_conversion_poller().stats() if POLL_MODE == "conversions" else None,
+        "zero_revenue_rules": _zero_rules.stats(),
+        "timeseries": series_stats(),
+        "postback_recorder": get_recorder().stats() if get_recorder() is not None else None,
+        "ftd_buffer": _ftd_buffer.stats() if _ftd_buffer is not None else None,
         "tip": "Hvis status er 'skipped' med 'No payout', tjek at Zapier sender Revenue/Payout felt. Brug /debug i Zapier POST URL for at se raw data."
     }), 200
 
 
+@app.route("/admin/outbox", methods=["GET"])
+def admin_outbox():
+    """
+    Vis beskeder i outboxen der ikke er kommet igennem (fejlede forsøg, opgivne eller gamle).
+    ?older_than=300 (sekunder) styrer hvornår en ventende besked regnes som "stuck".
+    URL: https://DIN-RAILWAY-URL/admin/outbox?secret=DIT_CRON_SECRET
+    """
+    err = _require_cron_secret()
+    if err:
+        return err
+    if _outbox is None:
+        return jsonify({"error": "Outbox er slået fra (OUTBOX_ENABLED=false)"}), 404
+    older_than = request.args.get("older_than", default=300, type=float)
+    return jsonify({"counts": _outbox.counts(), "stuck": _outbox.stuck(older_than=older_than)}), 200
+
+
 @app.route("/debug", methods=["POST"])
 def debug():
     """Se præcis hvad Zapier sender - brug denne URL i Zapier test, så vises data i response."""
@@ -504,7 +945,7 @@ def test():
     }
     
     message = "🧪 <b>TEST NOTIFIKATION</b>\n\n" + format_ftd_message(test_data)
-    success, error = send_telegram_message(message)
+    success, error = send_telegram_message(message, durable=False)
     
     if success:
         return jsonify({"status": "ok", "message": "Test notification sent!"}), 200
@@ -529,7 +970,7 @@ def test_conversion():
         "Click ID": "test-conv-001",
     }
     message = format_ftd_message(test_data)
-    success, error = send_telegram_message(message)
+    success, error = send_telegram_message(message, durable=False)
     
     if success:
         return jsonify({"status": "ok", "message": "Test conversion sent! (Revenue > 0, DEPOSIT)"}), 200
@@ -550,7 +991,7 @@ def _require_cron_secret():
 @app.route("/cron/zero-revenue", methods=["GET"])
 def cron_zero_revenue():
     """
-    Tjek offers med 80+ clicks uden revenue i 1,5 time. Send til Telegram.
+    Evaluér zero-revenue reglerne (standard: offers med 60+ clicks uden revenue i 1,5 time). Send til Telegram.
     Kald fra cron-job.org hvert 10. minut.
     URL: https://DIN-RAILWAY-URL/cron/zero-revenue?secret=DIT_CRON_SECRET
     """
@@ -558,165 +999,93 @@ def cron_zero_revenue():
     if err:
         return err
 
-    if not VOLUUM_EMAIL or not VOLUUM_PASSWORD:
-        return jsonify({"error": "VOLUUM_EMAIL og VOLUUM_PASSWORD mangler"}), 500
+    body, status = run_zero_revenue()
+    return jsonify(body), status
 
-    # Hent token
-    try:
-        r = requests.post("https://api.voluum.com/auth/session",
-            json={"email": VOLUUM_EMAIL, "password": VOLUUM_PASSWORD},
-            headers={"Content-Type": "application/json"}, timeout=15)
-        r.raise_for_status()
-        token = r.json().get("token")
-    except requests.RequestException as e:
-        logger.error(f"Voluum auth fejl: {e}")
-        return jsonify({"error": str(e)}), 500
-
-    # Hent offer-report (kun i dag)
-    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-    from_t = now.replace(hour=0, minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:00:00.000Z")
-    to_t = now.strftime("%Y-%m-%dT%H:00:00.000Z")
-    url = f"https://api.voluum.com/report?from={from_t}&to={to_t}&tz=UTC&groupBy=offer&limit=500"
+
+def run_zero_revenue():
+    """Ét zero-revenue tjek. Returnerer (svar, HTTP-status)."""
+    voluum = get_token_manager()
+    if not voluum.has_credentials():
+        return {"error": "VOLUUM_EMAIL og VOLUUM_PASSWORD mangler"}, 500
+
+    # Hent offer-report (kun i dag) – og campaign-report hvis en regel har scope "campaign"
     try:
-        resp = requests.get(url, headers={"cwauth-token": token, "Content-Type": "application/json"}, timeout=30)
-        resp.raise_for_status()
-        rows = resp.json().get("rows", [])
+        rows = get_report_ttl_cache().fetch("offer", *today_window())
+        campaign_rows = None
+        if _zero_rules.needs_campaign_report():
+            campaign_rows = get_report_ttl_cache().fetch("campaign", *today_window())
     except requests.RequestException as e:
         logger.error(f"Voluum report fejl: {e}")
-        return jsonify({"error": str(e)}), 500
-
-    def get_clicks(row):
-        return int(row.get("uniqueClicks", 0) or 0)
+        return {"error": str(e)}, 500
 
-    def get_revenue(row):
-        r1 = float(row.get("allConversionsRevenue", 0) or row.get("revenue", 0) or 0)
-        r2 = float(row.get("customRevenue1", 0) or 0)
-        r3 = float(row.get("customRevenue2", 0) or 0)
-        return r1 + r2 + r3
-
-    # Regel 1: 0 revenue i dag, 80+ clicks, 1,5t ventetid
-    # Regel 2: Har omsat, men 150+ clicks SIDEN sidste omsætning, 1t ventetid
-    # Maks 1 besked per offer
-    zero_rev_rows = [r for r in rows if get_clicks(r) >= CLICK_THRESHOLD and get_revenue(r) <= 0]
-    has_rev_rows = [r for r in rows if get_revenue(r) > 0]
-    rows_by_oid = {r.get("offerId"): r for r in rows if r.get("offerId")}
+    # Reporten læses én gang ind i kolonner; reglerne evalueres som array-operationer
+    reports = {"offer": ColumnarReport.from_rows(rows, "offer")}
+    if campaign_rows is not None:
+        reports["campaign"] = ColumnarReport.from_rows(campaign_rows, "campaign")
 
     now_dt = datetime.utcnow()
     today_str = now_dt.strftime("%Y-%m-%d")
-    is_new_day = False
-    if ZERO_DATE_FILE.exists():
-        try:
-            if ZERO_DATE_FILE.read_text().strip() != today_str:
-                is_new_day = True
-        except Exception:
-            pass
-    ZERO_DATE_FILE.write_text(today_str)
-
-    sent = set()
-    pending = {}
-    last_snap = {}
-    if not is_new_day:
-        if ZERO_SENT_FILE.exists():
-            try:
-                sent = set(json.loads(ZERO_SENT_FILE.read_text()))
-            except Exception:
-                pass
-        if ZERO_PENDING_FILE.exists():
-            try:
-                pending = json.loads(ZERO_PENDING_FILE.read_text())
-            except Exception:
-                pass
-        if ZERO_LAST_FILE.exists():
-            try:
-                last_snap = json.loads(ZERO_LAST_FILE.read_text())
-            except Exception:
-                pass
-
-    new_pending = {}
-    new_snap = {}
-    sent_count = 0
 
-    # Regel 1: 0 revenue, 60+ clicks, 1,5t
-    for row in zero_rev_rows:
-        oid = row.get("offerId", "")
-        if not oid or oid in sent:
-            continue
-        offer = row.get("offerName") or row.get("offer", "?")
-        uclicks = get_clicks(row)
-        entry = pending.get(oid, {})
-        first_80 = entry.get("first_seen_80") or entry.get("first_seen")
-        if not first_80:
-            first_80 = now_dt.timestamp()
-        try:
-            elapsed = (now_dt.timestamp() - float(first_80)) / 3600
-        except (TypeError, ValueError):
-            new_pending[oid] = {"first_seen_80": first_80}
-            new_snap[oid] = {"clicks": uclicks, "revenue": 0}
-            continue
-        if elapsed >= WAIT_HOURS:
-            country = row.get("offerCountry", row.get("campaignCountry", ""))
-            msg = format_zero_revenue_message(offer, country, uclicks)
-            ok, _ = send_telegram_message(msg)
-            if ok:
-                sent.add(oid)
-                sent_count += 1
-                logger.info(f"Zero-revenue alert (80+): {offer}")
-            new_snap[oid] = {"clicks": uclicks, "revenue": 0}
-            continue
-        new_pending[oid] = {"first_seen_80": first_80}
-        new_snap[oid] = {"clicks": uclicks, "revenue": 0}
+    # Hele ticket i én transaktion – ingen halvt skrevne baselines og ingen dobbelte alerts på tværs af workers
+    with get_state_store().transaction() as tx:
+        if tx.get_meta("zero_revenue_date", today_str) != today_str:
+            tx.reset_zero_revenue()  # Ny dag = nulstil sent, pending og snapshots
+        tx.set_meta("zero_revenue_date", today_str)
+        pending = tx.load_rule_pending()
+        series = {scope: load_series(tx, f"zero_revenue:{scope}") for scope in _zero_rules.scopes}
+        now = now_dt.timestamp()
 
-    # Regel 2: Har omsat, men 150+ clicks siden sidste omsætning, 1t
-    for row in has_rev_rows:
-        oid = row.get("offerId", "")
-        if not oid or oid in sent:
-            continue
-        uclicks = get_clicks(row)
-        rev = get_revenue(row)
-        prev = last_snap.get(oid, {})
-        prev_clicks = int(prev.get("clicks", 0) or 0)
-        prev_rev = float(prev.get("revenue", 0) or 0)
-        new_snap[oid] = {"clicks": uclicks, "revenue": rev}
-
-        if prev_rev <= 0:
-            continue  # Første gang vi ser offer med revenue – mangler baseline
-        if rev > prev_rev:
-            continue  # Ny omsætning – nulstil timer
-        clicks_since = uclicks - prev_clicks
-        if clicks_since < CLICK_THRESHOLD_HIGH:
-            continue
+        alerts, new_pending = _zero_rules.evaluate(reports, pending, tx.load_rule_alerts(), series, now)
+        metrics.observe_stage("zero_revenue_eval", _zero_rules.last_seconds)
 
-        offer = row.get("offerName") or row.get("offer", "?")
-        entry = pending.get(oid, {})
-        first_150 = entry.get("first_seen_150")
-        if not first_150:
-            first_150 = now_dt.timestamp()
-        try:
-            elapsed = (now_dt.timestamp() - float(first_150)) / 3600
-        except (TypeError, ValueError):
-            new_pending[oid] = {**entry, "first_seen_150": first_150}
-            continue
-        if elapsed >= WAIT_HOURS_HIGH:
-            country = row.get("offerCountry", row.get("campaignCountry", ""))
-            msg = format_zero_revenue_message(offer, country, uclicks)
-            ok, _ = send_telegram_message(msg)
+        sent_count = 0
+        for alert in alerts:
+            msg = format_zero_revenue_message(alert.label, alert.country, alert.clicks)
+            ok, _ = send_telegram_message(msg, priority=PRIORITY_ALERT, wait=False)
             if ok:
-                sent.add(oid)
+                tx.add_rule_alert(alert.scope, alert.key, now)
                 sent_count += 1
-                logger.info(f"Zero-revenue alert (150+ siden omsætning): {offer}")
-            continue
-        new_pending[oid] = {**entry, "first_seen_150": first_150}
+                logger.info(f"Zero-revenue alert ({alert.rule.name}): {alert.label}")
 
-    # Behold pending for offers vi stadig tracker
-    for oid, row in rows_by_oid.items():
-        if oid not in new_snap:
-            new_snap[oid] = {"clicks": get_clicks(row), "revenue": get_revenue(row)}
+        tx.sync_rule_pending(pending, new_pending)
+        for scope, store in series.items():
+            save_series(tx, f"zero_revenue:{scope}", store)
 
-    ZERO_SENT_FILE.write_text(json.dumps(list(sent)))
-    ZERO_PENDING_FILE.write_text(json.dumps(new_pending))
-    ZERO_LAST_FILE.write_text(json.dumps(new_snap))
+    return {"status": "ok", "alerts_sent": sent_count, "evaluated_ms": round(_zero_rules.last_seconds * 1000, 3)}, 200
 
-    return jsonify({"status": "ok", "alerts_sent": sent_count}), 200
+
+@app.route("/cron/digest", methods=["GET"])
+def cron_digest():
+    """
+    Send FTD-digest: antal og omsætning per ejer siden sidste digest.
+    URL: https://DIN-RAILWAY-URL/cron/digest?period=hourly|daily&secret=DIT_CRON_SECRET
+    """
+    err = _require_cron_secret()
+    if err:
+        return err
+    body, status = run_digest(request.args.get("period", "daily"))
+    return jsonify(body), status
+
+
+def run_digest(period: str):
+    """Én digest (hourly/daily). Returnerer (svar, HTTP-status)."""
+    if _ftd_buffer is None:
+        return {"error": "FTD-ledger er slået fra - sæt DIGEST_HOURLY/DIGEST_DAILY eller FTD_COALESCE_SECONDS"}, 400
+    if period not in PERIODS:
+        return {"error": f"Ukendt period '{period}' - brug {', '.join(PERIODS)}"}, 400
+    return {"status": "ok", **_ftd_buffer.send_digest(period)}, 200
+
+
+if SCHEDULER_ENABLED:
+    # Leasen i .state.db sørger for at kun én worker kører hvert job per interval
+    _jobs = get_job_scheduler()
+    _jobs.add("poll_new_ftds", run_poll_new_ftds, SCHEDULE_POLL_NEW_FTDS)
+    _jobs.add("zero_revenue", run_zero_revenue, SCHEDULE_ZERO_REVENUE)
+    _jobs.add("fetch_ftds", run_fetch_ftds, SCHEDULE_FETCH_FTDS)
+    _jobs.add("digest_hourly", lambda: run_digest("hourly"), PERIODS["hourly"] if DIGEST_HOURLY else 0)
+    _jobs.add("digest_daily", lambda: run_digest("daily"), PERIODS["daily"] if DIGEST_DAILY else 0)
+    _jobs.ensure_started()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,379 @@
+"""
+ASGI mode
+=========
+Kør med:  uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+(eller:   gunicorn -k uvicorn.workers.UvicornWorker -b 0.0.0.0:$PORT asgi_app:app)
+
+- /postback håndteres native som coroutine: feltudtræk, dedup, Voluum-forward og Telegram
+  kører på ét event loop med httpx.AsyncClient, så en langsom Telegram/Voluum ikke binder
+  en worker per postback.
+- Telegram leveres af AsyncTelegramScheduler (samme rate limits, prioriteter og outbox).
+- Reports hentes asynkront på loopet, men gennem de samme caches som app.py (ReportTTLCache og
+  HourBucketCache): poll-jobs (SCHEDULER_ENABLED) og state-opdateringen kører i en tråd som før.
+- Alle andre routes er de uændrede Flask routes fra app.py (via asgiref's WsgiToAsgi).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+import requests
+from asgiref.wsgi import WsgiToAsgi
+
+import app as flask_app
+import metrics
+import tracing
+from app import record_postback
+from async_reports import AsyncReportFetcher
+from async_telegram import AsyncTelegramScheduler
+from job_scheduler import get_job_scheduler
+from postback_batch import expand, is_ndjson, parse_batch
+from postback_fields import extract_fields
+from postback_recorder import get_recorder
+from report_cache import get_report_ttl_cache
+from telegram_scheduler import PRIORITY_FTD, get_scheduler, install_scheduler, scheduler_settings
+from voluum_forward import BREAKER_OPEN, get_forwarder
+from voluum_reports import REPORT_COLUMNS, VOLUUM_REPORT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+ASGI_MAX_BODY = int(os.getenv("ASGI_MAX_BODY", str(1024 * 1024)))
+ASGI_MAX_BATCH_BODY = int(os.getenv("ASGI_MAX_BATCH_BODY", str(32 * 1024 * 1024)))  # /postback/batch
+ASGI_FORWARD_CONCURRENCY = int(os.getenv("ASGI_FORWARD_CONCURRENCY", "100"))
+ASGI_TELEGRAM_IN_FLIGHT = int(os.getenv("ASGI_TELEGRAM_IN_FLIGHT", "20"))
+
+_wsgi = WsgiToAsgi(flask_app.app)
+_forward_client = None
+_forward_sem = None
+_reports = None
+_background = set()
+
+
+# --- HTTP-hjælpere ----------------------------------------------------------
+
+async def _read_body(receive, limit: int = ASGI_MAX_BODY) -> bytes:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise ValueError("Body for stor")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _json_response(send, body: dict, status: int):
+    data = json.dumps(body).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())]})
+    await send({"type": "http.response.body", "body": data})
+
+
+def _spawn(coro):
+    """Kør coroutine i baggrunden og hold en reference til den er færdig."""
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+# --- Forward + Telegram -----------------------------------------------------
+
+async def forward_to_voluum_async(fwd: dict):
+    """Som app._forward_to_voluum, men som coroutine. Breaker og retry-tabel deles med voluum_forward."""
+    forwarder = get_forwarder()
+    if forwarder is None:
+        return
+    if not forwarder.breaker.allow():
+        await asyncio.to_thread(forwarder.persist, fwd, BREAKER_OPEN)
+        return
+    async with _forward_sem:
+        started = time.perf_counter()
+        code, error = None, None
+        with tracing.span("forward"):
+            try:
+                r = await _forward_client.request(timeout=forwarder.timeout, **forwarder.request_kwargs(fwd))
+                code = r.status_code
+                metrics.upstream("forward", code)
+            except httpx.HTTPError as e:
+                metrics.upstream("forward", "error")
+                error = str(e) or type(e).__name__
+        seconds = time.perf_counter() - started
+        metrics.observe_stage("voluum_forward", seconds)
+    if forwarder.settle(code, seconds, error):
+        await asyncio.to_thread(forwarder.persist, fwd, error or str(code))
+
+
+async def send_telegram_async(message: str, priority: int = PRIORITY_FTD, wait: bool = True) -> tuple[bool, str]:
+    """Som app.send_telegram_message, men venter på loopet i stedet for at blokere en tråd."""
+    err = flask_app._telegram_config_error()
+    if err:
+        return False, err
+    scheduler = get_scheduler()
+    outbox = flask_app._outbox
+    chat_id = flask_app.TELEGRAM_CHAT_ID
+    if not wait:
+        msg_id = await asyncio.to_thread(outbox.append, chat_id, message, priority) if outbox else None
+        if msg_id is None:
+            scheduler.submit(chat_id, message, priority)
+        return True, ""
+    started = time.perf_counter()
+    msg_id = await asyncio.to_thread(outbox.append, chat_id, message, priority, True) if outbox else None
+    job = scheduler.submit(chat_id, message, priority)
+    if msg_id is not None:
+        outbox.track(msg_id, 0, job)
+    await scheduler.wait_async(job, flask_app.TELEGRAM_SEND_TIMEOUT)
+    metrics.observe_stage("telegram_send", time.perf_counter() - started)
+    return flask_app.telegram_job_result(job)
+
+
+# --- /postback ----------------------------------------------------------------
+
+def _normalize_payload(method: str, args: list, headers: dict, body: bytes, fwd: dict) -> tuple[str, dict]:
+    """(kilde, flad dict) via app.postback_data; udfylder fwd med den parsede body."""
+    payload = None
+    if method == "POST":
+        if "json" in headers.get("content-type", ""):
+            source = "zapier_json"
+            try:
+                payload = json.loads(body or b"null")
+            except ValueError:
+                payload = None
+            fwd["json"] = payload
+        else:
+            source = "form"
+            payload = dict(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
+            fwd["form"] = payload or None
+    else:
+        source = "voluum_get"
+    return source, flask_app.postback_data(method, payload, dict(args))
+
+
+async def _deliver_postback_async(message: str):
+    """Baggrundslevering (POSTBACK_ASYNC uden outbox) – som app._deliver_postback, men på loopet."""
+    with tracing.span("telegram"):
+        ok, err = await send_telegram_async(message)
+    if not ok:
+        record_postback("error", err, "telegram")
+        logger.error(f"Telegram fejl (async): {err}")
+        return
+    record_postback("ok", "Sent")
+
+
+async def _postback_io(step: str, *args):
+    """Ét I/O-trin fra app.postback_steps: netværk på loopet, SQLite i en tråd."""
+    if step == "claim":
+        return await asyncio.to_thread(flask_app._dedup.claim, *args)
+    if step == "release":
+        return await asyncio.to_thread(flask_app._dedup.release, *args)
+    if step == "forward":
+        # Forward kører samtidigt med Telegram – afsenderen venter ikke på Voluum
+        _spawn(forward_to_voluum_async(*args))
+        return None
+    if step == "send":
+        message, wait = args
+        return await send_telegram_async(message, wait=wait)
+    if step == "enqueue":
+        _spawn(_deliver_postback_async(*args))
+        return True
+    if flask_app._ftd_buffer is None:  # coalesce/ledger: hverken coalescing eller digests – ingen tråd-hop
+        return False
+    return await asyncio.to_thread(flask_app.coalesce_ftds if step == "coalesce" else flask_app.ledger_ftds, *args)
+
+
+async def process_postback_async(source: str, data: dict, fields, fwd: dict) -> tuple[dict, int]:
+    """app.postback_steps med I/O på event loopet. Returnerer (svar, HTTP-status)."""
+    steps = flask_app.postback_steps(source, data, fields, fwd)
+    result = None
+    try:
+        while True:
+            step, *args = steps.send(result)
+            result = await _postback_io(step, *args)
+    except StopIteration as done:
+        return done.value
+
+
+async def handle_postback_batch(send, args: list, body: bytes = b"", content_type: str = "", items: list = None):
+    """Batch (JSON-liste, {"conversions": [...]} eller NDJSON): app.process_postback_batch i en tråd."""
+    tracing.start("postback_batch", method="POST")
+    if items is None:
+        try:
+            with tracing.span("normalize"):
+                items = parse_batch(body, content_type)
+        except ValueError as e:
+            record_postback("error", str(e), "invalid_batch")
+            await _json_response(send, {"error": str(e)}, 400)
+            return
+    result, status = await asyncio.to_thread(flask_app.process_postback_batch, items, args)
+    await _json_response(send, result, status)
+
+
+async def handle_postback(scope, receive, send):
+    """Native async udgave af app.postback (og /postback/batch) – samme regler og svar."""
+    method = scope["method"]
+    args = parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    fwd = {"method": method, "args": args, "form": None, "json": None}
+    tracing.start("postback", method=method)
+    arrived = time.time()
+
+    body = b""
+    if method == "POST":
+        try:
+            body = await _read_body(receive, ASGI_MAX_BATCH_BODY if scope["path"] == "/postback/batch"
+                                    else ASGI_MAX_BODY)
+        except ValueError:
+            await _json_response(send, {"error": "Body for stor"}, 413)
+            return
+    if get_recorder() is not None:
+        get_recorder().record(method, args, body, headers, arrived)
+    if scope["path"] == "/postback/batch" or (method == "POST" and is_ndjson(headers.get("content-type", ""))):
+        await handle_postback_batch(send, args, body, headers.get("content-type", ""))
+        return
+    parse_started = time.perf_counter()  # Tiden det tager at modtage body tæller ikke med
+    with tracing.span("normalize"):
+        source, data = _normalize_payload(method, args, headers, body, fwd)
+    items = expand(fwd["json"])
+    if items is not None:
+        # Zapier batcher: flere konverteringer i én request
+        await handle_postback_batch(send, args, items=items)
+        return
+    with tracing.span("revenue"):
+        fields = extract_fields(data, source)
+    metrics.observe_stage("postback_parse", time.perf_counter() - parse_started)
+    tracing.annotate(source=source, offer=fields.offer, revenue=fields.revenue)
+    body, status = await process_postback_async(source, data, fields, fwd)
+    await _json_response(send, body, status)
+
+
+# --- Poll-jobs ----------------------------------------------------------------
+
+class _LoopReportFetcher:
+    """ReportFetcher.fetch (blokerende) over AsyncReportFetcher – til report-cacherne.
+
+    Cacherne kører i tråde (jobs og Flask-routes); selve siderne hentes på event loopet.
+    """
+
+    def __init__(self, reports: AsyncReportFetcher, loop):
+        self.reports = reports
+        self.loop = loop
+
+    def fetch(self, group_by: str, from_t: str, to_t: str, **filters) -> list:
+        future = asyncio.run_coroutine_threadsafe(self.reports.fetch(group_by, from_t, to_t, **filters), self.loop)
+        try:
+            return future.result()
+        except httpx.HTTPError as e:
+            # Kalderne (og cachernes fejlhåndtering) forventer requests' undtagelser
+            raise requests.RequestException(str(e) or type(e).__name__) from e
+
+
+# Reports hentes gennem ReportTTLCache/HourBucketCache (som i app.py), så jobs, Flask-routes
+# og andre workers deler dem; state-opdateringen kører i en tråd som før.
+
+async def _poll_new_ftds_job():
+    return await asyncio.to_thread(flask_app.run_poll_new_ftds)
+
+
+async def _zero_revenue_job():
+    return await asyncio.to_thread(flask_app.run_zero_revenue)
+
+
+async def _fetch_ftds_job():
+    return await asyncio.to_thread(flask_app.run_fetch_ftds)
+
+
+def _on_loop(loop, coro_fn):
+    """Job-funktion til job_scheduler-tråden: kør coroutinen på event loopet og vent på svaret."""
+    def run():
+        return asyncio.run_coroutine_threadsafe(coro_fn(), loop).result()
+    return run
+
+
+# --- Lifespan + routing -------------------------------------------------------
+
+async def _startup():
+    global _forward_client, _forward_sem, _reports
+    loop = asyncio.get_running_loop()
+    _forward_client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=ASGI_FORWARD_CONCURRENCY))
+    _forward_sem = asyncio.Semaphore(ASGI_FORWARD_CONCURRENCY)
+    _reports = AsyncReportFetcher(page_size=int(os.getenv("VOLUUM_REPORT_PAGE_SIZE", "500")),
+                                  max_concurrency=int(os.getenv("VOLUUM_REPORT_WORKERS", "4")),
+                                  columns=REPORT_COLUMNS if VOLUUM_REPORT_COLUMNS else None)
+    get_report_ttl_cache().fetcher = _LoopReportFetcher(_reports, loop)
+
+    scheduler = AsyncTelegramScheduler(os.getenv("TELEGRAM_BOT_TOKEN", ""), max_in_flight=ASGI_TELEGRAM_IN_FLIGHT,
+                                       **scheduler_settings())
+    await scheduler.start()
+    install_scheduler(scheduler)
+    if flask_app._outbox is not None:
+        flask_app._outbox.ensure_started()
+    if metrics.METRICS_ENABLED:
+        metrics.registry.ensure_started()
+    if tracing.TRACE_SAMPLE_RATE > 0:
+        tracing.buffer.ensure_started()
+    if get_recorder() is not None:
+        get_recorder().ensure_started()
+    if get_forwarder() is not None:
+        get_forwarder().ensure_started()
+    if flask_app._ftd_buffer is not None:
+        flask_app._ftd_buffer.ensure_started()
+
+    if flask_app.SCHEDULER_ENABLED:
+        jobs = get_job_scheduler()
+        jobs.replace("poll_new_ftds", _on_loop(loop, _poll_new_ftds_job))
+        jobs.replace("zero_revenue", _on_loop(loop, _zero_revenue_job))
+        jobs.replace("fetch_ftds", _on_loop(loop, _fetch_ftds_job))
+        jobs.ensure_started()
+    logger.info("ASGI mode startet")
+
+
+async def _shutdown():
+    get_report_ttl_cache().fetcher = None  # Loopet lukker – tilbage til den synkrone fetcher
+    if _background:
+        await asyncio.gather(*list(_background), return_exceptions=True)
+    scheduler = get_scheduler()
+    if isinstance(scheduler, AsyncTelegramScheduler):
+        await scheduler.stop()
+    if _forward_client is not None:
+        await _forward_client.aclose()
+    if _reports is not None:
+        await _reports.aclose()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await _startup()
+            except Exception as e:
+                logger.exception("ASGI startup fejlede")
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entrypoint: /postback native, resten via Flask."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] == "http" and ((scope["path"] == "/postback" and scope["method"] in ("GET", "POST"))
+                                    or (scope["path"] == "/postback/batch" and scope["method"] == "POST")):
+        content_type = dict(scope.get("headers", [])).get(b"content-type", b"")
+        # Multipart (fil-upload) er sjælden – lad Flask parse den
+        if not content_type.startswith(b"multipart/"):
+            await handle_postback(scope, receive, send)
+            return
+    await _wsgi(scope, receive, send)
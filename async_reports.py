@@ -0,0 +1,147 @@
+"""
+Asynkron Voluum report-fetcher (ASGI mode)
+==========================================
+Som voluum_reports.ReportFetcher, men siderne hentes som coroutines med en
+httpx.AsyncClient: første side giver `totalRows`, resten hentes samtidigt
+(højst `max_concurrency` ad gangen) og flettes i rækkefølge.
+
+Token deles med voluum_auth; login (sjældent) køres i en tråd, så loopet ikke blokerer.
+Svarene streames og parses inkrementelt med samme RowStream og kolonneliste som den synkrone fetcher.
+"""
+
+import asyncio
+import logging
+import time
+
+import httpx
+
+import metrics
+from voluum_auth import get_token_manager
+from voluum_reports import (_ROW_ALIASES, CONVERSIONS_URL, REPORT_URL, STREAM_CHUNK,
+                            RowStream)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncReportFetcher:
+    """Henter alle sider af en Voluum report på event loopet."""
+
+    def __init__(self, client: httpx.AsyncClient = None, token_manager=None, page_size: int = 500,
+                 max_concurrency: int = 4, timeout: float = 30, columns: tuple = None):
+        self.client = client
+        self.token_manager = token_manager
+        self.page_size = page_size
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.columns = columns
+        self.columns_rejected = False
+        self._keep = frozenset(tuple(columns) + _ROW_ALIASES) if columns else None
+        self.reports = 0
+        self.pages = 0
+        self.last_seconds = 0.0
+
+    async def _token(self, voluum) -> str:
+        return voluum.peek_token() or await asyncio.to_thread(voluum.get_token)
+
+    async def _get(self, url: str, query: dict, token: str) -> httpx.Response:
+        """Streamet svar – kalderen skal lukke det (aclose)."""
+        request = self.client.build_request("GET", url, params=query, headers={"cwauth-token": token})
+        try:
+            resp = await self.client.send(request, stream=True)
+        except httpx.HTTPError:
+            metrics.upstream("voluum", "error")
+            raise
+        metrics.upstream("voluum", resp.status_code)
+        return resp
+
+    async def _authed_get(self, url: str, query: dict) -> httpx.Response:
+        voluum = self.token_manager or get_token_manager()
+        token = await self._token(voluum)
+        resp = await self._get(url, query, token)
+        if resp.status_code == 401:
+            logger.info("Voluum 401 - fornyer token")
+            await resp.aclose()
+            voluum.invalidate(token)
+            resp = await self._get(url, query, await self._token(voluum))
+        return resp
+
+    async def _page(self, url: str, params: dict, offset: int, keep: frozenset = None) -> dict:
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout,
+                                            limits=httpx.Limits(max_connections=self.max_concurrency * 2))
+        query = {**params, "limit": self.page_size, "offset": offset}
+        if self.columns_rejected:
+            # Allerede afvist (evt. af en side der blev planlagt samtidig) – spar det fejlede kald
+            query.pop("column", None)
+        resp = await self._authed_get(url, query)
+        if resp.status_code == 400 and "column" in query:
+            await resp.aclose()
+            if not self.columns_rejected:
+                logger.warning("Voluum afviste column-parametrene - henter alle kolonner fremover")
+                self.columns_rejected = True
+            query.pop("column")
+            resp = await self._authed_get(url, query)
+        try:
+            resp.raise_for_status()
+            stream = RowStream(keep)
+            rows = []
+            async for chunk in resp.aiter_bytes(STREAM_CHUNK):
+                rows.extend(stream.feed(chunk))
+            rows.extend(stream.close())
+        finally:
+            await resp.aclose()
+        self.pages += 1
+        return {**stream.meta, "rows": rows}
+
+    async def _fetch_all(self, url: str, params: dict, keep: frozenset = None) -> list:
+        started = time.monotonic()
+        first = await self._page(url, params, 0, keep)
+        rows = list(first.get("rows") or [])
+        total = first.get("totalRows")
+        self.reports += 1
+        if total is not None and int(total) > self.page_size:
+            sem = asyncio.Semaphore(self.max_concurrency)
+
+            async def _bounded(off):
+                async with sem:
+                    return await self._page(url, params, off, keep)
+
+            pages = await asyncio.gather(*(_bounded(off) for off in range(self.page_size, int(total), self.page_size)))
+            for page in pages:
+                rows.extend(page.get("rows") or [])
+        elif total is None:
+            offset = self.page_size
+            more = len(rows) >= self.page_size
+            while more:
+                page_rows = (await self._page(url, params, offset, keep)).get("rows") or []
+                rows.extend(page_rows)
+                more = len(page_rows) >= self.page_size
+                offset += self.page_size
+        self.last_seconds = time.monotonic() - started
+        metrics.observe_stage("report_fetch", self.last_seconds)
+        return rows
+
+    async def fetch(self, group_by: str, from_t: str, to_t: str, **filters) -> list:
+        """Hele reporten som liste. Rejser httpx.HTTPError ved fejl."""
+        params = {"from": from_t, "to": to_t, "tz": "UTC", "groupBy": group_by, **filters}
+        if self.columns and not self.columns_rejected:
+            params["column"] = list(self.columns)
+        return await self._fetch_all(REPORT_URL, params, self._keep)
+
+    async def conversions(self, from_t: str, to_t: str, **filters) -> list:
+        """Konverteringsloggen for perioden (alle sider)."""
+        return await self._fetch_all(CONVERSIONS_URL, {"from": from_t, "to": to_t, "tz": "UTC", **filters})
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "page_size": self.page_size,
+            "max_concurrency": self.max_concurrency,
+            "columns": None if not self.columns or self.columns_rejected else len(self.columns),
+            "reports": self.reports,
+            "pages": self.pages,
+            "last_seconds": round(self.last_seconds, 3),
+        }
@@ -0,0 +1,131 @@
+"""
+Asynkron Telegram-afsender (ASGI mode)
+======================================
+Samme kø, prioriteter, token buckets og 429/retry_after-håndtering som TelegramScheduler,
+men beskederne leveres som coroutines på event loopet med en httpx.AsyncClient.
+
+- submit() kan kaldes fra både event loopet og andre tråde (outboxens leveringstråd,
+  Flask-routes under WSGI-adapteren) – loopet vækkes trådsikkert.
+- Op til `max_in_flight` beskeder er undervejs samtidigt; rate limits håndhæves stadig
+  af token buckets før afsendelse.
+- wait_async() venter på et jobs resultat uden at blokere loopet.
+"""
+
+import asyncio
+import logging
+import os
+
+import httpx
+
+import metrics
+from telegram_scheduler import PRIORITY_FTD, TelegramJob, TelegramScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTelegramScheduler(TelegramScheduler):
+    """TelegramScheduler hvor leveringen kører på et asyncio event loop."""
+
+    def __init__(self, bot_token: str, client: httpx.AsyncClient = None, max_in_flight: int = 20, **rates):
+        super().__init__(bot_token, **rates)
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self._loop = None
+        self._wake = None
+        self._sem = None
+        self._runner = None
+        self._tasks = set()
+
+    async def start(self):
+        """Start leveringen på det kørende loop (kaldes fra ASGI lifespan)."""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._sem = asyncio.Semaphore(self.max_in_flight)
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=self.max_in_flight))
+        self._pid = os.getpid()  # Ingen leveringstråd – loopet overtager
+        self._runner = asyncio.create_task(self._run_async())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.client is not None:
+            await self.client.aclose()
+
+    def _ensure_started(self):
+        if self._loop is None:
+            # Uden event loop (fx i et script) opfører vi os som den trådbaserede scheduler
+            super()._ensure_started()
+
+    def _notify(self):
+        if self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wake.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def submit(self, chat_id, text: str, priority: int = PRIORITY_FTD) -> TelegramJob:
+        job = super().submit(chat_id, text, priority)
+        self._notify()
+        return job
+
+    def _requeue(self, job: TelegramJob):
+        super()._requeue(job)
+        self._notify()
+
+    async def wait_async(self, job: TelegramJob, timeout: float = 30) -> TelegramJob:
+        """Vent på jobbet (højst `timeout` sekunder) uden at blokere loopet."""
+        done = self._loop.create_future()
+
+        def _on_done(_job):
+            self._loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+        job.add_done_callback(_on_done)
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            pass  # Ligger stadig i køen (rate limit) – den sendes, men vi venter ikke længere
+        return job
+
+    async def _run_async(self):
+        while True:
+            # Ryd før vi kigger i køen, så en submit() imellem ikke går tabt
+            self._wake.clear()
+            with self._cond:
+                job, wait = self._pop_ready()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._sem.acquire()
+            task = asyncio.create_task(self._deliver_async(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._sem.release()
+
+    async def _deliver_async(self, job: TelegramJob):
+        job.attempts += 1
+        try:
+            response = await self.client.post(self.send_url, json=self.payload(job))
+            try:
+                data = response.json()
+            except ValueError:
+                data = {}
+        except httpx.HTTPError as e:
+            metrics.upstream("telegram", "error")
+            self._on_error(job, e)
+            return
+        metrics.upstream("telegram", response.status_code)
+        self._on_response(job, response.status_code, data)
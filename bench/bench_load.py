@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Load-benchmark: /postback, /poll-new-ftds og /cron/zero-revenue
+===============================================================
+Starter lokale stand-ins for Telegram og Voluum (bench/fake_upstreams.py), starter appen mod dem
+(gunicorn som i Procfile, eller uvicorn asgi_app:app) og sender requests med fast rate.
+
+Brug:
+    python3 bench/bench_load.py                          # alle scenarier, sammenlign med baseline
+    python3 bench/bench_load.py --scenario postback --rate postback=100 --duration 20
+    python3 bench/bench_load.py --mode asgi --tg-latency 0.2 --tg-error-rate 0.05
+    python3 bench/bench_load.py --save-baseline          # gem resultaterne som ny baseline
+    python3 bench/bench_load.py --env POSTBACK_WORKERS=8  # ekstra env til appen
+
+Per scenarie rapporteres throughput, p50/p95/p99 (målt fra det planlagte sendetidspunkt, så en
+langsom server ikke skjuler sin kø) og leveringsgrad: beskeder modtaget af fake-Telegram i forhold
+til det forventede (FTD-postbacks, nye konverteringer i poll-reporten, zero-revenue offers).
+
+Appen køres fra en midlertidig kopi, så .state.db/.outbox.db i repoet ikke røres. Baseline gemmes
+i bench/baseline.json per scenarie og mode; afviger p95, throughput eller leveringsgrad mere end
+--tolerance, afsluttes med exit code 1.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from fake_upstreams import FakeTelegram, FakeVoluum  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+SECRET = "bench"
+
+# Standard rate (requests/s) per scenarie
+SCENARIOS = {
+    "postback": 50,
+    "poll": 2,
+    "zero_revenue": 1,
+}
+
+MODES = {
+    "sync": {},
+    "async": {"POSTBACK_ASYNC": "true"},
+    "asgi": {},
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))]
+
+
+class AppServer:
+    """Appen som subprocess fra en midlertidig kopi af repoet."""
+
+    def __init__(self, mode: str, workers: int, env: dict):
+        self.mode = mode
+        self.workers = workers
+        self.port = _free_port()
+        self.dir = Path(tempfile.mkdtemp(prefix="ftd-bench-"))
+        for path in ROOT.glob("*.py"):
+            shutil.copy(path, self.dir)
+        self.env = {**os.environ, **MODES[mode], **env}
+        self.log = open(self.dir / "server.log", "w")
+        self.proc = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, timeout: float = 30):
+        if self.mode == "asgi":
+            cmd = [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(self.port),
+                   "--workers", str(self.workers), "--log-level", "warning"]
+        else:
+            cmd = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{self.port}", "-w", str(self.workers),
+                   "--log-level", "warning", "app:app"]
+        self.proc = subprocess.Popen(cmd, cwd=self.dir, env=self.env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                break
+            try:
+                requests.get(self.base_url + "/", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"Appen startede ikke - se {self.dir / 'server.log'}")
+
+    def stop(self, keep: bool = False):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.log.close()
+        if not keep:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def drive(url_for, rate: float, duration: float, concurrency: int) -> dict:
+    """Send rate*duration requests med fast rate (open loop). url_for(i) -> URL."""
+    n = max(1, int(rate * duration))
+    local = threading.local()
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(i: int, scheduled: float):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        try:
+            code = session.get(url_for(i), timeout=60).status_code
+        except requests.RequestException:
+            code = "error"
+        elapsed = time.perf_counter() - scheduled
+        with lock:
+            latencies.append(elapsed)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i in range(n):
+            scheduled = started + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one, i, scheduled)
+    elapsed = time.perf_counter() - started
+    ok = sum(v for k, v in statuses.items() if isinstance(k, int) and 200 <= k < 300)
+    return {
+        "requests": n,
+        "ok": ok,
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "throughput": round(ok / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+    }
+
+
+def wait_delivered(telegram: FakeTelegram, kind: str, expected: int, timeout: float) -> float:
+    """Vent til fake-Telegram har modtaget `expected` beskeder af `kind` (eller timeout). Returnerer sekunder."""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if telegram.stats()["by_kind"].get(kind, 0) >= expected:
+            break
+        time.sleep(0.2)
+    return round(time.monotonic() - started, 1)
+
+
+def run_scenario(name: str, app: AppServer, telegram: FakeTelegram, voluum: FakeVoluum, args) -> dict:
+    rate = args.rates.get(name, SCENARIOS[name])
+    telegram.reset()
+    voluum.reset()
+    base = app.base_url
+
+    if name == "postback":
+        skip_every = int(1 / args.skip_ratio) if args.skip_ratio > 0 else 0
+        run_id = int(time.time())
+
+        def url_for(i):
+            payout = 0 if skip_every and i % skip_every == 0 else 50
+            return f"{base}/postback?cid=bench-{run_id}-{i}&payout={payout}&type=FTD&offer=Bench%20Offer&country=DK"
+
+        n = max(1, int(rate * args.duration))
+        result = drive(url_for, rate, args.duration, args.concurrency)
+        expected = n - (len(range(0, n, skip_every)) if skip_every else 0)
+        expected = min(expected, result["ok"])  # Fejlede requests kan ikke forventes leveret
+        kind = "ftd"
+    elif name == "poll":
+        result = drive(lambda i: f"{base}/poll-new-ftds?secret={SECRET}", rate, args.duration, args.concurrency)
+        expected = None  # Kendes først når fake-Voluum har serveret alle reports
+        kind = "ftd"
+    else:
+        result = drive(lambda i: f"{base}/cron/zero-revenue?secret={SECRET}", rate, args.duration, args.concurrency)
+        expected = voluum.zero_offers
+        kind = "zero_revenue"
+
+    if expected is None:
+        expected = voluum.stats()["ftds_added"]
+    result["drain_seconds"] = wait_delivered(telegram, kind, expected, args.drain_timeout)
+    tg = telegram.stats()
+    delivered = tg["by_kind"].get(kind, 0)
+    result.update({
+        "rate": rate,
+        "duration": args.duration,
+        "expected": expected,
+        "delivered": delivered,
+        "completeness": round(delivered / expected, 4) if expected else 1.0,
+        "telegram_429": tg["throttled"],
+        "telegram_errors": tg["errors"],
+    })
+    if name == "postback":
+        result["forwards"] = voluum.stats()["forwards"]
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Regressioner i forhold til baseline (tom liste = ok)."""
+    problems = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if (base.get("rate"), base.get("duration")) != (cur["rate"], cur["duration"]):
+            print(f"  {key}: baseline er kørt med andre parametre - sammenlignes ikke")
+            continue
+        if cur["p95_ms"] > base["p95_ms"] * (1 + tolerance) + 5:
+            problems.append(f"{key}: p95 {cur['p95_ms']} ms > baseline {base['p95_ms']} ms")
+        if cur["throughput"] < base["throughput"] * (1 - tolerance):
+            problems.append(f"{key}: throughput {cur['throughput']}/s < baseline {base['throughput']}/s")
+        if cur["completeness"] < base["completeness"] - 0.01:
+            problems.append(f"{key}: leveringsgrad {cur['completeness']} < baseline {base['completeness']}")
+    return problems
+
+
+def _print_table(results: dict, baseline: dict):
+    print(f"\n{'scenarie':24s} {'req/s':>7s} {'p50':>8s} {'p95':>8s} {'p99':>8s} {'levering':>14s} {'429':>5s}")
+    for key, r in results.items():
+        base = baseline.get(key) or {}
+        ref = f"  (baseline p95 {base['p95_ms']})" if base else ""
+        print(f"{key:24s} {r['throughput']:7.1f} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} {r['p99_ms']:8.1f} "
+              f"{r['delivered']:>6d}/{r['expected']:<7d} {r['telegram_429']:5d}{ref}")
+
+
+def _parse_pairs(values: list, cast=str) -> dict:
+    out = {}
+    for item in values or []:
+        key, _, value = item.partition("=")
+        out[key.strip()] = cast(value.strip())
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-benchmark mod lokale Telegram/Voluum stand-ins")
+    parser.add_argument("--scenario", default=",".join(SCENARIOS), help="kommasepareret: " + ", ".join(SCENARIOS))
+    parser.add_argument("--mode", choices=list(MODES), default="sync")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--rate", action="append", help="scenarie=requests/s, fx postback=100")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--skip-ratio", type=float, default=0.2, help="andel postbacks uden payout")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--tg-latency", type=float, default=0.05)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-limit", type=float, default=30, help="beskeder/s per chat før 429")
+    parser.add_argument("--voluum-latency", type=float, default=0.1)
+    parser.add_argument("--voluum-error-rate", type=float, default=0.0)
+    parser.add_argument("--env", action="append", help="KEY=VALUE til appen")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--json", type=Path, help="skriv resultaterne hertil")
+    parser.add_argument("--keep", action="store_true", help="behold app-kopien og server.log")
+    args = parser.parse_args()
+    args.rates = _parse_pairs(args.rate, float)
+    scenarios = [s.strip() for s in args.scenario.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"ukendt scenarie: {', '.join(unknown)}")
+
+    telegram = FakeTelegram(latency=args.tg_latency, error_rate=args.tg_error_rate, limit=args.tg_limit).start()
+    voluum = FakeVoluum(latency=args.voluum_latency, error_rate=args.voluum_error_rate).start()
+    env = {
+        "TELEGRAM_BOT_TOKEN": "bench-token",
+        "TELEGRAM_CHAT_ID": "-100100",
+        "TELEGRAM_API_BASE": telegram.base_url,
+        "VOLUUM_API_BASE": voluum.base_url,
+        "VOLUUM_FORWARD_URL": voluum.base_url,
+        "VOLUUM_EMAIL": "bench@example.com",
+        "VOLUUM_PASSWORD": "bench",
+        "VOLUUM_ACCESS_KEY_ID": "",
+        "VOLUUM_ACCESS_KEY_SECRET": "",
+        "CRON_SECRET": SECRET,
+        "SCHEDULER_ENABLED": "false",
+        # Hver tick skal ramme (fake-)Voluum, ellers måles kun TTL-cachen
+        "REPORT_TTL_SECONDS": "0",
+        # Én regel uden ventetid, så zero-revenue faktisk sender alerts
+        "ZERO_REVENUE_RULES": json.dumps([{"name": "bench", "type": "zero_revenue", "clicks": 60}]),
+        # Appens rate limits over fake-Telegrams grænse, så 429-stien bruges
+        "TELEGRAM_CHAT_RATE": str(args.tg_limit * 1.5),
+        "TELEGRAM_GROUP_RATE": str(args.tg_limit * 90),
+        "TELEGRAM_GLOBAL_RATE": str(args.tg_limit * 1.5),
+        **_parse_pairs(args.env),
+    }
+    app = AppServer(args.mode, args.workers, env)
+    print(f"Starter app ({args.mode}, {args.workers} workers) på {app.base_url} - Telegram {telegram.base_url}, "
+          f"Voluum {voluum.base_url}")
+    results = {}
+    try:
+        app.start()
+        for name in scenarios:
+            print(f"- {name} ...", flush=True)
+            results[f"{name}@{args.mode}"] = run_scenario(name, app, telegram, voluum, args)
+    finally:
+        app.stop(keep=args.keep)
+        if args.keep:
+            print(f"App-kopi og server.log: {app.dir}")
+        telegram.stop()
+        voluum.stop()
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    _print_table(results, baseline)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaseline gemt i {args.baseline}")
+        return 0
+    problems = compare(results, baseline, args.tolerance)
+    if problems:
+        print("\nREGRESSION:")
+        for p in problems:
+            print(f"  {p}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: postback-feltudtræk
+====================================
+Sammenligner den gamle multi-pass udtrækning (lowercase-kopi, _get_revenue to gange,
+format_ftd_message med egne nøglekæder) med postback_fields.extract_fields().
+
+Brug: python3 bench/bench_postback_fields.py [antal]
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from postback_fields import PostbackExtractor  # noqa: E402
+
+PAYLOADS = {
+    "voluum_get": {"cid": "abc123", "payout": "150", "campaign": "SWIS - Germany", "country": "DE",
+                   "offer": "Casino X", "source": "Facebook"},
+    "zapier_json": {"Click ID": "conv-001", "Revenue": 142.5, "All Conversions Revenue": 142.5,
+                    "Offer Name": "Casino - Offer", "Campaign name": "SWIS - Germany - Test",
+                    "Country": "Germany", "Conversion type": "DEPOSIT", "Visit timestamp": "2026-01-01",
+                    "Traffic source": "FB", "Custom variable 1": "x", "Custom variable 2": "y"},
+}
+
+
+def legacy_extract(data: dict):
+    """Kopi af den gamle logik fra app.postback() + format_ftd_message() (baseline)."""
+    data_lower = {str(k).strip().lower(): v for k, v in data.items() if str(k).strip()}
+
+    def _parse_num(val):
+        if val is None or val == "":
+            return 0
+        try:
+            s = str(val).replace("$", "").replace(",", ".").strip()
+            return float(s) if s else 0
+        except (TypeError, ValueError):
+            return 0
+
+    def _get_revenue(d):
+        keys = ("Revenue", "revenue", "Revenue (USD)", "Revenue(USD)", "allConversionsRevenue",
+                "conversionRevenue", "totalRevenue", "payout", "Payout", "amount", "Amount")
+        for key in keys:
+            v = d.get(key)
+            if v is not None and v != "" and _parse_num(v) > 0:
+                return v
+        for k, v in d.items():
+            if v is not None and v != "" and ("revenue" in k.lower() or "payout" in k.lower()):
+                if _parse_num(v) > 0:
+                    return v
+        return None
+
+    payout_val = _get_revenue(data) or _get_revenue(data_lower)
+    payout_num = _parse_num(payout_val)
+    conv_type = str(data.get("conversionType") or data.get("conversion_type") or data.get("Conversion type")
+                    or data.get("et") or data.get("type") or "").upper()
+    offer = (data.get("offer") or data.get("offerName") or data.get("offer_id") or data.get("lander")
+             or data.get("Lander name") or data.get("Campaign name") or "?")
+    country = data.get("country") or data.get("countryCode") or data.get("geo") or data.get("cc") or ""
+    for v in (data.get("Revenue"), data.get("revenue"), data.get("Revenue (USD)"), data.get("allConversionsRevenue"),
+              data.get("conversionRevenue"), data.get("payout"), data.get("Payout"), data.get("amount")):
+        if _parse_num(v) > 0:
+            break
+    return payout_num, conv_type, offer, country
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for source, payload in PAYLOADS.items():
+        cached = PostbackExtractor()
+        uncached = PostbackExtractor(max_plans=0)
+        t_legacy = timeit.timeit(lambda: legacy_extract(payload), number=n)
+        t_scan = timeit.timeit(lambda: uncached.extract(payload, source), number=n)
+        t_cached = timeit.timeit(lambda: cached.extract(payload, source), number=n)
+        us = lambda t: t / n * 1e6
+        print(f"{source:12s}  legacy {us(t_legacy):6.2f} µs   single-pass {us(t_scan):6.2f} µs   "
+              f"cached plan {us(t_cached):6.2f} µs   ({t_legacy / t_cached:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Lokale stand-ins for Telegram Bot API og Voluum
+===============================================
+Bruges af bench/bench_load.py, men kan også køres alene til manuel test:
+
+    python3 bench/fake_upstreams.py --telegram-port 8701 --voluum-port 8702
+    TELEGRAM_API_BASE=http://127.0.0.1:8701 VOLUUM_API_BASE=http://127.0.0.1:8702 python3 app.py
+
+Telegram (POST /bot<token>/sendMessage):
+- Token bucket per chat (`limit` beskeder/s). Over grænsen svares 429 med parameters.retry_after
+  som den rigtige API.
+- `latency` sekunder per kald (±50% jitter) og `error_rate` andel 500-svar.
+
+Voluum:
+- POST /auth/session: token med udløb om en time.
+- GET /report?groupBy=campaign|offer: syntetiske rækker, pagineret med limit/offset og totalRows.
+  Ældre enkelttimer er tomme – al data ligger i den senest afsluttede time – så timebucket-cachen ser de
+  samme totaler som en direkte hentning. Hver campaign-report (offset 0) tilføjer `ftds_per_tick`
+  konverteringer, så /poll-new-ftds har noget at sende.
+- GET/POST /postback: forward-mål for /postback (tælles bare).
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+TIME_FORMAT = "%Y-%m-%dT%H:00:00.000Z"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _json(self, status: int, obj: dict, headers: dict = None):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.upstream.handle(self, "GET")
+
+    def do_POST(self):
+        self.server.upstream.handle(self, "POST")
+
+
+class _Upstream:
+    """Fælles: lytter på 127.0.0.1 i en baggrundstråd, latency og fejlrate."""
+
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", port), _Handler)
+        self.server.upstream = self
+        self.errors = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "_Upstream":
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def _fail(self, handler) -> bool:
+        """Svar 500 for en andel af kaldene."""
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            handler._json(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+            return True
+        return False
+
+
+class FakeTelegram(_Upstream):
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0, limit: float = 30):
+        super().__init__(port, latency, error_rate)
+        self.limit = limit
+        self._buckets = {}  # chat_id -> (tokens, sidst fyldt)
+        self.delivered = 0
+        self.throttled = 0
+        self.by_kind = {}
+
+    def reset(self):
+        with self._lock:
+            self.delivered = self.throttled = self.errors = 0
+            self.by_kind = {}
+
+    def _take(self, chat_id) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(chat_id, (self.limit, now))
+            tokens = min(self.limit, tokens + (now - last) * self.limit)
+            ok = tokens >= 1
+            self._buckets[chat_id] = (tokens - 1 if ok else tokens, now)
+            if not ok:
+                self.throttled += 1
+            return ok
+
+    def handle(self, handler, method: str):
+        body = handler._body()
+        if method != "POST" or not urlsplit(handler.path).path.endswith("/sendMessage"):
+            handler._json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        self._delay()
+        if self._fail(handler):
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = dict(parse_qsl(body.decode()))
+        if not self._take(payload.get("chat_id")):
+            handler._json(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                "parameters": {"retry_after": 1}}, {"Retry-After": 1})
+            return
+        kind = "zero_revenue" if "uden at omsætte" in str(payload.get("text", "")) else "ftd"
+        with self._lock:
+            self.delivered += 1
+            self.by_kind[kind] = self.by_kind.get(kind, 0) + 1
+            message_id = self.delivered
+        handler._json(200, {"ok": True, "result": {"message_id": message_id, "chat": {"id": payload.get("chat_id")}}})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"delivered": self.delivered, "throttled": self.throttled, "errors": self.errors,
+                    "by_kind": dict(self.by_kind)}
+
+
+class FakeVoluum(_Upstream):
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0, campaigns: int = 200,
+                 offers: int = 500, zero_ratio: float = 0.1, ftds_per_tick: int = 3):
+        super().__init__(port, latency, error_rate)
+        self.ftds_per_tick = ftds_per_tick
+        rnd = random.Random(42)
+        self.campaigns = [{"campaignId": f"c{i}", "campaignName": f"Bench - Campaign {i}",
+                           "campaignCountry": rnd.choice(["DK", "DE", "SE", "NO"]),
+                           "conversions": rnd.randint(0, 5), "revenue": 0.0} for i in range(campaigns)]
+        for row in self.campaigns:
+            row["revenue"] = row["conversions"] * 50.0
+        self.offers = []
+        for i in range(offers):
+            zero = rnd.random() < zero_ratio
+            self.offers.append({"offerId": f"o{i}", "offerName": f"Bench Offer {i}",
+                                "offerCountry": rnd.choice(["DK", "DE", "SE", "NO"]),
+                                "uniqueClicks": rnd.randint(100, 400) if zero else rnd.randint(0, 400),
+                                "revenue": 0.0 if zero else round(rnd.uniform(10, 500), 2)})
+        self.zero_offers = sum(1 for o in self.offers if o["revenue"] <= 0 and o["uniqueClicks"] > 0)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.logins = 0
+            self.reports = 0
+            self.forwards = 0
+            self.errors = 0
+            self.ftds_added = 0  # Konverteringer tilføjet efter første campaign-report
+            self._served_campaigns = False
+
+    def _tick_campaigns(self):
+        """Nye konverteringer siden sidste campaign-report (første kald er baseline)."""
+        if not self._served_campaigns:
+            self._served_campaigns = True
+            return
+        for row in random.sample(self.campaigns, min(self.ftds_per_tick, len(self.campaigns))):
+            row["conversions"] += 1
+            row["revenue"] += 50.0
+            self.ftds_added += 1
+
+    def handle(self, handler, method: str):
+        url = urlsplit(handler.path)
+        params = dict(parse_qsl(url.query))
+        handler._body()
+        self._delay()
+        if url.path == "/postback":
+            with self._lock:
+                self.forwards += 1
+            handler._json(200, {"status": "ok"})
+            return
+        if self._fail(handler):
+            return
+        if url.path == "/auth/session" and method == "POST":
+            with self._lock:
+                self.logins += 1
+            expires = datetime.utcfromtimestamp(time.time() + 3600).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            handler._json(200, {"token": f"bench-{self.logins}", "expirationTimestamp": expires})
+            return
+        if url.path == "/report" and method == "GET":
+            handler._json(200, self._report(params))
+            return
+        if url.path == "/report/conversions":
+            handler._json(200, {"rows": [], "totalRows": 0})
+            return
+        handler._json(404, {"error": "not found"})
+
+    def _report(self, params: dict) -> dict:
+        now_hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        try:
+            start = datetime.strptime(params["from"], TIME_FORMAT)
+            end = datetime.strptime(params["to"], TIME_FORMAT)
+            closed_bucket = end - start == timedelta(hours=1) and end < now_hour
+        except (KeyError, ValueError):
+            closed_bucket = False
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 500))
+        with self._lock:
+            self.reports += 1
+            if closed_bucket:
+                return {"rows": [], "totalRows": 0}  # Ældre time: ingen data
+            if params.get("groupBy") == "offer":
+                rows = self.offers
+            else:
+                if offset == 0:
+                    self._tick_campaigns()
+                rows = self.campaigns
+            return {"rows": [dict(r) for r in rows[offset:offset + limit]], "totalRows": len(rows)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"logins": self.logins, "reports": self.reports, "forwards": self.forwards,
+                    "errors": self.errors, "ftds_added": self.ftds_added}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokale Telegram/Voluum stand-ins")
+    parser.add_argument("--telegram-port", type=int, default=8701)
+    parser.add_argument("--voluum-port", type=int, default=8702)
+    parser.add_argument("--tg-latency", type=float, default=0.05)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-limit", type=float, default=30)
+    parser.add_argument("--voluum-latency", type=float, default=0.1)
+    parser.add_argument("--voluum-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    tg = FakeTelegram(args.telegram_port, args.tg_latency, args.tg_error_rate, args.tg_limit).start()
+    voluum = FakeVoluum(args.voluum_port, args.voluum_latency, args.voluum_error_rate).start()
+    print(f"TELEGRAM_API_BASE={tg.base_url}\nVOLUUM_API_BASE={voluum.base_url}\nVOLUUM_FORWARD_URL={voluum.base_url}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"telegram {tg.stats()}  voluum {voluum.stats()}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Afspil optagede postbacks
+=========================
+Sender en optagelse fra postback_recorder.py (POSTBACK_RECORD_ENABLED=true) tilbage til /postback
+med samme method, query args, body og headers. Afstanden mellem postbacks bevares, skaleret med --speed.
+
+Brug:
+    python3 bench/replay_postbacks.py recordings/ --target http://127.0.0.1:5000            # 1x
+    python3 bench/replay_postbacks.py recordings/ --target http://127.0.0.1:5000 --speed 10
+    python3 bench/replay_postbacks.py recordings/postbacks-2026...jsonl.gz --speed max --unique
+
+OBS: målet sender Telegram-beskeder og forwarder til Voluum som normalt – peg det mod
+bench/fake_upstreams.py (TELEGRAM_API_BASE, VOLUUM_API_BASE, VOLUUM_FORWARD_URL), ikke produktion.
+
+--unique tilføjer et suffix til click ID/txid-felterne, så målets dedup ikke afviser gentagne afspilninger.
+Postbacks hvis body blev afkortet ved optagelsen (POSTBACK_RECORD_MAX_BODY) springes over – de ville blive
+afvist som ugyldig JSON i stedet for at ramme samme kodevej som originalen.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from bench_load import percentile  # noqa: E402
+from postback_fields import SCHEMA  # noqa: E402
+from postback_recorder import read_segments  # noqa: E402
+
+_ID_KEYS = frozenset(SCHEMA["click_id"] + SCHEMA["txid"])
+
+
+def _suffix_ids(obj, suffix: str):
+    """Kopi af obj hvor ID-felter (også i nested conversion/data og lister) har fået suffix."""
+    if isinstance(obj, dict):
+        return {k: (f"{v}{suffix}" if str(k).strip().lower() in _ID_KEYS and v not in (None, "")
+                    else _suffix_ids(v, suffix)) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_suffix_ids(v, suffix) for v in obj]
+    return obj
+
+
+def build_request(entry: dict, target: str, suffix: str = None) -> dict:
+    """kwargs til requests.request() for én optaget postback."""
+    args = [tuple(a) for a in entry.get("args") or []]
+    body = entry.get("body") or ""
+    headers = dict(entry.get("headers") or {})
+    if suffix:
+        args = [(k, f"{v}{suffix}" if k.strip().lower() in _ID_KEYS and v else v) for k, v in args]
+        if body:
+            if "json" in headers.get("content-type", ""):
+                try:
+                    body = json.dumps(_suffix_ids(json.loads(body), suffix))
+                except ValueError:
+                    pass
+            else:
+                pairs = parse_qsl(body, keep_blank_values=True)
+                body = urlencode([(k, f"{v}{suffix}" if k.strip().lower() in _ID_KEYS and v else v) for k, v in pairs])
+    return {
+        "method": entry.get("method", "GET"),
+        "url": f"{target.rstrip('/')}/postback",
+        "params": args,
+        "data": body.encode("utf-8") if body else None,
+        "headers": headers,
+    }
+
+
+def replay(entries: list, target: str, speed: float = 1.0, concurrency: int = 32, suffix: str = None,
+           timeout: float = 30) -> dict:
+    """Afspil entries. speed=0 betyder så hurtigt som muligt (begrænset af concurrency)."""
+    t0 = entries[0]["t"]
+    local = threading.local()
+    latencies, lags, statuses = [], [], {}
+    lock = threading.Lock()
+
+    def one(entry: dict, scheduled: float):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        sent = time.perf_counter()
+        try:
+            code = session.request(timeout=timeout, **build_request(entry, target, suffix)).status_code
+        except requests.RequestException:
+            code = "error"
+        done = time.perf_counter()
+        with lock:
+            # Latency fra planlagt tidspunkt (som bench_load), lag = hvor sent den blev sendt
+            latencies.append(done - scheduled)
+            lags.append(sent - scheduled)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for entry in entries:
+            scheduled = started + ((entry["t"] - t0) / speed if speed > 0 else 0)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one, entry, scheduled if speed > 0 else time.perf_counter())
+    elapsed = time.perf_counter() - started
+    return {
+        "postbacks": len(entries),
+        "captured_seconds": round(entries[-1]["t"] - t0, 1),
+        "replay_seconds": round(elapsed, 1),
+        "rate": round(len(entries) / elapsed, 1) if elapsed > 0 else None,
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "send_lag_p99_ms": round(percentile(lags, 99) * 1000, 1),
+    }
+
+
+def _speed(value: str) -> float:
+    value = value.lower()
+    return 0.0 if value == "max" else float(value.removesuffix("x"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Afspil optagede postbacks mod /postback")
+    parser.add_argument("paths", nargs="+", help="segmenter (*.jsonl.gz) eller mapper med segmenter")
+    parser.add_argument("--target", default="http://127.0.0.1:5000")
+    parser.add_argument("--speed", type=_speed, default=1.0, help="1, 10, 10x, 0.5 eller max")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--limit", type=int, help="kun de første N postbacks")
+    parser.add_argument("--unique", action="store_true", help="suffix på click ID/txid så dedup ikke slår til")
+    parser.add_argument("--json", type=Path, help="skriv resultatet hertil")
+    args = parser.parse_args()
+
+    entries = read_segments(args.paths)[:args.limit]
+    truncated = sum(1 for e in entries if e.get("truncated"))
+    if truncated:
+        print(f"Springer {truncated} postbacks over med afkortet body (POSTBACK_RECORD_MAX_BODY)")
+        entries = [e for e in entries if not e.get("truncated")]
+    if not entries:
+        print("Ingen postbacks fundet")
+        return 1
+    suffix = f"-r{int(time.time())}" if args.unique else None
+    speed = "max" if args.speed == 0 else f"{args.speed:g}x"
+    print(f"Afspiller {len(entries)} postbacks ({entries[-1]['t'] - entries[0]['t']:.0f}s optaget) "
+          f"mod {args.target} med {speed}")
+    result = replay(entries, args.target, args.speed, args.concurrency, suffix)
+    result["skipped_truncated"] = truncated
+    print(json.dumps(result, indent=2))
+    if args.json:
+        args.json.write_text(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""
+Cursor-baseret poller på Voluums konverteringslog
+=================================================
+Alternativ til at diffe kampagne-totaler (POLL_MODE=conversions): hver konvertering
+læses enkeltvis fra /report/conversions, så beløb, offer og land er præcise.
+
+- Cursor (nyeste postback-tidspunkt) gemmes i .state.db (meta "conversion_cursor").
+- Hver tick henter kun loggen fra CONVERSION_POLL_OVERLAP_MINUTES før cursoren og frem, så trafikken
+  følger antallet af nye konverteringer – ikke antallet af kampagner.
+- Konverteringer i overlap-vinduet genkendes på deres nøgle (dedup_key – txid, click ID eller hash af
+  rækken) i tabellen conversion_seen: flere uden ID i samme sekund og sent indlæste rækker med et
+  tidspunkt før cursoren tabes ikke, og ingen sendes to gange.
+- take_new() kører i state-transaktionen: to samtidige ticks kan ikke sende samme konvertering.
+- Første kørsel sætter kun baseline (ingen beskeder), som poll-new-ftds.
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta
+
+from dedup import dedup_key
+from postback_fields import PostbackFields, parse_amount
+from voluum_reports import TIME_FORMAT, get_report_fetcher
+
+logger = logging.getLogger(__name__)
+
+CURSOR_KEY = "conversion_cursor"
+# Så langt før cursoren genlæses loggen (Voluum kan indlæse konverteringer forsinket)
+CONVERSION_POLL_OVERLAP_MINUTES = float(os.getenv("CONVERSION_POLL_OVERLAP_MINUTES", "30"))
+_CURSOR_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Voluum har brugt flere tidsformater i loggen – prøv dem i rækkefølge
+_TS_FORMATS = ("%Y-%m-%d %I:%M:%S %p", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ",
+               "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_timestamp(val):
+    """Voluum-tidsstempel -> datetime (UTC) eller None."""
+    if not val:
+        return None
+    s = str(val).strip()
+    for fmt in _TS_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class Conversion:
+    """Én række fra konverteringsloggen."""
+
+    __slots__ = ("id", "timestamp", "fields", "row")
+
+    def __init__(self, conv_id: str, timestamp: datetime, fields: PostbackFields, row: dict):
+        self.id = conv_id
+        self.timestamp = timestamp
+        self.fields = fields
+        self.row = row
+
+    @property
+    def cursor(self) -> tuple:
+        return self.timestamp.strftime(_CURSOR_FORMAT), self.id
+
+
+def parse_conversion(row: dict):
+    """Rå log-række -> Conversion (None hvis tidsstempel mangler)."""
+    ts = parse_timestamp(row.get("postbackTimestamp") or row.get("conversionTimestamp") or row.get("timestamp"))
+    if ts is None:
+        return None
+    click_id = row.get("clickId") or row.get("externalId")
+    txid = row.get("transactionId")
+    revenue_raw = row.get("revenue", row.get("payout"))
+    fields = PostbackFields(
+        offer=row.get("offerName") or row.get("offer") or row.get("campaignName"),
+        country=row.get("countryCode") or row.get("countryName") or row.get("offerCountry"),
+        revenue=parse_amount(revenue_raw),
+        revenue_raw=revenue_raw,
+        conv_type=row.get("conversionType") or row.get("conversionTypeName") or row.get("conversionTypeId"),
+        click_id=click_id,
+        txid=txid,
+    )
+    return Conversion(f"{click_id or ''}:{txid or ''}", ts, fields, row)
+
+
+class ConversionPoller:
+    """Henter konverteringer nyere end den gemte cursor."""
+
+    def __init__(self, fetcher=None, max_window_hours: float = 24, overlap_minutes: float = 30):
+        self.fetcher = fetcher
+        self.max_window_hours = max_window_hours
+        self.overlap = timedelta(minutes=overlap_minutes)
+        self.fetched = 0
+        self.taken = 0
+
+    @staticmethod
+    def load_cursor(tx):
+        """Nyeste sete postback-tidspunkt ("%Y-%m-%d %H:%M:%S") eller None før første kørsel."""
+        return tx.get_meta(CURSOR_KEY) or None
+
+    def fetch(self, cursor=None, now: datetime = None) -> list:
+        """Konverteringer fra overlap-vinduet før cursoren og frem, sorteret efter (tid, ID).
+
+        Rejser requests.RequestException ved fejl.
+        """
+        now = now or datetime.utcnow()
+        open_hour = now.replace(minute=0, second=0, microsecond=0)
+        start = open_hour
+        if cursor is not None:
+            since = (datetime.strptime(cursor, _CURSOR_FORMAT) - self.overlap).replace(minute=0, second=0,
+                                                                                        microsecond=0)
+            start = max(since, open_hour - timedelta(hours=self.max_window_hours))
+        rows = (self.fetcher or get_report_fetcher()).conversions(
+            start.strftime(TIME_FORMAT), (open_hour + timedelta(hours=1)).strftime(TIME_FORMAT))
+        convs = []
+        for row in rows:
+            conv = parse_conversion(row)
+            if conv is None:
+                logger.warning(f"Konvertering uden tidsstempel: {row}")
+                continue
+            convs.append(conv)
+        convs.sort(key=lambda c: c.cursor)
+        self.fetched += len(convs)
+        return convs
+
+    @staticmethod
+    def _keys(conversions: list) -> list:
+        """Stabil nøgle per konvertering; ens rækker uden ID'er nummereres i logrækkefølge."""
+        keys, counts = [], {}
+        for conv in conversions:
+            key = dedup_key(conv.row, conv.fields)
+            n = counts[key] = counts.get(key, 0) + 1
+            keys.append(key if n == 1 else f"{key}#{n}")
+        return keys
+
+    def take_new(self, tx, conversions: list, now: datetime = None) -> tuple:
+        """Filtrér til konverteringer der ikke er set før og flyt cursoren (i transaktionen).
+
+        Returnerer (nye konverteringer, first_run).
+        """
+        cursor = self.load_cursor(tx)
+        newest = max([c.cursor[0] for c in conversions] + ([cursor] if cursor else []), default=None)
+        newest = newest or (now or datetime.utcnow()).strftime(_CURSOR_FORMAT)
+        cutoff = (datetime.strptime(newest, _CURSOR_FORMAT) - self.overlap).strftime(_CURSOR_FORMAT)
+        # Ældre end overlap-vinduet: allerede afgjort i en tidligere tick
+        window = [(key, c) for key, c in zip(self._keys(conversions), conversions) if c.cursor[0] >= cutoff]
+        seen = tx.seen_conversions([key for key, _ in window])
+        unseen = [(key, c) for key, c in window if key not in seen]
+        tx.add_seen_conversions([(key, c.cursor[0]) for key, c in unseen])
+        tx.prune_seen_conversions(cutoff)
+        tx.set_meta(CURSOR_KEY, newest)
+        if cursor is None:
+            # Baseline: alt i loggen nu er "set" – intet sendes
+            return [], True
+        self.taken += len(unseen)
+        return [c for _, c in unseen], False
+
+    def stats(self) -> dict:
+        return {"fetched": self.fetched, "taken": self.taken}
+
+
+_poller = None
+
+
+def get_conversion_poller() -> ConversionPoller:
+    """Delt poller for processen."""
+    global _poller
+    if _poller is None:
+        _poller = ConversionPoller(overlap_minutes=CONVERSION_POLL_OVERLAP_MINUTES)
+    return _poller
@@ -0,0 +1,189 @@
+"""
+Idempotente postbacks
+=====================
+Zapier og affiliate-netværk gensender postbacks. DedupIndex husker hvilke
+konverteringer vi allerede har håndteret, så en retry ikke giver en ekstra
+Telegram-besked eller et ekstra Voluum-forward.
+
+- Nøgle: transaction ID, ellers click ID + konverteringstype + payout, ellers hash af hele payloaden.
+- In-memory LRU foran en SQLite-tabel (.state.db): LRU-hit koster ét dict-opslag,
+  SQLite deler index på tværs af gunicorn workers og overlever genstart.
+- Nøgler udløber efter `ttl` sekunder.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from outbox import connect
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS postback_seen (
+    key TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postback_seen_expires ON postback_seen (expires_at);
+"""
+
+# Atomisk på tværs af workers: indsæt, eller overtag en udløbet nøgle
+_CLAIM_SQL = (
+    "INSERT INTO postback_seen (key, seen_at, expires_at) VALUES (?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET seen_at = excluded.seen_at, expires_at = excluded.expires_at "
+    "WHERE postback_seen.expires_at <= excluded.seen_at"
+)
+
+
+def dedup_key(data: dict, fields) -> str:
+    """Idempotens-nøgle for en postback (fields = PostbackFields fra postback_fields)."""
+    if fields.txid:
+        return f"tx:{str(fields.txid).strip()}"
+    if fields.click_id:
+        conv_type = str(fields.conv_type or "").strip().upper()
+        return f"cid:{str(fields.click_id).strip()}:{conv_type}:{fields.revenue:g}"
+    body = json.dumps(data, sort_keys=True, default=str)
+    return "h:" + hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+class DedupIndex:
+    """Bounded TTL-index: LRU i hukommelsen + persistent SQLite-backing."""
+
+    def __init__(self, path: Path, ttl: float = 72 * 3600, capacity: int = 10000):
+        self.path = path
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lru = OrderedDict()  # key -> expires_at
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._claims = 0
+        self.hits = 0
+        self.lru_hits = 0
+        self.misses = 0
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _remember(self, entries: list, hits: int = 0, misses: int = 0, lru_hits: int = 0) -> bool:
+        """Læg [(key, expires_at)] i LRU'en og tæl op under samme lås. True når purge() skal køre."""
+        with self._lock:
+            for key, expires_at in entries:
+                self._lru[key] = expires_at
+                self._lru.move_to_end(key)
+            while len(self._lru) > self.capacity:
+                self._lru.popitem(last=False)
+            self.hits += hits
+            self.lru_hits += lru_hits
+            self.misses += misses
+            before = self._claims
+            self._claims += misses
+            return self._claims // 1000 > before // 1000
+
+    def claim(self, key: str) -> bool:
+        """True hvis nøglen er ny (og nu reserveret), False hvis det er en dublet."""
+        now = time.time()
+        with self._lock:
+            expires_at = self._lru.get(key)
+            if expires_at is not None and expires_at > now:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                self.lru_hits += 1
+                return False
+        try:
+            claimed = self._conn().execute(_CLAIM_SQL, (key, now, now + self.ttl)).rowcount == 1
+        except sqlite3.Error as e:
+            # Hellere en dublet end en tabt FTD
+            logger.error(f"Dedup fejl: {e}")
+            return True
+        if claimed:
+            if self._remember([(key, now + self.ttl)], misses=1):
+                self.purge()
+            return True
+        row = self._conn().execute("SELECT expires_at FROM postback_seen WHERE key = ?", (key,)).fetchone()
+        self._remember([(key, row[0])] if row else [], hits=1)
+        return False
+
+    def claim_many(self, keys: list) -> list:
+        """claim() for en hel batch i én SQLite-transaktion. Returnerer [True/False per nøgle]."""
+        now = time.time()
+        result = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                expires_at = self._lru.get(key)
+                if expires_at is not None and expires_at > now:
+                    self._lru.move_to_end(key)
+                    result[i] = False
+        todo = [i for i, r in enumerate(result) if r is None]
+        lru_hits = len(keys) - len(todo)
+        seen = {}
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for i in todo:
+                if conn.execute(_CLAIM_SQL, (keys[i], now, now + self.ttl)).rowcount == 1:
+                    result[i] = True
+                else:
+                    result[i] = False
+                    row = conn.execute("SELECT expires_at FROM postback_seen WHERE key = ?", (keys[i],)).fetchone()
+                    if row:
+                        seen[keys[i]] = row[0]
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Dedup fejl: {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            # Hellere dubletter end tabte FTD'er
+            pending = set(todo)
+            return [True if i in pending else r for i, r in enumerate(result)]
+        claimed = sum(1 for i in todo if result[i])
+        if self._remember([(keys[i], seen.get(keys[i], now + self.ttl)) for i in todo],
+                          hits=len(keys) - claimed, misses=claimed, lru_hits=lru_hits):
+            self.purge()
+        return result
+
+    def release(self, key: str):
+        """Glem nøglen igen (fx når håndteringen fejlede og afsenderen skal kunne prøve igen)."""
+        with self._lock:
+            self._lru.pop(key, None)
+        try:
+            self._conn().execute("DELETE FROM postback_seen WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error(f"Dedup fejl: {e}")
+
+    def purge(self):
+        """Slet udløbne nøgler fra SQLite."""
+        try:
+            self._conn().execute("DELETE FROM postback_seen WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.error(f"Dedup purge fejl: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, lru_hits, misses, lru_size = self.hits, self.lru_hits, self.misses, len(self._lru)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "lru_hits": lru_hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 3) if total else 0.0,
+            "lru_size": lru_size,
+            "capacity": self.capacity,
+            "ttl_hours": round(self.ttl / 3600, 1),
+        }
@@ -0,0 +1,287 @@
+"""
+Samlede FTD-beskeder og digests
+===============================
+Coalescing (FTD_COALESCE_SECONDS > 0): FTD-notifikationer fra /postback, /postback/batch og poll sendes
+ikke hver for sig. De lægges i tabellen ftd_notification i .state.db, og når den ældste har ventet
+FTD_COALESCE_SECONDS, samles alt i én besked grupperet efter ejer (country_to_owner) og offer/land
+med totaler. Bufferen deles af alle workers, så et burst fordelt på flere workers stadig bliver én
+besked, og den overlever en genstart.
+
+Digests: send_digest("hourly"/"daily") sender antal FTD'er og omsætning per ejer siden sidste digest
+af samme slags (første gang: seneste time/døgn). Køres af job_scheduler (DIGEST_HOURLY, DIGEST_DAILY)
+eller /cron/digest. Rækkerne gemmes FTD_LEDGER_HOURS, også når coalescing er slået fra.
+"""
+
+import html
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from outbox import connect
+from postback_batch import coalesce
+
+logger = logging.getLogger(__name__)
+
+FTD_COALESCE_SECONDS = float(os.getenv("FTD_COALESCE_SECONDS", "0"))
+DIGEST_HOURLY = os.getenv("DIGEST_HOURLY", "false").lower() == "true"
+DIGEST_DAILY = os.getenv("DIGEST_DAILY", "false").lower() == "true"
+FTD_LEDGER_HOURS = float(os.getenv("FTD_LEDGER_HOURS", "48"))
+
+PERIODS = {"hourly": 3600, "daily": 86400}
+_PERIOD_LABELS = {"hourly": "seneste time", "daily": "seneste døgn"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ftd_notification (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    offer TEXT,
+    country TEXT,
+    owner TEXT NOT NULL,
+    revenue REAL NOT NULL,
+    count INTEGER NOT NULL DEFAULT 1,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS ftd_notification_pending ON ftd_notification (sent_at, created_at);
+CREATE INDEX IF NOT EXISTS ftd_notification_created ON ftd_notification (created_at);
+CREATE TABLE IF NOT EXISTS ftd_digest (
+    period TEXT PRIMARY KEY,
+    until REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def _money(value: float) -> str:
+    return f"${value:.2f}"
+
+
+def _ftds(n: int) -> str:
+    return "1 FTD" if n == 1 else f"{n} FTD'er"
+
+
+class FtdBuffer:
+    """Delt FTD-buffer (coalescing) og ledger (digests) i .state.db.
+
+    owner_of/flag_of: land -> ejer/flag (app.country_to_owner/country_to_flag).
+    send: tekst -> (ok, fejl), fx app.send_telegram_message(tekst, wait=False).
+    """
+
+    def __init__(self, path: Path, window: float, owner_of, flag_of, send, retention_hours: float = 48):
+        self.path = path
+        self.window = window
+        self.owner_of = owner_of
+        self.flag_of = flag_of
+        self.send = send
+        self.retention = retention_hours * 3600
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self.added = 0
+        self.flushes = 0
+        self.messages = 0
+        self.last_flush = None
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    @property
+    def coalescing(self) -> bool:
+        return self.window > 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def ensure_started(self):
+        """Start flush-tråden i denne proces (fork-sikkert). Kun når coalescing er slået til."""
+        if not self.coalescing or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="ftd-coalesce", daemon=True).start()
+
+    def add(self, items: list, conn: sqlite3.Connection = None, sent: bool = None):
+        """Registrér FTD'er: [(offer, land, samlet revenue, antal), ...].
+
+        sent=None: ventende hvis coalescing er slået til, ellers kun til digests (allerede sendt).
+        conn: skriv i kalderens transaktion (fx state_store-tick'et), så de følger dens commit.
+        """
+        if not items:
+            return
+        now = time.time()
+        pending = self.coalescing if sent is None else not sent
+        sent_at = None if pending else now
+        (conn or self._conn()).executemany(
+            "INSERT INTO ftd_notification (created_at, offer, country, owner, revenue, count, sent_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(now, offer, country, self.owner_of(country or ""), float(revenue), int(count), sent_at)
+             for offer, country, revenue, count in items])
+        self.added += len(items)
+
+    # --- Coalescing -------------------------------------------------------------
+
+    def _run(self):
+        tick = min(1.0, max(0.1, self.window / 5))
+        while True:
+            time.sleep(tick)
+            try:
+                self.flush_due()
+            except Exception:
+                logger.exception("FTD coalescing fejl")
+
+    def flush_due(self, force: bool = False) -> int:
+        """Send bufferen som samlet besked hvis den ældste har ventet `window`. Returnerer antal beskeder.
+
+        Hver del (højst 4096 tegn) markeres sendt i sin egen transaktion, så en fejl i en senere del
+        ikke sender de første igen ved næste forsøg.
+        """
+        conn = self._conn()
+        oldest = conn.execute("SELECT MIN(created_at) FROM ftd_notification WHERE sent_at IS NULL").fetchone()[0]
+        now = time.time()
+        if oldest is None or (not force and now - oldest < self.window):
+            return 0
+        rows = conn.execute("SELECT id, offer, country, owner, revenue, count FROM ftd_notification "
+                            "WHERE sent_at IS NULL ORDER BY id").fetchall()
+        chunks = self._combine([r[1:] for r in rows]) if rows else []
+        sent = ftds = 0
+        try:
+            for text, indexes in chunks:
+                ids = [rows[i][0] for i in indexes]
+                marks = ", ".join("?" * len(ids))
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # Genlæs i transaktionen – har en anden worker sendt nogle af dem imens, tager den resten
+                    unsent = conn.execute(f"SELECT COUNT(*) FROM ftd_notification WHERE sent_at IS NULL "
+                                          f"AND id IN ({marks})", ids).fetchone()[0] if ids else 0
+                    if unsent < len(ids):
+                        conn.execute("ROLLBACK")
+                        break
+                    if ids:
+                        conn.execute(f"UPDATE ftd_notification SET sent_at = ? WHERE id IN ({marks})", (now, *ids))
+                    # Beskeden lægges i outboxen inden commit – fejler det, ruller vi denne del tilbage og prøver igen
+                    ok, err = self.send(text)
+                    if not ok:
+                        raise RuntimeError(f"Samlet FTD-besked kunne ikke sendes: {err}")
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                sent += 1
+                ftds += sum(rows[i][5] for i in indexes)
+        finally:
+            if sent:
+                self.flushes += 1
+                self.messages += sent
+                self.last_flush = datetime.utcnow().isoformat()
+                logger.info(f"Samlede {ftds} FTD'er i {sent} besked(er)")
+        conn.execute("DELETE FROM ftd_notification WHERE sent_at IS NOT NULL AND created_at < ?",
+                     (now - self.retention,))
+        return sent
+
+    def format_combined(self, rows: list) -> list:
+        """[(offer, land, ejer, revenue, antal), ...] -> beskeder (højst 4096 tegn hver).
+
+        Én FTD giver den sædvanlige linje; flere grupperes efter ejer og offer/land med totaler.
+        """
+        return [text for text, _ in self._combine(rows)]
+
+    def _combine(self, rows: list) -> list:
+        """Som format_combined, men [(tekst, [index i rows, ...]), ...] for hver besked."""
+        groups = {}
+        for i, (offer, country, owner, revenue, count) in enumerate(rows):
+            key = (owner, offer or "?", country or "")
+            n, rev, indexes = groups.get(key, (0, 0.0, []))
+            groups[key] = (n + count, rev + revenue, indexes + [i])
+        total_n = sum(n for n, _, _ in groups.values())
+        total_rev = sum(rev for _, rev, _ in groups.values())
+        if total_n == 1:
+            (_, offer, country), (_, rev, indexes) = next(iter(groups.items()))
+            return [(f"{_money(rev)} - {offer} - {self.flag_of(country)}", indexes)]
+
+        by_owner = {}
+        for (owner, offer, country), (n, rev, indexes) in groups.items():
+            by_owner.setdefault(owner, []).append((rev, n, offer, country, indexes))
+        lines = [f"💰 <b>{_ftds(total_n)} - {_money(total_rev)}</b>"]
+        line_rows = [[]]  # Rækkerne bag hver linje (overskrifter har ingen)
+        for owner, entries in sorted(by_owner.items(), key=lambda kv: -sum(e[0] for e in kv[1])):
+            lines.append("")
+            lines.append(f"<b>{html.escape(owner)}</b>: {_ftds(sum(e[1] for e in entries))} - "
+                         f"{_money(sum(e[0] for e in entries))}")
+            line_rows += [[], []]
+            for rev, n, offer, country, indexes in sorted(entries, key=lambda e: e[:4], reverse=True):
+                prefix = f"{n}x " if n > 1 else ""
+                lines.append(f"{prefix}{_money(rev)} - {html.escape(offer)} - {self.flag_of(country)}")
+                line_rows.append(indexes)
+        return [(text, [i for line in line_indexes for i in line_rows[line]])
+                for text, line_indexes in coalesce(lines)]
+
+    # --- Digests ------------------------------------------------------------------
+
+    def send_digest(self, period: str) -> dict:
+        """Omsætning per ejer siden sidste digest af samme slags. Sendes ikke hvis der ingen FTD'er var."""
+        seconds = PERIODS[period]
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT until FROM ftd_digest WHERE period = ?", (period,)).fetchone()
+            since = max(row[0] if row else now - seconds, now - self.retention)
+            owners = conn.execute(
+                "SELECT owner, SUM(count), SUM(revenue) FROM ftd_notification "
+                "WHERE created_at >= ? AND created_at < ? GROUP BY owner ORDER BY SUM(revenue) DESC",
+                (since, now)).fetchall()
+            conn.execute("INSERT INTO ftd_digest (period, until) VALUES (?, ?) "
+                         "ON CONFLICT(period) DO UPDATE SET until = excluded.until", (period, now))
+            total_n = sum(n for _, n, _ in owners)
+            total_rev = sum(rev for _, _, rev in owners)
+            sent = False
+            if owners:
+                ok, err = self.send(self.format_digest(period, since, now, owners))
+                if not ok:
+                    logger.error(f"FTD digest ({period}) kunne ikke sendes: {err}")
+                sent = ok
+            conn.execute("DELETE FROM ftd_notification WHERE sent_at IS NOT NULL AND created_at < ?",
+                         (now - self.retention,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return {"period": period, "from": datetime.utcfromtimestamp(since).isoformat(),
+                "to": datetime.utcfromtimestamp(now).isoformat(), "ftds": total_n, "revenue": round(total_rev, 2),
+                "by_owner": {owner: {"ftds": n, "revenue": round(rev, 2)} for owner, n, rev in owners},
+                "sent": sent}
+
+    @staticmethod
+    def format_digest(period: str, since: float, until: float, owners: list) -> str:
+        fmt = "%H:%M" if period == "hourly" else "%d/%m %H:%M"
+        span = f"{datetime.utcfromtimestamp(since).strftime(fmt)}–{datetime.utcfromtimestamp(until).strftime(fmt)} UTC"
+        total_n = sum(n for _, n, _ in owners)
+        total_rev = sum(rev for _, _, rev in owners)
+        lines = [f"📊 <b>FTD'er {_PERIOD_LABELS[period]}</b> ({span})",
+                 f"<b>I alt: {_ftds(total_n)} - {_money(total_rev)}</b>", ""]
+        lines += [f"{html.escape(owner)}: {_ftds(n)} - {_money(rev)}" for owner, n, rev in owners]
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        pending = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(count), 0) FROM ftd_notification WHERE sent_at IS NULL").fetchone()
+        digests = dict(self._conn().execute("SELECT period, until FROM ftd_digest").fetchall())
+        return {
+            "window_seconds": self.window,
+            "pending_rows": pending[0],
+            "pending_ftds": pending[1],
+            "added": self.added,
+            "flushes": self.flushes,
+            "messages": self.messages,
+            "last_flush": self.last_flush,
+            "last_digest": {p: datetime.utcfromtimestamp(t).isoformat() for p, t in digests.items()},
+        }
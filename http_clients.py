@@ -0,0 +1,159 @@
+"""
+Delte keep-alive HTTP-klienter
+==============================
+Én langtlevende requests.Session per upstream (Telegram, Voluum API, Voluum forward),
+så TCP+TLS handshake kun betales når en forbindelse åbnes første gang.
+
+- Pool-størrelse og retry/backoff konfigureres per klient via .env.
+- urllib3-poolen er thread-safe, så samme klient kan bruges fra alle tråde i en gunicorn worker.
+- stats() viser nye forbindelser (handshakes) vs genbrugte forbindelser.
+"""
+
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Metoder der må gentages ved 5xx (POST gentages kun ved forbindelsesfejl – ellers risiko for dubletter)
+_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+class _Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def add(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+
+def _counting_pool(base, counters: _Counters):
+    class _CountingPool(base):
+        def _new_conn(self):
+            counters.add("new_connections")
+            return super()._new_conn()
+    return _CountingPool
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter der tæller hvor mange nye forbindelser urllib3 åbner."""
+
+    def __init__(self, counters: _Counters, **kwargs):
+        self._counters = counters
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self._counters),
+            "https": _counting_pool(HTTPSConnectionPool, self._counters),
+        }
+
+
+class PooledClient:
+    """Thread-safe HTTP-klient med connection pooling og retry/backoff."""
+
+    def __init__(self, name: str, pool_size: int = 10, retries: int = 2, backoff: float = 0.5,
+                 status_forcelist=(502, 503, 504)):
+        self.name = name
+        self.pool_size = pool_size
+        self._counters = _Counters()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=status_forcelist,
+            allowed_methods=_IDEMPOTENT_METHODS,
+            raise_on_status=False,
+            respect_retry_after_header=True,
+        )
+        adapter = _CountingAdapter(self._counters, pool_connections=4, pool_maxsize=pool_size,
+                                   max_retries=retry, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        self._counters.add("requests")
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.upstream(self.name, "error")
+            raise
+        metrics.upstream(self.name, r.status_code)
+        return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        reqs = self._counters.requests
+        new = self._counters.new_connections
+        return {
+            "pool_size": self.pool_size,
+            "requests": reqs,
+            "handshakes": new,
+            "reused": max(0, reqs - new),
+        }
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+# Standardindstillinger per upstream – kan overskrives med HTTP_POOL_<NAVN>, HTTP_RETRIES_<NAVN>, HTTP_BACKOFF_<NAVN>
+_DEFAULTS = {
+    "telegram": {"pool_size": 10, "retries": 2, "backoff": 0.5},
+    "voluum": {"pool_size": 10, "retries": 3, "backoff": 1.0},
+    "forward": {"pool_size": 10, "retries": 1, "backoff": 0.5},
+}
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_client(name: str) -> PooledClient:
+    """Delt klient for upstream `name` (telegram, voluum eller forward). Oprettes ved første brug."""
+    global _clients_pid
+    pid = os.getpid()
+    client = _clients.get(name)
+    if client is not None and _clients_pid == pid:
+        return client
+    with _clients_lock:
+        if _clients_pid != pid:
+            # Ny proces (gunicorn fork) – del ikke sockets med forælderen
+            _clients.clear()
+            _clients_pid = pid
+        client = _clients.get(name)
+        if client is None:
+            cfg = _DEFAULTS.get(name, _DEFAULTS["telegram"])
+            key = name.upper()
+            client = PooledClient(
+                name,
+                pool_size=_env_int(f"HTTP_POOL_{key}", cfg["pool_size"]),
+                retries=_env_int(f"HTTP_RETRIES_{key}", cfg["retries"]),
+                backoff=float(os.getenv(f"HTTP_BACKOFF_{key}", str(cfg["backoff"]))),
+            )
+            _clients[name] = client
+    return client
+
+
+def stats() -> dict:
+    """Handshakes vs genbrugte forbindelser for alle oprettede klienter."""
+    return {name: client.stats() for name, client in list(_clients.items())}
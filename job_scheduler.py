@@ -0,0 +1,200 @@
+"""
+Indbygget job-scheduler
+=======================
+Kører poll/zero-revenue jobs på faste intervaller inde i appen i stedet for at vente
+på cron-job.org. HTTP-endpoints virker stadig som manuelle triggers.
+
+- Hvert job har sin egen tråd i hver worker, men en lease i .state.db (tabel job_lease)
+  sikrer at præcis én worker kører jobbet per interval – og aldrig to samtidigt.
+- Dør en worker midt i et job, udløber leasen efter `max_runtime` og en anden tager over.
+- Varighed, lag (hvor længe efter planlagt tid jobbet startede) og fejl gemmes per job
+  og ses i /diagnose på tværs af workers.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from outbox import connect
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_lease (
+    name TEXT PRIMARY KEY,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    next_run REAL NOT NULL DEFAULT 0,
+    last_started REAL,
+    last_finished REAL,
+    last_duration REAL,
+    last_lag REAL,
+    max_lag REAL NOT NULL DEFAULT 0,
+    runs INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+) WITHOUT ROWID;
+"""
+
+
+class Job:
+    __slots__ = ("name", "fn", "interval", "max_runtime")
+
+    def __init__(self, name: str, fn, interval: float, max_runtime: float):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.max_runtime = max_runtime
+
+
+class JobScheduler:
+    """Intervalbaserede jobs med SQLite-lease (én kørsel per interval på tværs af workers)."""
+
+    def __init__(self, path: Path, tick: float = 1.0):
+        self.path = path
+        self.tick = tick
+        self.jobs = {}
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    @property
+    def owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, name: str, fn, interval: float, max_runtime: float = 600):
+        """Registrér fn() til at køre hvert `interval` sekund. interval <= 0 = slået fra."""
+        if interval > 0:
+            self.jobs[name] = Job(name, fn, interval, max_runtime)
+
+    def replace(self, name: str, fn):
+        """Skift funktionen for et registreret job (fx async-varianten i ASGI mode)."""
+        job = self.jobs.get(name)
+        if job is not None:
+            job.fn = fn
+
+    def ensure_started(self):
+        """Start én tråd per job i denne proces (fork-sikkert)."""
+        if self._pid == os.getpid() or not self.jobs:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for job in self.jobs.values():
+                threading.Thread(target=self._loop, args=(job,), name=f"job-{job.name}", daemon=True).start()
+            logger.info(f"Job scheduler startet: {', '.join(f'{j.name}/{j.interval:g}s' for j in self.jobs.values())}")
+
+    def _acquire(self, job: Job):
+        """Tag leasen hvis jobbet er forfaldent og ingen kører det. Returnerer planlagt starttid eller None."""
+        now = time.time()
+        conn = self._conn()
+        select = "SELECT lease_until, next_run FROM job_lease WHERE name = ?"
+        try:
+            # Uden transaktion først: de fleste ticks er ikke forfaldne og skal ikke tage skrivelåsen
+            row = conn.execute(select, (job.name,)).fetchone()
+            if row and (row[0] > now or row[1] > now):
+                return None
+            conn.execute("BEGIN IMMEDIATE")
+            # Tjek igen under låsen – en anden worker kan have taget leasen imens
+            row = conn.execute(select, (job.name,)).fetchone()
+            lease_until, next_run = row if row else (0, 0)
+            if lease_until > now or next_run > now:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "INSERT INTO job_lease (name, owner, lease_until, next_run, last_started) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until, "
+                "next_run = excluded.next_run, last_started = excluded.last_started",
+                (job.name, self.owner, now + job.max_runtime, now + job.interval, now))
+            conn.execute("COMMIT")
+            return next_run or now
+        except sqlite3.Error as e:
+            logger.error(f"Job lease fejl ({job.name}): {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            return None
+
+    def _release(self, job: Job, started: float, lag: float, error: str = None):
+        finished = time.time()
+        try:
+            self._conn().execute(
+                "UPDATE job_lease SET lease_until = 0, last_finished = ?, last_duration = ?, last_lag = ?, "
+                "max_lag = MAX(max_lag, ?), runs = runs + 1, failures = failures + ?, last_error = ? "
+                "WHERE name = ? AND owner = ?",
+                (finished, finished - started, lag, lag, 1 if error else 0, error, job.name, self.owner))
+        except sqlite3.Error as e:
+            logger.error(f"Job lease fejl ({job.name}): {e}")
+
+    def run_once(self, job: Job) -> bool:
+        """Kør jobbet hvis det er forfaldent og leasen er ledig. True hvis det blev kørt."""
+        scheduled = self._acquire(job)
+        if scheduled is None:
+            return False
+        started = time.time()
+        lag = max(0.0, started - scheduled)
+        error = None
+        try:
+            result = job.fn()
+            # Jobs er app-funktioner der returnerer (svar, HTTP-status)
+            if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], int) and result[1] >= 400:
+                error = str(result[0].get("error") if isinstance(result[0], dict) else result[0])
+        except Exception as e:
+            logger.exception(f"Job {job.name} fejlede")
+            error = str(e)
+        self._release(job, started, lag, error)
+        return True
+
+    def _loop(self, job: Job):
+        while True:
+            self.run_once(job)
+            time.sleep(self.tick)
+
+    def status(self) -> dict:
+        """Status per job (fra .state.db – dækker alle workers)."""
+        keys = ("owner", "lease_until", "next_run", "last_started", "last_finished", "last_duration",
+                "last_lag", "max_lag", "runs", "failures", "last_error")
+        rows = self._conn().execute(
+            f"SELECT name, {', '.join(keys)} FROM job_lease").fetchall()
+        now = time.time()
+        out = {}
+        for name, *vals in rows:
+            info = dict(zip(keys, vals))
+            info["running"] = info.pop("lease_until") > now
+            for k in ("last_duration", "last_lag", "max_lag"):
+                if info[k] is not None:
+                    info[k] = round(info[k], 3)
+            info["interval"] = self.jobs[name].interval if name in self.jobs else None
+            out[name] = info
+        return out
+
+
+_job_scheduler = None
+_job_scheduler_lock = threading.Lock()
+
+
+def get_job_scheduler() -> JobScheduler:
+    """Delt scheduler (lease i .state.db)."""
+    global _job_scheduler
+    if _job_scheduler is None:
+        with _job_scheduler_lock:
+            if _job_scheduler is None:
+                _job_scheduler = JobScheduler(Path(__file__).parent / ".state.db")
+    return _job_scheduler
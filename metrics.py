@@ -0,0 +1,299 @@
+"""
+Prometheus-metrics
+==================
+Tællere, gauges og latency-histogrammer i Prometheus' tekstformat på /metrics.
+
+- Registrering er billig nok til at køre altid: én lås og et par additioner per observation,
+  ingen I/O på hot path.
+- Hver proces (gunicorn worker, voluum_poll.py) skriver sit snapshot til .state.db
+  (tabel metrics_snapshot) hvert METRICS_FLUSH_SECONDS; /metrics summerer alle processer,
+  så tallene er de samme uanset hvilken worker Prometheus rammer.
+- Snapshots fra døde processer beholdes i METRICS_RETENTION_HOURS, så tællere ikke falder
+  når en worker genstartes. Gauges (kødybder) tælles kun med fra levende processer.
+"""
+
+import bisect
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from outbox import connect
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "10"))
+METRICS_RETENTION_HOURS = float(os.getenv("METRICS_RETENTION_HOURS", "24"))
+
+# Sekunder – dækker alt fra feltudtræk (µs) til Voluum reports (sekunder)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics_snapshot (
+    owner TEXT PRIMARY KEY,
+    updated REAL NOT NULL,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(k), v if not isinstance(v, list) else list(v)] for k, v in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge hvis værdi hentes ved snapshot (fx kødybde) – `fn` returnerer {label-tuple: værdi}.
+
+    per_process=False: værdien er den samme i alle processer (fx outboxen i .state.db) og
+    læses direkte ved /metrics i stedet for at blive summeret.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple, fn, per_process: bool = True):
+        super().__init__(name, help_text, labels)
+        self.fn = fn
+        self.per_process = per_process
+
+    def snapshot(self) -> list:
+        try:
+            return [[list(k), v] for k, v in self.fn().items()]
+        except Exception as e:
+            logger.error(f"Metric {self.name} fejl: {e}")
+            return []
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                # Ikke-kumulative bucket-tællere + [sum, count] til sidst
+                v = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+
+class Registry:
+    """Metrics for denne proces + sammenlægning af alle processers snapshots."""
+
+    def __init__(self, path: Path, flush_interval: float = 10, retention: float = 24 * 3600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.metrics = {}
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    @property
+    def owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _add(self, metric: _Metric) -> _Metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, labels: tuple, fn, per_process: bool = True) -> Gauge:
+        """Gauge hvis værdier hentes fra fn() ved hvert snapshot (summeres over levende processer)."""
+        metric = Gauge(name, help_text, labels, fn, per_process)
+        self.metrics[name] = metric  # Må gerne erstattes (fx når app.py genindlæses)
+        return metric
+
+    # --- Flush / sammenlægning --------------------------------------------------
+
+    def _snapshot(self) -> dict:
+        return {name: m.snapshot() for name, m in list(self.metrics.items())
+                if not isinstance(m, Gauge) or m.per_process}
+
+    def flush(self):
+        """Skriv denne proces' snapshot til .state.db."""
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO metrics_snapshot (owner, updated, data) VALUES (?, ?, ?)",
+                (self.owner, time.time(), json.dumps(self._snapshot())))
+        except sqlite3.Error as e:
+            logger.error(f"Metrics flush fejl: {e}")
+
+    def ensure_started(self):
+        """Start flush-tråden i denne proces (fork-sikkert)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Ny proces efter fork: de arvede tal er allerede talt med i forælderens snapshot
+                for metric in self.metrics.values():
+                    if not isinstance(metric, Gauge):
+                        with metric._lock:
+                            metric._values.clear()
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def collect(self) -> dict:
+        """Sum af alle processers snapshots: {navn: {label-tuple: værdi}}."""
+        self.flush()
+        now = time.time()
+        conn = self._conn()
+        conn.execute("DELETE FROM metrics_snapshot WHERE updated < ?", (now - self.retention,))
+        live_after = now - 3 * self.flush_interval
+        merged = {}
+        for updated, data in conn.execute("SELECT updated, data FROM metrics_snapshot"):
+            try:
+                snap = json.loads(data)
+            except ValueError:
+                continue
+            for name, entries in snap.items():
+                metric = self.metrics.get(name)
+                if metric is None or (isinstance(metric, Gauge) and updated < live_after):
+                    continue
+                out = merged.setdefault(name, {})
+                for labels, value in entries:
+                    key = tuple(labels)
+                    if isinstance(value, list):
+                        prev = out.get(key)
+                        out[key] = [a + b for a, b in zip(prev, value)] if prev and len(prev) == len(value) else value
+                    else:
+                        out[key] = out.get(key, 0) + value
+        for name, metric in self.metrics.items():
+            if isinstance(metric, Gauge) and not metric.per_process:
+                merged[name] = {tuple(k): v for k, v in metric.snapshot()}
+        return merged
+
+    def render(self) -> str:
+        """Prometheus tekstformat (version 0.0.4)."""
+        merged = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            values = merged.get(name, {})
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(values.items()):
+                labels = list(zip(metric.labels, key))
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, n in zip(metric.buckets + (float("inf"),), value):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        lines.append(f"{name}_bucket{_fmt_labels(labels + [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{_fmt_labels(labels)} {_fmt_value(value[-2])}")
+                    lines.append(f"{name}_count{_fmt_labels(labels)} {value[-1]}")
+                else:
+                    lines.append(f"{name}{_fmt_labels(labels)} {_fmt_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _fmt_labels(labels: list) -> str:
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+
+def _fmt_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# --- Delt registry og app-metrics ---------------------------------------------
+
+registry = Registry(Path(__file__).parent / ".state.db", flush_interval=METRICS_FLUSH_SECONDS,
+                    retention=METRICS_RETENTION_HOURS * 3600)
+
+STAGE_SECONDS = registry.histogram(
+    "ftd_stage_duration_seconds",
+    "Varighed af hot-path trin (postback_parse, voluum_forward, telegram_send, voluum_auth, report_fetch, zero_revenue_eval)",
+    ("stage",))
+UPSTREAM_RESPONSES = registry.counter(
+    "ftd_upstream_responses_total", "HTTP-svar per upstream og statuskode (code=error ved netværksfejl)",
+    ("upstream", "code"))
+POSTBACKS = registry.counter(
+    "ftd_postbacks_total", "Postbacks per udfald (ok, queued, retrying, duplicate, skipped, error)",
+    ("status", "reason"))
+
+
+def observe_stage(stage: str, seconds: float):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("voluum_forward"): ... – måler varigheden (også ved exception)."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name)
+
+
+def upstream(name: str, code):
+    if METRICS_ENABLED:
+        UPSTREAM_RESPONSES.inc(upstream=name, code=code)
+
+
+def postback_outcome(status: str, reason: str = ""):
+    if METRICS_ENABLED:
+        POSTBACKS.inc(status=status, reason=reason)
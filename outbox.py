@@ -0,0 +1,256 @@
+"""
+Persistent outbox for notifikationer
+====================================
+Alle Telegram-beskeder skrives først til en SQLite-tabel (WAL mode) og leveres derefter.
+Fejler afsendelsen, prøves igen med eksponentiel backoff – også efter genstart.
+
+- append() er durable når den returnerer. Skrivninger samles i én transaktion
+  (group commit), så bursts af postbacks ikke betaler én fsync hver.
+- Rækker "claimes" med en lease, så flere gunicorn workers kan dele outboxen uden
+  at sende samme besked to gange. Dør en worker midt i en afsendelse, udløber
+  leasen og beskeden prøves igen.
+- stuck() bruges af /admin/outbox til at se beskeder der ikke er kommet igennem.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_SENDING = "sending"
+STATUS_DONE = "done"
+STATUS_DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+"""
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    """Åbn SQLite i WAL mode med busy timeout (deles af flere processer)."""
+    conn = sqlite3.connect(str(path), timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+
+class _PendingWrite:
+    __slots__ = ("sql", "params", "rowid", "done")
+
+    def __init__(self, sql: str, params: tuple, wait: bool):
+        self.sql = sql
+        self.params = params
+        self.rowid = None
+        self.done = threading.Event() if wait else None
+
+
+class Outbox:
+    """Durable kø af Telegram-beskeder med retry og group commit."""
+
+    def __init__(self, path: Path, send_fn, max_attempts: int = 20, base_backoff: float = 5,
+                 max_backoff: float = 900, lease_seconds: float = 600, batch_size: int = 50,
+                 flush_interval: float = 0.005):
+        self.path = path
+        # send_fn(chat_id, text, priority) -> TelegramJob (ikke-blokerende)
+        self.send_fn = send_fn
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._writes = []
+        self._writes_cond = threading.Condition()
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._local = threading.local()
+        self._in_flight = set()
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def ensure_started(self):
+        """Start writer- og leveringstråd i denne proces (fork-sikkert)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._writes = []
+            self._in_flight = set()
+            threading.Thread(target=self._writer_loop, name="outbox-writer", daemon=True).start()
+            threading.Thread(target=self._delivery_loop, name="outbox-delivery", daemon=True).start()
+
+    # --- Group commit -------------------------------------------------------
+
+    def _write(self, sql: str, params: tuple, wait: bool) -> _PendingWrite:
+        self.ensure_started()
+        item = _PendingWrite(sql, params, wait)
+        with self._writes_cond:
+            self._writes.append(item)
+            self._writes_cond.notify()
+        if wait:
+            item.done.wait()
+        return item
+
+    def _writer_loop(self):
+        conn = connect(self.path)
+        while True:
+            with self._writes_cond:
+                while not self._writes:
+                    self._writes_cond.wait()
+            # Giv samtidige skrivere et øjeblik til at komme med i samme transaktion
+            time.sleep(self.flush_interval)
+            with self._writes_cond:
+                batch, self._writes = self._writes, []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for item in batch:
+                    item.rowid = conn.execute(item.sql, item.params).lastrowid
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                logger.error(f"Outbox skrivefejl: {e}")
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+            for item in batch:
+                if item.done is not None:
+                    item.done.set()
+            self._wake.set()
+
+    # --- API ----------------------------------------------------------------
+
+    def append(self, chat_id, text: str, priority: int = 0, claim: bool = False) -> int:
+        """Gem besked durable og returnér id.
+
+        claim=True: kalderen sender selv med det samme – rækken er leaset, så
+        leveringstråden kun tager den hvis kalderen ikke når at markere den.
+        """
+        now = time.time()
+        status = STATUS_SENDING if claim else STATUS_PENDING
+        lease = now + self.lease_seconds if claim else 0
+        item = self._write(
+            "INSERT INTO outbox (chat_id, text, priority, status, created_at, next_attempt_at, lease_until) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(chat_id), text, priority, status, now, now, lease), wait=True)
+        return item.rowid
+
+    def mark_done(self, msg_id: int):
+        self._write("UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                    (STATUS_DONE, msg_id), wait=False)
+
+    def mark_failed(self, msg_id: int, error: str, attempts: int):
+        """Planlæg nyt forsøg med eksponentiel backoff – eller giv op efter max_attempts."""
+        attempts += 1
+        if attempts >= self.max_attempts:
+            self._write("UPDATE outbox SET status = ?, attempts = ?, last_error = ? WHERE id = ?",
+                        (STATUS_DEAD, attempts, error, msg_id), wait=False)
+            logger.error(f"Outbox besked {msg_id} opgivet efter {attempts} forsøg: {error}")
+            return
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+        self._write("UPDATE outbox SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?, lease_until = 0 "
+                    "WHERE id = ?", (STATUS_PENDING, attempts, error, time.time() + delay, msg_id), wait=False)
+
+    # --- Levering -----------------------------------------------------------
+
+    def _claim_due(self, limit: int) -> list:
+        """Claim forfaldne beskeder (inkl. udløbne leases fra døde workers)."""
+        conn = self._conn()
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, chat_id, text, priority, attempts FROM outbox "
+                "WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_until < ?) "
+                "ORDER BY priority, id LIMIT ?",
+                (STATUS_PENDING, now, STATUS_SENDING, now, limit)).fetchall()
+            if rows:
+                conn.executemany("UPDATE outbox SET status = ?, lease_until = ? WHERE id = ?",
+                                 [(STATUS_SENDING, now + self.lease_seconds, r[0]) for r in rows])
+            conn.execute("COMMIT")
+            return rows
+        except sqlite3.Error as e:
+            logger.error(f"Outbox claim fejl: {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            return []
+
+    def track(self, msg_id: int, attempts: int, job):
+        """Markér rækken done/failed når scheduler-jobbet er færdigt."""
+        def _on_done(j):
+            with self._start_lock:
+                self._in_flight.discard(msg_id)
+            if j.ok:
+                self.mark_done(msg_id)
+            else:
+                self.mark_failed(msg_id, j.description or str(j.status_code), attempts)
+        with self._start_lock:
+            self._in_flight.add(msg_id)
+        job.add_done_callback(_on_done)
+
+    def _delivery_loop(self):
+        last_purge = 0.0
+        while True:
+            if time.time() - last_purge > 3600:
+                self.purge_done()
+                last_purge = time.time()
+            # Claim kun så meget som scheduleren kan nå før leasen udløber
+            free = self.batch_size - len(self._in_flight)
+            rows = self._claim_due(free) if free > 0 else []
+            if not rows:
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+            for msg_id, chat_id, text, priority, attempts in rows:
+                self.track(msg_id, attempts, self.send_fn(chat_id, text, priority))
+
+    def stuck(self, older_than: float = 300, limit: int = 100) -> list:
+        """Beskeder der ikke er leveret: fejlede forsøg, opgivne eller ældre end `older_than` sekunder."""
+        now = time.time()
+        rows = self._conn().execute(
+            "SELECT id, chat_id, text, priority, status, attempts, created_at, next_attempt_at, last_error "
+            "FROM outbox WHERE status = ? OR (status IN (?, ?) AND (attempts > 0 OR created_at < ?)) "
+            "ORDER BY created_at LIMIT ?",
+            (STATUS_DEAD, STATUS_PENDING, STATUS_SENDING, now - older_than, limit)).fetchall()
+        keys = ("id", "chat_id", "text", "priority", "status", "attempts", "created_at", "next_attempt_at", "last_error")
+        return [dict(zip(keys, r)) for r in rows]
+
+    def counts(self) -> dict:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+    def purge_done(self, older_than: float = 7 * 86400):
+        """Ryd leverede beskeder ældre end `older_than` sekunder."""
+        self._write("DELETE FROM outbox WHERE status = ? AND created_at < ?",
+                    (STATUS_DONE, time.time() - older_than), wait=False)
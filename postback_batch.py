@@ -0,0 +1,99 @@
+"""
+Batch-postbacks
+===============
+Zapier sender flere konverteringer i én request, når den batcher. Tidligere blev kun første element
+i en JSON-liste brugt – resten gik tabt. Her parses batchen i ét gennemløb:
+
+- JSON-liste:           [{...}, {...}]
+- Multi-conversion:     {"conversions": [{...}, ...]}  (eller "data": [...])
+- NDJSON:               én JSON-konvertering per linje (Content-Type application/x-ndjson)
+
+Ugyldige NDJSON-linjer bliver til None, så svaret kan melde fejl for netop det element.
+Selve håndteringen (dedup, forward, Telegram) ligger i app.process_postback_batch.
+"""
+
+import json
+import os
+
+POSTBACK_BATCH_MAX = int(os.getenv("POSTBACK_BATCH_MAX", "10000"))
+TELEGRAM_MAX_MESSAGE = 4096
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines")
+_LIST_KEYS = ("conversions", "data")
+
+
+def is_ndjson(content_type: str) -> bool:
+    return (content_type or "").split(";")[0].strip().lower() in NDJSON_TYPES
+
+
+def expand(payload):
+    """Elementerne hvis payload er en batch (liste med flere, eller {"conversions": [...]}), ellers None."""
+    if isinstance(payload, list):
+        return payload if len(payload) > 1 else None
+    if isinstance(payload, dict):
+        for key in _LIST_KEYS:
+            if isinstance(payload.get(key), list):
+                return payload[key]
+    return None
+
+
+def parse_batch(body: bytes, content_type: str = "") -> list:
+    """Alle konverteringer i body (JSON-liste, multi-conversion objekt eller NDJSON).
+
+    ValueError hvis body hverken er JSON eller NDJSON, eller har flere end POSTBACK_BATCH_MAX elementer.
+    """
+    text = (body or b"").decode("utf-8-sig", "replace").strip()
+    if not text:
+        return []
+    items = None
+    if not is_ndjson(content_type):
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            if text[0] != "{":
+                raise ValueError("Body er hverken JSON eller NDJSON")
+        else:
+            items = expand(payload)
+            if items is None:
+                items = payload if isinstance(payload, list) else [payload]
+    if items is None:
+        items = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    if len(items) > POSTBACK_BATCH_MAX:
+        raise ValueError(f"Batch med {len(items)} elementer - højst {POSTBACK_BATCH_MAX} (POSTBACK_BATCH_MAX)")
+    return items
+
+
+def unwrap(raw) -> dict:
+    """Flad dict med str-keys for ét element: nested {"conversion": {...}}, {"data": {...}} eller flad obj."""
+    if isinstance(raw, dict):
+        raw = raw.get("conversion") or raw.get("data") or raw
+    if not isinstance(raw, dict):
+        return {}
+    return {str(k): v for k, v in raw.items()}
+
+
+def coalesce(lines: list, limit: int = TELEGRAM_MAX_MESSAGE) -> list:
+    """Saml linjer til så få beskeder som muligt under Telegrams grænse.
+
+    Returnerer [(tekst, [index i lines, ...]), ...], så hver besked kan føres tilbage til sine elementer.
+    """
+    chunks = []
+    text, indexes = "", []
+    for i, line in enumerate(lines):
+        line = line[:limit]
+        if indexes and len(text) + 1 + len(line) > limit:
+            chunks.append((text, indexes))
+            text, indexes = "", []
+        text = f"{text}\n{line}" if indexes else line
+        indexes.append(i)
+    if indexes:
+        chunks.append((text, indexes))
+    return chunks
@@ -0,0 +1,158 @@
+"""
+Postback-feltudtræk i ét gennemløb
+==================================
+Finder offer, land, revenue, konverteringstype, click ID og transaction ID i en
+postback med én skanning af nøglerne.
+
+- Alias-tabellen (SCHEMA) kompileres ved import til ét opslag: lowercase nøgle -> (felt, prioritet).
+- For hver kilde (Voluum GET, Zapier JSON, form POST) caches en "plan" per nøgle-sæt:
+  hvilke nøgler der er kandidater til hvert felt, i prioriteret rækkefølge. Næste postback
+  med samme form springer skanningen over og læser kun de nøgler planen peger på.
+- Revenue er første kandidat der parser til et positivt tal (Revenue foretrækkes frem for Payout).
+"""
+
+import threading
+from collections import OrderedDict
+
+# Felt -> aliaser i prioriteret rækkefølge (matches case-insensitivt)
+SCHEMA = {
+    "offer": ("offer", "offername", "offer name", "offer_id", "lander", "lander name", "campaign name"),
+    "country": ("country", "countrycode", "geo", "cc"),
+    "revenue": ("revenue", "revenue (usd)", "revenue(usd)", "allconversionsrevenue", "conversionrevenue",
+                "totalrevenue", "payout", "amount"),
+    "conv_type": ("conversiontype", "conversion_type", "conversion type", "et", "type"),
+    "click_id": ("cid", "clickid", "click_id", "click id", "subid", "externalid", "external_id"),
+    "txid": ("txid", "transaction_id", "transactionid", "transaction id", "tid"),
+}
+# Nøgler der indeholder disse ord er revenue-kandidater efter de faste aliaser (fx "All Conversions Revenue")
+_REVENUE_SUBSTRINGS = ("revenue", "payout")
+_FALLBACK_PRIORITY = 1000
+
+FIELDS = tuple(SCHEMA)
+_ALIASES = {alias: (field, prio) for field, aliases in SCHEMA.items() for prio, alias in enumerate(aliases)}
+
+
+def parse_amount(val) -> float:
+    """"$150", "142,50", 99 -> float. Ugyldigt/tomt -> 0."""
+    if val is None or val == "":
+        return 0.0
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        return float(val)
+    try:
+        s = str(val).replace("$", "").replace(",", ".").strip()
+        return float(s) if s else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def is_ftd_type(conv_type) -> bool:
+    """Kun tydelige lead/reg/click springes over – DEPOSIT/FTD/SALE/CUSTOM og ukendte typer tæller."""
+    conv_type = str(conv_type or "").upper()
+    if conv_type and any(x in conv_type for x in ("LEAD", "REG", "REGISTRATION", "CLICK")):
+        return any(x in conv_type for x in ("FTD", "CUSTOM", "SALE", "DEPOSIT"))
+    return True
+
+
+class PostbackFields:
+    """Resultat af udtræk. revenue er parset; revenue_raw er den oprindelige værdi."""
+
+    __slots__ = ("offer", "country", "revenue", "revenue_raw", "conv_type", "click_id", "txid")
+
+    def __init__(self, offer=None, country=None, revenue=0.0, revenue_raw=None, conv_type=None,
+                 click_id=None, txid=None):
+        self.offer = offer
+        self.country = country
+        self.revenue = revenue
+        self.revenue_raw = revenue_raw
+        self.conv_type = conv_type
+        self.click_id = click_id
+        self.txid = txid
+
+
+def _build_plan(keys) -> dict:
+    """Skan nøglerne én gang: felt -> tuple af kandidat-nøgler i prioriteret rækkefølge."""
+    candidates = {field: [] for field in FIELDS}
+    for pos, key in enumerate(keys):
+        lk = str(key).strip().lower()
+        hit = _ALIASES.get(lk)
+        if hit is not None:
+            candidates[hit[0]].append((hit[1], pos, key))
+        elif any(sub in lk for sub in _REVENUE_SUBSTRINGS):
+            candidates["revenue"].append((_FALLBACK_PRIORITY, pos, key))
+    return {field: tuple(k for _, _, k in sorted(c)) for field, c in candidates.items() if c}
+
+
+class PostbackExtractor:
+    """Udtræk med plan-cache per kilde. Thread-safe."""
+
+    def __init__(self, max_plans: int = 256):
+        self.max_plans = max_plans
+        self._plans = {}  # kilde -> OrderedDict(nøgle-tuple -> plan)
+        self._lock = threading.Lock()
+        self.plan_hits = 0
+        self.plan_misses = 0
+
+    def _plan(self, data: dict, source: str) -> dict:
+        shape = tuple(data)
+        with self._lock:
+            plans = self._plans.setdefault(source, OrderedDict())
+            plan = plans.get(shape)
+            if plan is not None:
+                plans.move_to_end(shape)
+                self.plan_hits += 1
+                return plan
+        plan = _build_plan(shape)
+        with self._lock:
+            plans[shape] = plan
+            self.plan_misses += 1
+            while len(plans) > self.max_plans:
+                plans.popitem(last=False)
+        return plan
+
+    def extract(self, data: dict, source: str = "default") -> PostbackFields:
+        plan = self._plan(data, source)
+        out = PostbackFields()
+        for field, keys in plan.items():
+            if field == "revenue":
+                for k in keys:
+                    v = data[k]
+                    n = parse_amount(v)
+                    if n > 0:
+                        out.revenue = n
+                        out.revenue_raw = v
+                        break
+                continue
+            for k in keys:
+                v = data[k]
+                if v:
+                    setattr(out, field, v)
+                    break
+        return out
+
+    def aliases_in_use(self) -> dict:
+        """Hvilke nøgler hver kilde faktisk bruger per felt (fra de cachede planer)."""
+        with self._lock:
+            out = {}
+            for source, plans in self._plans.items():
+                used = {}
+                for plan in plans.values():
+                    for field, keys in plan.items():
+                        used.setdefault(field, set()).update(keys)
+                out[source] = {field: sorted(map(str, keys)) for field, keys in used.items()}
+            return out
+
+    def stats(self) -> dict:
+        return {
+            "plan_hits": self.plan_hits,
+            "plan_misses": self.plan_misses,
+            "plans": {source: len(plans) for source, plans in self._plans.items()},
+            "aliases_in_use": self.aliases_in_use(),
+        }
+
+
+extractor = PostbackExtractor()
+
+
+def extract_fields(data: dict, source: str = "default") -> PostbackFields:
+    """Udtræk felter med den delte extractor."""
+    return extractor.extract(data, source)
@@ -0,0 +1,221 @@
+"""
+Optagelse af postbacks
+======================
+Slå til med POSTBACK_RECORD_ENABLED=true. Hver indkommende /postback (method, query args, body,
+udvalgte headers, ankomsttid) skrives som én JSON-linje til gzip-segmenter i POSTBACK_RECORD_DIR:
+
+    postbacks-20260117T101500-<host>-<pid>-<nr>.jsonl.gz
+
+- Hot path lægger kun en dict i en begrænset kø; en baggrundstråd per proces serialiserer og
+  komprimerer. Er køen fuld, droppes optagelsen (postbacken behandles som normalt).
+- Hver proces skriver sine egne segmenter, så gunicorn workers ikke skriver i samme fil.
+- Et segment lukkes efter POSTBACK_RECORD_SEGMENT_MB (ukomprimeret) eller
+  POSTBACK_RECORD_SEGMENT_MINUTES; det åbne segment hedder *.jsonl.gz.part indtil det lukkes.
+- Højst POSTBACK_RECORD_MAX_SEGMENTS lukkede segmenter beholdes (ældste slettes).
+- Bodies over POSTBACK_RECORD_MAX_BODY bytes afkortes og markeres med "truncated" (den oprindelige
+  længde) – afspilningen springer dem over, da en afkortet batch ikke kan parses.
+
+Afspil med bench/replay_postbacks.py.
+"""
+
+import gzip
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+POSTBACK_RECORD_ENABLED = os.getenv("POSTBACK_RECORD_ENABLED", "false").lower() == "true"
+POSTBACK_RECORD_DIR = Path(os.getenv("POSTBACK_RECORD_DIR", "") or Path(__file__).parent / "recordings")
+POSTBACK_RECORD_SEGMENT_MB = float(os.getenv("POSTBACK_RECORD_SEGMENT_MB", "16"))
+POSTBACK_RECORD_SEGMENT_MINUTES = float(os.getenv("POSTBACK_RECORD_SEGMENT_MINUTES", "60"))
+POSTBACK_RECORD_MAX_SEGMENTS = int(os.getenv("POSTBACK_RECORD_MAX_SEGMENTS", "48"))
+POSTBACK_RECORD_MAX_BODY = int(os.getenv("POSTBACK_RECORD_MAX_BODY", "65536"))
+# Kun disse headers gemmes (ingen cookies/auth)
+POSTBACK_RECORD_HEADERS = tuple(h.strip().lower() for h in os.getenv(
+    "POSTBACK_RECORD_HEADERS", "content-type,user-agent").split(",") if h.strip())
+
+SEGMENT_GLOB = "postbacks-*.jsonl.gz"
+
+
+class PostbackRecorder:
+    """Skriver optagede postbacks til roterende gzip JSONL-segmenter fra en baggrundstråd."""
+
+    def __init__(self, directory: Path, segment_bytes: int = 16 * 1024 * 1024, segment_seconds: float = 3600,
+                 max_segments: int = 48, max_body: int = 65536, headers: tuple = ("content-type", "user-agent"),
+                 queue_size: int = 10000):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.max_body = max_body
+        self.headers = headers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._path = None
+        self._opened = 0.0
+        self._written = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.truncated = 0
+        self.segments = 0
+
+    def ensure_started(self):
+        """Start skrive-tråden i denne proces (fork-sikkert)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forælderens kø og åbne fil hører til forælderen
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._file = None
+            self._pid = os.getpid()
+            self.directory.mkdir(parents=True, exist_ok=True)
+            threading.Thread(target=self._run, name="postback-recorder", daemon=True).start()
+
+    def record(self, method: str, args: list, body: bytes, headers, arrived: float = None):
+        """Læg én postback i køen. headers: mapping med (vilkårlig case) header-navne."""
+        size = len(body) if body else 0
+        if size > self.max_body:
+            body = body[:self.max_body]
+            self.truncated += 1
+        entry = {
+            "t": arrived or time.time(),
+            "method": method,
+            "args": [[k, v] for k, v in args],
+            "body": body.decode("utf-8", "replace") if body else "",
+            "headers": {k.lower(): v for k, v in headers.items() if k.lower() in self.headers},
+        }
+        if size > self.max_body:
+            entry["truncated"] = size
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    # --- Skrivning (baggrundstråd) --------------------------------------------
+
+    def _run(self):
+        while True:
+            try:
+                entry = self._queue.get(timeout=min(5.0, self.segment_seconds))
+            except queue.Empty:
+                entry = None
+            try:
+                if entry is not None:
+                    batch = [entry]
+                    while len(batch) < 500:
+                        try:
+                            batch.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    self._write(batch)
+                elif self._file is not None and time.time() - self._opened >= self.segment_seconds:
+                    self._close()
+            except OSError as e:
+                logger.error(f"Postback-optagelse fejl: {e}")
+                self._file = None
+
+    def _write(self, batch: list):
+        if self._file is not None and (self._written >= self.segment_bytes
+                                       or time.time() - self._opened >= self.segment_seconds):
+            self._close()
+        if self._file is None:
+            self._open()
+        data = "".join(json.dumps(e, separators=(",", ":"), ensure_ascii=False) + "\n" for e in batch).encode("utf-8")
+        self._file.write(data)
+        self._file.flush()  # Z_SYNC_FLUSH: .part kan læses mens den skrives
+        self._written += len(data)
+        self.recorded += len(batch)
+
+    def _open(self):
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        name = f"postbacks-{stamp}-{socket.gethostname()}-{os.getpid()}-{self.segments:04d}.jsonl.gz.part"
+        self._path = self.directory / name
+        self._file = gzip.open(self._path, "ab")
+        self._opened = time.time()
+        self._written = 0
+
+    def _close(self):
+        self._file.close()
+        self._file = None
+        self._path.rename(self._path.with_suffix(""))  # .jsonl.gz.part -> .jsonl.gz
+        self.segments += 1
+        self._prune()
+
+    def _prune(self):
+        segments = sorted(self.directory.glob(SEGMENT_GLOB))
+        for path in segments[:max(0, len(segments) - self.max_segments)]:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "dir": str(self.directory),
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "queued": self._queue.qsize(),
+            "segments_closed": self.segments,
+            "current_segment": self._path.name if self._file is not None else None,
+        }
+
+
+def read_segments(paths) -> list:
+    """Alle optagede postbacks fra filer/mapper (også *.part), sorteret efter ankomsttid."""
+    files = []
+    for p in map(Path, paths):
+        if p.is_dir():
+            files.extend(sorted(p.glob(SEGMENT_GLOB)) + sorted(p.glob(SEGMENT_GLOB + ".part")))
+        else:
+            files.append(p)
+    entries = []
+    for path in files:
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue  # Afkortet sidste linje i et segment der stadig skrives
+        except (EOFError, OSError) as e:
+            # Segment der stadig skrives (eller blev afbrudt) – brug det der kunne læses
+            if path.suffix != ".part":
+                logger.warning(f"{path.name}: {e}")
+    entries.sort(key=lambda e: e.get("t", 0))
+    return entries
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    """Delt recorder hvis POSTBACK_RECORD_ENABLED=true, ellers None."""
+    global _recorder
+    if not POSTBACK_RECORD_ENABLED:
+        return None
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = PostbackRecorder(
+                    POSTBACK_RECORD_DIR,
+                    segment_bytes=int(POSTBACK_RECORD_SEGMENT_MB * 1024 * 1024),
+                    segment_seconds=POSTBACK_RECORD_SEGMENT_MINUTES * 60,
+                    max_segments=POSTBACK_RECORD_MAX_SEGMENTS,
+                    max_body=POSTBACK_RECORD_MAX_BODY,
+                    headers=POSTBACK_RECORD_HEADERS,
+                )
+    return _recorder
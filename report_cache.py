@@ -0,0 +1,432 @@
+"""
+Caches af Voluum reports
+========================
+ReportTTLCache: samme report (groupBy, from, to, filtre) hentes højst én gang per TTL.
+
+- Samtidige kald i processen venter på ét igangværende fetch (single-flight).
+- På tværs af gunicorn workers og scripts deles resultatet via .state.db (tabel report_ttl);
+  en lease sikrer at kun én proces henter, mens de andre venter på resultatet.
+- LRU-eviction med loft over antal entries og samlet størrelse (bytes JSON).
+- fetch_rows() giver rækkerne som report_rows.ReportRow, bygget én gang per cachet report og delt
+  af alle hits inden for TTL (/fetch-ftds, /poll-new-ftds, voluum_poll.py, send_latest.py).
+
+HourBucketCache: polling (/poll-new-ftds, voluum_poll.py) spørger om det samme rullende
+vindue hvert minut, men afsluttede timer ændrer sig ikke. Reporten hentes derfor time for time:
+
+- Afsluttede timer gemmes i .state.db (tabel report_bucket) og genbruges af alle workers.
+- Hver tick henter kun de seneste `settle_hours` timer igen (sene konverteringer).
+- Vinduet er det samme som en direkte hentning (voluum_reports.hour_window): de sidste
+  `hours_back` hele timer, uden den åbne time.
+- Rækkerne flettes per kampagne/offer: additive tal (konverteringer, revenue, clicks …)
+  summeres, øvrige felter tages fra den nyeste time.
+- Buckets ældre end `max_age_hours` slettes.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from outbox import connect
+from report_rows import report_rows
+from voluum_reports import TIME_FORMAT, get_report_fetcher
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_bucket (
+    group_by TEXT NOT NULL,
+    hour TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    rows TEXT NOT NULL,
+    PRIMARY KEY (group_by, hour)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS report_ttl (
+    key TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL,
+    rows TEXT,
+    lease_until REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+
+# Metrics der kan lægges sammen på tværs af timer (ratios som cr/epc/roi kan ikke)
+ADDITIVE = {
+    "visits", "uniqueVisits", "clicks", "uniqueClicks", "impressions", "conversions", "allConversions",
+    "revenue", "allConversionsRevenue", "cost", "profit", "suspiciousVisits", "suspiciousClicks",
+}
+_ADDITIVE_PREFIXES = ("customConversions", "customRevenue")
+
+
+def _is_additive(field: str) -> bool:
+    return field in ADDITIVE or field.startswith(_ADDITIVE_PREFIXES)
+
+
+def _num(val):
+    if isinstance(val, (int, float)):
+        return val
+    try:
+        return float(val or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def merge_buckets(buckets: list, key_field: str) -> list:
+    """Flet time-buckets (ældste først) til én række per `key_field`."""
+    merged = {}
+    for rows in buckets:
+        for row in rows:
+            key = row.get(key_field)
+            if key is None:
+                continue
+            acc = merged.get(key)
+            if acc is None:
+                merged[key] = dict(row)
+                continue
+            for field, val in row.items():
+                if _is_additive(field):
+                    acc[field] = _num(acc.get(field)) + _num(val)
+                elif field == "updated":
+                    acc[field] = max(acc.get(field) or "", val or "")
+                elif val not in (None, ""):
+                    acc[field] = val
+    return list(merged.values())
+
+
+class _Flight:
+    """Et igangværende fetch som andre tråde kan vente på."""
+
+    __slots__ = ("done", "rows", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.rows = None
+        self.error = None
+
+
+class ReportTTLCache:
+    """Kortlivet, delt cache af hele reports med single-flight."""
+
+    def __init__(self, path: Path, fetcher=None, ttl: float = 30, max_entries: int = 64,
+                 max_bytes: int = 32 * 1024 * 1024, lease_seconds: float = 60, poll_interval: float = 0.2):
+        self.path = path
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._entries = OrderedDict()  # key -> (expires_at, rows, size)
+        self._models = {}  # key -> (rows, [ReportRow]) – bygges først ved fetch_rows()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.shared_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(group_by: str, from_t: str, to_t: str, filters: dict) -> str:
+        return json.dumps([group_by, from_t, to_t, sorted(filters.items())], separators=(",", ":"), default=str)
+
+    def _remember(self, key: str, expires_at: float, rows: list, size: int):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._models.pop(key, None)
+            self._entries[key] = (expires_at, rows, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                dropped_key, (_, _, dropped) = self._entries.popitem(last=False)
+                self._models.pop(dropped_key, None)
+                self._bytes -= dropped
+                self.evictions += 1
+
+    def _shared(self, key: str):
+        """(rows, expires_at) fra .state.db hvis en anden proces har hentet reporten inden for TTL."""
+        try:
+            row = self._conn().execute("SELECT rows, expires_at FROM report_ttl WHERE key = ? AND expires_at > ? "
+                                       "AND rows IS NOT NULL", (key, time.time())).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Report cache læsefejl: {e}")
+            return None
+        return (row[0], row[1]) if row else None
+
+    def _acquire_lease(self, key: str) -> bool:
+        now = time.time()
+        try:
+            cur = self._conn().execute(
+                "INSERT INTO report_ttl (key, expires_at, rows, lease_until) VALUES (?, 0, NULL, ?) "
+                "ON CONFLICT(key) DO UPDATE SET lease_until = excluded.lease_until "
+                "WHERE report_ttl.lease_until < ? AND report_ttl.expires_at <= ?",
+                (key, now + self.lease_seconds, now, now))
+            return cur.rowcount == 1
+        except sqlite3.Error as e:
+            logger.error(f"Report cache lease fejl: {e}")
+            return True
+
+    def _load_shared(self, key: str):
+        """Hent fra .state.db – eller vent på en anden proces der har leasen. None = hent selv."""
+        deadline = time.monotonic() + self.lease_seconds
+        while True:
+            shared = self._shared(key)
+            if shared is not None:
+                return shared
+            if self._acquire_lease(key) or time.monotonic() > deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def _fetch_and_store(self, key: str, group_by: str, from_t: str, to_t: str, filters: dict) -> list:
+        fetcher = self.fetcher or get_report_fetcher()
+        try:
+            rows = fetcher.fetch(group_by, from_t, to_t, **filters)
+        except BaseException:
+            try:
+                self._conn().execute("UPDATE report_ttl SET lease_until = 0 WHERE key = ?", (key,))
+            except sqlite3.Error:
+                pass
+            raise
+        data = json.dumps(rows, separators=(",", ":"))
+        expires_at = time.time() + self.ttl
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO report_ttl (key, expires_at, rows, lease_until) VALUES (?, ?, ?, 0)",
+                         (key, expires_at, data))
+            conn.execute("DELETE FROM report_ttl WHERE expires_at <= ? AND lease_until < ?",
+                         (time.time(), time.time()))
+        except sqlite3.Error as e:
+            logger.error(f"Report cache skrivefejl: {e}")
+        self._remember(key, expires_at, rows, len(data))
+        return rows
+
+    def fetch(self, group_by: str, from_t: str, to_t: str, **filters) -> list:
+        """Som ReportFetcher.fetch, men delt inden for TTL. Rejser requests.RequestException ved fejl."""
+        if self.ttl <= 0:
+            return (self.fetcher or get_report_fetcher()).fetch(group_by, from_t, to_t, **filters)
+        return list(self._cached(self.make_key(group_by, from_t, to_t, filters), group_by, from_t, to_t, filters))
+
+    def fetch_rows(self, group_by: str, from_t: str, to_t: str, **filters) -> list:
+        """Som fetch(), men som [ReportRow]. Bygges én gang per cachet report og deles af alle hits."""
+        if self.ttl <= 0:
+            return report_rows((self.fetcher or get_report_fetcher()).fetch(group_by, from_t, to_t, **filters))
+        key = self.make_key(group_by, from_t, to_t, filters)
+        rows = self._cached(key, group_by, from_t, to_t, filters)
+        with self._lock:
+            built = self._models.get(key)
+            if built is not None and built[0] is rows:
+                return list(built[1])
+        models = report_rows(rows)
+        with self._lock:
+            # Kun hvis entry'en stadig er den vi byggede af (ikke fornyet/evicted imens)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is rows:
+                self._models[key] = (rows, models)
+        return list(models)
+
+    def _cached(self, key: str, group_by: str, from_t: str, to_t: str, filters: dict) -> list:
+        """Den cachede rækkeliste (delt – kalderen kopierer)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not owner:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.rows
+
+        try:
+            shared = self._load_shared(key)
+            if shared is not None:
+                data, expires_at = shared
+                flight.rows = json.loads(data)
+                self._remember(key, expires_at, flight.rows, len(data))
+                self.shared_hits += 1
+            else:
+                flight.rows = self._fetch_and_store(key, group_by, from_t, to_t, filters)
+                self.misses += 1
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+        return flight.rows
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.shared_hits + self.coalesced + self.misses
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((lookups - self.misses) / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "ttl_seconds": self.ttl,
+        }
+
+
+class HourBucketCache:
+    """Rullende report-vindue bygget af cachede time-buckets."""
+
+    def __init__(self, path: Path, fetcher=None, max_age_hours: float = 48, settle_hours: int = 1):
+        self.path = path
+        self.fetcher = fetcher
+        self.max_age_hours = max_age_hours
+        self.settle_hours = settle_hours
+        self._local = threading.local()
+        self.bucket_hits = 0
+        self.bucket_fetches = 0
+        self.last_tick_fetches = 0
+        self.last_tick_seconds = 0.0
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _load(self, group_by: str, hours: list) -> dict:
+        rows = self._conn().execute(
+            f"SELECT hour, rows FROM report_bucket WHERE group_by = ? AND hour IN ({', '.join('?' * len(hours))})",
+            (group_by, *hours)).fetchall()
+        out = {}
+        for hour, data in rows:
+            try:
+                out[hour] = json.loads(data)
+            except ValueError:
+                pass
+        return out
+
+    def _store(self, group_by: str, hour: str, rows: list):
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO report_bucket (group_by, hour, fetched_at, rows) VALUES (?, ?, ?, ?)",
+                (group_by, hour, time.time(), json.dumps(rows, separators=(",", ":"))))
+        except sqlite3.Error as e:
+            logger.error(f"Report cache skrivefejl: {e}")
+
+    def evict(self, now: datetime = None):
+        """Slet buckets ældre end max_age_hours."""
+        cutoff = ((now or datetime.utcnow()) - timedelta(hours=self.max_age_hours)).strftime(TIME_FORMAT)
+        try:
+            self._conn().execute("DELETE FROM report_bucket WHERE hour < ?", (cutoff,))
+        except sqlite3.Error as e:
+            logger.error(f"Report cache evict fejl: {e}")
+
+    def fetch(self, group_by: str, hours_back: int = 24, now: datetime = None) -> list:
+        """Report for de sidste `hours_back` hele timer (som hour_window), flettet per række.
+
+        Rejser requests.RequestException hvis en time ikke kan hentes.
+        """
+        started = time.monotonic()
+        now = now or datetime.utcnow()
+        open_hour = now.replace(minute=0, second=0, microsecond=0)
+        starts = [open_hour - timedelta(hours=h) for h in range(int(hours_back), 0, -1)]
+        # Timer der stadig kan få sene konverteringer hentes altid (og caches ikke)
+        settled_before = open_hour - timedelta(hours=self.settle_hours)
+        cached = self._load(group_by, [s.strftime(TIME_FORMAT) for s in starts if s < settled_before])
+
+        fetcher = self.fetcher or get_report_ttl_cache()
+        buckets = []
+        fetches = 0
+        stored = False
+        for start in starts:
+            hour = start.strftime(TIME_FORMAT)
+            rows = cached.get(hour)
+            if rows is not None:
+                self.bucket_hits += 1
+            else:
+                rows = fetcher.fetch(group_by, hour, (start + timedelta(hours=1)).strftime(TIME_FORMAT))
+                fetches += 1
+                if start < settled_before:
+                    self._store(group_by, hour, rows)
+                    stored = True
+            buckets.append(rows)
+
+        self.bucket_fetches += fetches
+        self.last_tick_fetches = fetches
+        self.last_tick_seconds = time.monotonic() - started
+        if stored:
+            # Sker højst én gang i timen (når en time falder til ro) – ellers ved kold cache
+            self.evict(now)
+        return merge_buckets(buckets, f"{group_by}Id")
+
+    def stats(self) -> dict:
+        return {
+            "bucket_hits": self.bucket_hits,
+            "bucket_fetches": self.bucket_fetches,
+            "last_tick_fetches": self.last_tick_fetches,
+            "last_tick_seconds": round(self.last_tick_seconds, 3),
+            "settle_hours": self.settle_hours,
+            "max_age_hours": self.max_age_hours,
+        }
+
+
+_cache = None
+_ttl_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_report_ttl_cache() -> ReportTTLCache:
+    """Delt TTL-cache (i .state.db) – konfigureres fra .env ved første kald."""
+    global _ttl_cache
+    if _ttl_cache is None:
+        with _cache_lock:
+            if _ttl_cache is None:
+                _ttl_cache = ReportTTLCache(
+                    Path(__file__).parent / ".state.db",
+                    ttl=float(os.getenv("REPORT_TTL_SECONDS", "30")),
+                    max_entries=int(os.getenv("REPORT_TTL_MAX_ENTRIES", "64")),
+                    max_bytes=int(float(os.getenv("REPORT_TTL_MAX_MB", "32")) * 1024 * 1024),
+                )
+    return _ttl_cache
+
+
+def get_report_cache() -> HourBucketCache:
+    """Delt bucket-cache (i .state.db) – konfigureres fra .env ved første kald."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = HourBucketCache(
+                    Path(__file__).parent / ".state.db",
+                    max_age_hours=float(os.getenv("REPORT_CACHE_MAX_AGE_HOURS", "48")),
+                    settle_hours=int(os.getenv("REPORT_CACHE_SETTLE_HOURS", "1")),
+                )
+    return _cache
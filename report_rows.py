@@ -0,0 +1,138 @@
+"""
+Report-rækker
+=============
+Voluum report-rækker (dicts fra voluum_reports/report_cache) læses én gang per fetch ind i ReportRow:
+konverteringer og revenue er summeret, offer/land slået op i samme rækkefølge overalt og `updated`
+parset til et timestamp. /fetch-ftds, /poll-new-ftds, voluum_poll.py og send_latest.py regner derefter
+kun på attributter i stedet for at parse de samme strenge igen for hvert filter og hver sortering.
+
+Zero-revenue reglerne har deres egen kolonne-model (zero_revenue_rules.ColumnarReport), men bruger
+samme row_revenue.
+"""
+
+from datetime import datetime, timezone
+
+# Offer-navn og land: første felt med en værdi vinder
+OFFER_FIELDS = ("offerName", "offer", "lander", "campaignNamePostfix", "campaignName")
+COUNTRY_FIELDS = ("offerCountry", "campaignCountry", "countryCode")
+
+
+def _int(value) -> int:
+    if type(value) is int:  # Voluum sender tal som JSON-tal – det almindelige tilfælde
+        return value
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return 0
+
+
+def _float(value) -> float:
+    if type(value) is float:
+        return value
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _timestamp(value) -> float:
+    """Voluums "2024-05-01T12:34:56.000Z" (eller epoch) -> sekunder. 0 hvis ukendt."""
+    if not value:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    if text[-1:] in ("Z", "z"):
+        # fromisoformat kender først "Z" fra Python 3.11
+        text = text[:-1] + "+00:00"
+    try:
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        return 0.0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def row_conversions(row: dict) -> int:
+    """Alle konverteringer: conversions + customConversions1+2."""
+    return _int(row.get("conversions")) + _int(row.get("customConversions1")) + _int(row.get("customConversions2"))
+
+
+def row_revenue(row: dict) -> float:
+    """Al revenue: allConversionsRevenue (ellers revenue) + customRevenue1+2."""
+    main = _float(row.get("allConversionsRevenue")) or _float(row.get("revenue"))
+    return main + _float(row.get("customRevenue1")) + _float(row.get("customRevenue2"))
+
+
+def _first(row: dict, fields: tuple, default: str = "") -> str:
+    for field in fields:
+        value = row.get(field)
+        if value:
+            return value
+    return default
+
+
+class ReportRow:
+    """Én kampagne-række med færdigregnede totaler.
+
+    `updated` (updated, ellers created, som timestamp) parses først når den bruges – poll-tick'et sorterer
+    ikke og betaler derfor ikke for det.
+    """
+
+    __slots__ = ("campaign_id", "campaign_name", "campaign_country", "source", "offer", "country",
+                 "conversions", "revenue", "clicks", "_updated_raw", "_updated")
+
+    def __init__(self, campaign_id: str, campaign_name: str, campaign_country: str, source: str, offer: str,
+                 country: str, conversions: int, revenue: float, clicks: int, updated=None):
+        self.campaign_id = campaign_id
+        self.campaign_name = campaign_name
+        self.campaign_country = campaign_country
+        self.source = source
+        self.offer = offer
+        self.country = country
+        self.conversions = conversions
+        self.revenue = revenue
+        self.clicks = clicks
+        self._updated_raw = updated
+        self._updated = None
+
+    @classmethod
+    def from_dict(cls, row: dict) -> "ReportRow":
+        get = row.get
+        campaign_id = get("campaignId")
+        return cls(
+            str(campaign_id) if campaign_id else "",
+            get("campaignName") or "",
+            get("campaignCountry") or "",
+            get("trafficSourceName") or "",
+            _first(row, OFFER_FIELDS, "?"),
+            _first(row, COUNTRY_FIELDS),
+            row_conversions(row),
+            row_revenue(row),
+            _int(get("uniqueClicks")),
+            get("updated") or get("created"),
+        )
+
+    @property
+    def updated(self) -> float:
+        if self._updated is None:
+            self._updated = _timestamp(self._updated_raw)
+        return self._updated
+
+    def __repr__(self):
+        return (f"ReportRow({self.campaign_id!r}, offer={self.offer!r}, country={self.country!r}, "
+                f"conversions={self.conversions}, revenue={self.revenue:.2f})")
+
+
+def report_rows(rows: list) -> list:
+    """Dicts fra en report -> [ReportRow]. Allerede konverterede rækker genbruges."""
+    return [row if isinstance(row, ReportRow) else ReportRow.from_dict(row) for row in rows]
+
+
+def newest_first(rows: list) -> list:
+    """Sorteret efter updated (ellers created), nyeste først."""
+    return sorted(rows, key=lambda r: r.updated, reverse=True)
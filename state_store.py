@@ -0,0 +1,330 @@
+"""
+Transaktionel state store
+=========================
+Erstatter de spredte JSON-state-filer (.zero_revenue_*.json, .poll_ftd_state.json,
+.voluum_state.json) med én SQLite-database (.state.db) med typede tabeller.
+
+- Hver tick kører i én transaktion (BEGIN IMMEDIATE): samtidige gunicorn workers og
+  voluum_poll.py serialiseres, og et crash midt i en skrivning efterlader den gamle baseline.
+- sync_*() skriver kun de kampagner/offers der faktisk er ændret.
+- De gamle JSON-filer importeres automatisk første gang og omdøbes til *.migrated.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from outbox import connect
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaign_totals (
+    scope TEXT NOT NULL,
+    campaign_id TEXT NOT NULL,
+    conversions INTEGER NOT NULL,
+    revenue REAL NOT NULL,
+    PRIMARY KEY (scope, campaign_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS offer_pending (
+    offer_id TEXT PRIMARY KEY,
+    first_seen_80 REAL,
+    first_seen_150 REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS offer_snapshot (
+    offer_id TEXT PRIMARY KEY,
+    clicks INTEGER NOT NULL,
+    revenue REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS offer_alert_sent (
+    offer_id TEXT PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rule_pending (
+    rule TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (rule, entity)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rule_alert (
+    scope TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    sent_at REAL NOT NULL,
+    PRIMARY KEY (scope, entity)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS timeseries_head (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    created INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS timeseries_key (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS timeseries_key_version ON timeseries_key (name, version);
+CREATE TABLE IF NOT EXISTS conversion_seen (
+    key TEXT PRIMARY KEY,
+    ts TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS conversion_seen_ts ON conversion_seen (ts);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+SCOPE_POLL_FTD = "poll_ftd"
+SCOPE_VOLUUM_POLL = "voluum_poll"
+
+# Gamle filer -> importeres én gang
+_LEGACY_FILES = {
+    "poll_ftd": ".poll_ftd_state.json",
+    "voluum_poll": ".voluum_state.json",
+    "zero_sent": ".zero_revenue_sent.json",
+    "zero_pending": ".zero_revenue_pending.json",
+    "zero_last": ".zero_revenue_last.json",
+    "zero_date": ".zero_revenue_date.txt",
+}
+
+
+class StateTxn:
+    """Læs/skriv state inden for én transaktion."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _sync(self, table: str, key_cols: tuple, val_cols: tuple, fixed: dict, old: dict, new: dict) -> int:
+        """Upsert ændrede rækker og slet forsvundne. Returnerer antal skrevne rækker."""
+        cols = tuple(fixed) + key_cols + val_cols
+        fixed_vals = tuple(fixed.values())
+        upserts = []
+        for key, vals in new.items():
+            if old.get(key) != vals:
+                upserts.append(fixed_vals + (key,) + tuple(vals[c] for c in val_cols))
+        deletes = [fixed_vals + (key,) for key in old.keys() - new.keys()]
+        if upserts:
+            placeholders = ", ".join("?" * len(cols))
+            self.conn.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES ({placeholders})", upserts)
+        if deletes:
+            where = " AND ".join(f"{c} = ?" for c in tuple(fixed) + key_cols)
+            self.conn.executemany(f"DELETE FROM {table} WHERE {where}", deletes)
+        return len(upserts) + len(deletes)
+
+    # --- Kampagne-totaler (poll-new-ftds / voluum_poll) ---------------------
+
+    def load_campaign_totals(self, scope: str) -> dict:
+        rows = self.conn.execute(
+            "SELECT campaign_id, conversions, revenue FROM campaign_totals WHERE scope = ?", (scope,))
+        return {cid: {"conversions": conv, "revenue": rev} for cid, conv, rev in rows}
+
+    def sync_campaign_totals(self, scope: str, old: dict, new: dict) -> int:
+        return self._sync("campaign_totals", ("campaign_id",), ("conversions", "revenue"),
+                          {"scope": scope}, old, new)
+
+    def clear_campaign_totals(self, scope: str):
+        self.conn.execute("DELETE FROM campaign_totals WHERE scope = ?", (scope,))
+
+    # --- Zero-revenue -------------------------------------------------------
+
+    def sync_offer_pending(self, old: dict, new: dict) -> int:
+        norm = lambda d: {k: {"first_seen_80": v.get("first_seen_80"), "first_seen_150": v.get("first_seen_150")}
+                          for k, v in d.items()}
+        return self._sync("offer_pending", ("offer_id",), ("first_seen_80", "first_seen_150"), {},
+                          norm(old), norm(new))
+
+    def sync_offer_snapshot(self, old: dict, new: dict) -> int:
+        return self._sync("offer_snapshot", ("offer_id",), ("clicks", "revenue"), {}, old, new)
+
+    def add_alert_sent(self, offer_id: str):
+        self.conn.execute("INSERT OR IGNORE INTO offer_alert_sent (offer_id) VALUES (?)", (offer_id,))
+
+    def reset_zero_revenue(self):
+        """Ny dag: glem sendte alerts, pending timere og snapshots."""
+        for table in ("offer_alert_sent", "offer_pending", "offer_snapshot", "rule_pending", "rule_alert"):
+            self.conn.execute(f"DELETE FROM {table}")
+
+    # --- Zero-revenue regler (zero_revenue_rules.py) -------------------------
+
+    def load_rule_pending(self) -> dict:
+        out = {}
+        for rule, entity, first_seen in self.conn.execute("SELECT rule, entity, first_seen FROM rule_pending"):
+            out.setdefault(rule, {})[entity] = first_seen
+        return out
+
+    def sync_rule_pending(self, old: dict, new: dict) -> int:
+        wrap = lambda d: {k: {"first_seen": v} for k, v in d.items()}
+        return sum(self._sync("rule_pending", ("entity",), ("first_seen",), {"rule": rule},
+                              wrap(old.get(rule, {})), wrap(new.get(rule, {})))
+                   for rule in old.keys() | new.keys())
+
+    def load_rule_alerts(self) -> dict:
+        out = {}
+        for scope, entity, sent_at in self.conn.execute("SELECT scope, entity, sent_at FROM rule_alert"):
+            out.setdefault(scope, {})[entity] = sent_at
+        return out
+
+    def add_rule_alert(self, scope: str, entity: str, sent_at: float):
+        self.conn.execute("INSERT OR REPLACE INTO rule_alert (scope, entity, sent_at) VALUES (?, ?, ?)",
+                          (scope, entity, sent_at))
+
+    def migrate_offer_tables(self):
+        """Flyt state fra de gamle offer_*-tabeller til regeltabellerne (de to standardregler)."""
+        self.conn.execute("INSERT OR IGNORE INTO rule_pending SELECT 'zero_revenue', offer_id, first_seen_80 "
+                          "FROM offer_pending WHERE first_seen_80 IS NOT NULL")
+        self.conn.execute("INSERT OR IGNORE INTO rule_pending SELECT 'since_revenue', offer_id, first_seen_150 "
+                          "FROM offer_pending WHERE first_seen_150 IS NOT NULL")
+        self.conn.execute("INSERT OR IGNORE INTO rule_alert SELECT 'offer', offer_id, strftime('%s', 'now') "
+                          "FROM offer_alert_sent")
+        for table in ("offer_pending", "offer_alert_sent", "offer_snapshot"):
+            self.conn.execute(f"DELETE FROM {table}")
+
+    # --- Tidsserier (timeseries.py) -------------------------------------------
+
+    def series_head(self, name: str) -> tuple:
+        """(version, created) for serien – None hvis den ikke findes."""
+        return self.conn.execute("SELECT version, created FROM timeseries_head WHERE name = ?", (name,)).fetchone()
+
+    def load_series_rows(self, name: str, since_version: int = None) -> list:
+        """[(key, data)] – kun keys skrevet efter `since_version` hvis den er angivet."""
+        if since_version is None:
+            return self.conn.execute("SELECT key, data FROM timeseries_key WHERE name = ?", (name,)).fetchall()
+        return self.conn.execute("SELECT key, data FROM timeseries_key WHERE name = ? AND version > ?",
+                                 (name, since_version)).fetchall()
+
+    def save_series_rows(self, name: str, upserts: list, removed: list) -> int:
+        """Skriv ændrede keys [(key, data)] og slet fjernede. Returnerer seriens nye version."""
+        head = self.series_head(name)
+        # Unik også efter delete_series – en gammel proces-kopi kan ikke matche
+        version = max(time.time_ns(), head[0] + 1 if head else 0)
+        self.conn.executemany("INSERT OR REPLACE INTO timeseries_key (name, key, version, data) VALUES (?, ?, ?, ?)",
+                              [(name, key, version, data) for key, data in upserts])
+        self.conn.executemany("DELETE FROM timeseries_key WHERE name = ? AND key = ?", [(name, k) for k in removed])
+        self.conn.execute("INSERT INTO timeseries_head (name, version, created) VALUES (?, ?, ?) "
+                          "ON CONFLICT(name) DO UPDATE SET version = excluded.version", (name, version, version))
+        return version
+
+    def delete_series(self, name: str):
+        for table in ("timeseries_head", "timeseries_key"):
+            self.conn.execute(f"DELETE FROM {table} WHERE name = ?", (name,))
+
+    # --- Konverteringsloggen (conversion_poller.py) ----------------------------
+
+    def seen_conversions(self, keys: list) -> set:
+        """De af `keys` der allerede er håndteret."""
+        seen = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            seen.update(k for (k,) in self.conn.execute(
+                f"SELECT key FROM conversion_seen WHERE key IN ({', '.join('?' * len(chunk))})", chunk))
+        return seen
+
+    def add_seen_conversions(self, rows: list):
+        """[(key, tidspunkt)]"""
+        self.conn.executemany("INSERT OR IGNORE INTO conversion_seen (key, ts) VALUES (?, ?)", rows)
+
+    def prune_seen_conversions(self, before: str):
+        self.conn.execute("DELETE FROM conversion_seen WHERE ts < ?", (before,))
+
+    # --- Meta ---------------------------------------------------------------
+
+    def get_meta(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value: str):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+class StateStore:
+    """SQLite-baseret state (WAL) delt af alle processer i projektmappen."""
+
+    def __init__(self, path: Path, legacy_dir: Path = None):
+        self.path = path
+        self._local = threading.local()
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+        if legacy_dir is not None:
+            self._migrate_legacy(legacy_dir)
+        with self.transaction() as tx:
+            tx.migrate_offer_tables()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Atomisk læs-ændr-skriv. Ruller tilbage ved exception."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield StateTxn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _migrate_legacy(self, legacy_dir: Path):
+        files = {name: legacy_dir / fname for name, fname in _LEGACY_FILES.items()}
+        if not any(f.exists() for f in files.values()):
+            return
+
+        def _load(name, default):
+            f = files[name]
+            if not f.exists():
+                return default
+            try:
+                return f.read_text().strip() if f.suffix == ".txt" else json.loads(f.read_text())
+            except Exception:
+                return default
+
+        with self.transaction() as tx:
+            if tx.get_meta("legacy_migrated"):
+                return
+            for scope in (SCOPE_POLL_FTD, SCOPE_VOLUUM_POLL):
+                totals = _load(scope, {})
+                tx.sync_campaign_totals(scope, {}, {
+                    cid: {"conversions": int(v.get("conversions", 0) or 0), "revenue": float(v.get("revenue", 0) or 0)}
+                    for cid, v in totals.items()})
+            tx.sync_offer_pending({}, {
+                oid: {"first_seen_80": v.get("first_seen_80") or v.get("first_seen"), "first_seen_150": v.get("first_seen_150")}
+                for oid, v in _load("zero_pending", {}).items()})
+            tx.sync_offer_snapshot({}, {
+                oid: {"clicks": int(v.get("clicks", 0) or 0), "revenue": float(v.get("revenue", 0) or 0)}
+                for oid, v in _load("zero_last", {}).items()})
+            for oid in _load("zero_sent", []):
+                tx.add_alert_sent(oid)
+            zero_date = _load("zero_date", "")
+            if zero_date:
+                tx.set_meta("zero_revenue_date", zero_date)
+            tx.set_meta("legacy_migrated", "1")
+        for f in files.values():
+            if f.exists():
+                f.rename(f.with_name(f.name + ".migrated"))
+        logger.info("Gamle JSON state-filer importeret til .state.db")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_state_store() -> StateStore:
+    """Delt state store for projektmappen."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                data_dir = Path(__file__).parent
+                _store = StateStore(data_dir / ".state.db", legacy_dir=data_dir)
+    return _store
@@ -0,0 +1,347 @@
+"""
+Central Telegram-afsender
+=========================
+Alle Telegram-beskeder går gennem én scheduler per proces, så vi holder os under
+Telegrams rate limits i stedet for at få 429 og miste beskeder.
+
+- Token buckets: én global (TELEGRAM_GLOBAL_RATE/s) og én per chat
+  (grupper: TELEGRAM_GROUP_RATE/min, private chats: TELEGRAM_CHAT_RATE/s).
+- 429: `parameters.retry_after` respekteres – chatten pauses og beskeden sendes igen.
+- Prioritet: FTD-beskeder sendes før zero-revenue alerts.
+- backlog() viser kø per prioritet og pausede chats.
+
+Bemærk: rate limits håndhæves per proces. Med flere gunicorn workers deles budgettet
+ikke – sæt rates derefter.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import http_clients
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_FTD = 0
+PRIORITY_ALERT = 10
+PRIORITY_NAMES = {PRIORITY_FTD: "ftd", PRIORITY_ALERT: "alert"}
+
+MAX_429_RETRIES = 10
+MAX_ERROR_RETRIES = 3
+# Kan peges på en lokal stand-in (bench/bench_load.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+
+class TokenBucket:
+    """Klassisk token bucket: `rate` tokens/sekund, højst `capacity` på lager."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now <= self.updated:  # `now` kan være taget før bucketen blev oprettet
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Sekunder til der er et token (0 hvis der er et nu)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class TelegramJob:
+    """En besked i køen. wait() blokerer til den er sendt eller endeligt fejlet."""
+
+    __slots__ = ("chat_id", "text", "priority", "seq", "enqueued_at", "attempts",
+                 "ok", "status_code", "description", "_done", "_callbacks", "_lock")
+
+    def __init__(self, chat_id: str, text: str, priority: int, seq: int):
+        self.chat_id = str(chat_id)
+        self.text = text
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.ok = False
+        self.status_code = None
+        self.description = ""
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def finish(self, ok: bool, status_code=None, description: str = ""):
+        with self._lock:
+            self.ok = ok
+            self.status_code = status_code
+            self.description = description
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.error(f"Telegram job callback fejl: {e}")
+
+    def add_done_callback(self, fn):
+        """Kald fn(job) når jobbet er færdigt (med det samme hvis det allerede er)."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Vent på resultat. Returnerer False hvis timeout (beskeden ligger stadig i køen)."""
+        return self._done.wait(timeout)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+
+class TelegramScheduler:
+    """Prioriteret, rate-limited afsender til Telegram Bot API."""
+
+    def __init__(self, bot_token: str, global_rate: float = 25, chat_rate: float = 1,
+                 group_rate_per_min: float = 20, burst: float = 3):
+        self.bot_token = bot_token
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate_per_min / 60
+        self.burst = burst
+        self._global = TokenBucket(global_rate, max(1, global_rate))
+        self._chats = {}
+        self._blocked_until = {}  # chat_id -> monotonic tid hvor retry_after udløber
+        self._queues = {}  # chat_id -> heap af chattens jobs
+        self._heap = []  # Forreste job per chat der må sende (forældede entries springes over)
+        self._parked = []  # Heap af (tid, chat_id) for chats der venter (rate limit / retry_after)
+        self._parked_until = {}  # chat_id -> tid
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pid = None
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Grupper/kanaler har negative ID'er og en langt lavere grænse end private chats
+            rate = self.group_rate if chat_id.startswith("-") else self.chat_rate
+            bucket = TokenBucket(rate, self.burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="telegram-scheduler", daemon=True).start()
+
+    def submit(self, chat_id, text: str, priority: int = PRIORITY_FTD) -> TelegramJob:
+        """Læg besked i køen og returnér jobbet (ikke-blokerende)."""
+        self._ensure_started()
+        with self._cond:
+            job = TelegramJob(chat_id, text, priority, next(self._seq))
+            self._push(job)
+            self._cond.notify()
+        return job
+
+    def send(self, chat_id, text: str, priority: int = PRIORITY_FTD, timeout: float = 30) -> TelegramJob:
+        """Send og vent på resultat (højst `timeout` sekunder)."""
+        job = self.submit(chat_id, text, priority)
+        job.wait(timeout)
+        return job
+
+    def _push(self, job: TelegramJob):
+        """Læg job i sin chats kø; er det nu chattens forreste og venter chatten ikke, kan det sendes."""
+        queue = self._queues.get(job.chat_id)
+        if queue is None:
+            queue = self._queues[job.chat_id] = []
+        heapq.heappush(queue, job)
+        if queue[0] is job and job.chat_id not in self._parked_until:
+            heapq.heappush(self._heap, job)
+
+    def _release_parked(self, now: float):
+        """Chats hvis ventetid er udløbet kommer tilbage i køen med deres forreste job."""
+        while self._parked and self._parked[0][0] <= now:
+            _, chat_id = heapq.heappop(self._parked)
+            del self._parked_until[chat_id]
+            queue = self._queues.get(chat_id)
+            if queue:
+                heapq.heappush(self._heap, queue[0])
+
+    def _pop_ready(self):
+        """Tag næste job der må sendes nu (og brug tokens). Kaldes med _cond holdt. Returnerer (job, ventetid).
+
+        Kun hver chats forreste job ligger i den fælles heap; en chat der skal vente parkeres samlet.
+        Hvert pop er derfor O(log n), også med en lang kø bag én rate-limitet chat.
+        """
+        now = time.monotonic()
+        self._release_parked(now)
+        while self._heap:
+            job = self._heap[0]
+            chat_id = job.chat_id
+            queue = self._queues.get(chat_id)
+            if not queue or queue[0] is not job or chat_id in self._parked_until:
+                heapq.heappop(self._heap)  # Forældet: sendt, overhalet af et vigtigere job eller parkeret
+                continue
+            wait = max(self._blocked_until.get(chat_id, 0) - now, self._chat_bucket(chat_id).wait_time(now))
+            if wait > 0:
+                heapq.heappop(self._heap)
+                self._parked_until[chat_id] = now + wait
+                heapq.heappush(self._parked, (now + wait, chat_id))
+                continue
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return None, global_wait
+            heapq.heappop(self._heap)
+            heapq.heappop(queue)
+            if queue:
+                heapq.heappush(self._heap, queue[0])
+            else:
+                del self._queues[chat_id]
+            self._global.take(now)
+            self._chat_bucket(chat_id).take(now)
+            return job, 0.0
+        return None, (max(0.0, self._parked[0][0] - now) if self._parked else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    job, wait = self._pop_ready()
+                    if job is not None:
+                        break
+                    self._cond.wait(wait)
+            self._deliver(job)
+
+    def _requeue(self, job: TelegramJob):
+        with self._cond:
+            self._push(job)
+            self._cond.notify()
+
+    def _deliver(self, job: TelegramJob):
+        job.attempts += 1
+        try:
+            response = http_clients.get_client("telegram").post(self.send_url, json=self.payload(job), timeout=10)
+            try:
+                data = response.json()
+            except ValueError:
+                data = {}
+        except requests.RequestException as e:
+            self._on_error(job, e)
+            return
+        self._on_response(job, response.status_code, data)
+
+    @property
+    def send_url(self) -> str:
+        return f"{TELEGRAM_API_BASE}/bot{self.bot_token}/sendMessage"
+
+    @staticmethod
+    def payload(job: TelegramJob) -> dict:
+        return {"chat_id": job.chat_id, "text": job.text, "parse_mode": "HTML"}
+
+    def _on_error(self, job: TelegramJob, e: Exception):
+        """Netværksfejl: prøv igen med backoff, giv op efter MAX_ERROR_RETRIES."""
+        logger.error(f"Failed to send Telegram message: {e}")
+        if job.attempts < MAX_ERROR_RETRIES:
+            with self._cond:
+                self._blocked_until[job.chat_id] = time.monotonic() + 2 ** job.attempts
+            self._requeue(job)
+            return
+        self.failed += 1
+        job.finish(False, None, str(e))
+
+    def _on_response(self, job: TelegramJob, status_code: int, data: dict):
+        """Svar fra Telegram: 429 pauser chatten og sender igen, ellers afsluttes jobbet."""
+        if status_code == 429:
+            retry_after = (data.get("parameters") or {}).get("retry_after") or 1
+            self.rate_limited += 1
+            logger.warning(f"Telegram 429 for chat {job.chat_id} - venter {retry_after}s")
+            if job.attempts < MAX_429_RETRIES:
+                with self._cond:
+                    self._blocked_until[job.chat_id] = time.monotonic() + float(retry_after)
+                self._requeue(job)
+                return
+
+        if not 200 <= status_code < 300:
+            self.failed += 1
+            job.finish(False, status_code, data.get("description", str(status_code)))
+            return
+
+        self.sent += 1
+        job.finish(True, status_code, "")
+
+    def backlog(self) -> dict:
+        """Kø-status: antal per prioritet, ældste besked og pausede chats."""
+        with self._cond:
+            now = time.monotonic()
+            by_priority = {}
+            oldest = 0.0
+            for job in itertools.chain.from_iterable(self._queues.values()):
+                name = PRIORITY_NAMES.get(job.priority, str(job.priority))
+                by_priority[name] = by_priority.get(name, 0) + 1
+                oldest = max(oldest, now - job.enqueued_at)
+            blocked = {c: round(t - now, 1) for c, t in self._blocked_until.items() if t > now}
+        return {
+            "queued": sum(by_priority.values()),
+            "by_priority": by_priority,
+            "oldest_seconds": round(oldest, 1),
+            "blocked_chats": blocked,
+            "sent": self.sent,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+        }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def install_scheduler(scheduler: TelegramScheduler):
+    """Erstat den delte scheduler (fx med den asynkrone i ASGI mode)."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+def scheduler_settings() -> dict:
+    """Rate limits fra .env (deles af den trådbaserede og den asynkrone scheduler)."""
+    return {
+        "global_rate": float(os.getenv("TELEGRAM_GLOBAL_RATE", "25")),
+        "chat_rate": float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+        "group_rate_per_min": float(os.getenv("TELEGRAM_GROUP_RATE", "20")),
+        "burst": float(os.getenv("TELEGRAM_BURST", "3")),
+    }
+
+
+def get_scheduler() -> TelegramScheduler:
+    """Delt scheduler for processen – konfigureres fra .env ved første kald."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = TelegramScheduler(os.getenv("TELEGRAM_BOT_TOKEN", ""), **scheduler_settings())
+    return _scheduler
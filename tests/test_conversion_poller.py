@@ -0,0 +1,61 @@
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversion_poller import ConversionPoller
+from state_store import StateStore
+
+
+class FakeFetcher:
+    def __init__(self):
+        self.rows = []
+
+    def conversions(self, start, end):
+        return list(self.rows)
+
+
+def _row(ts, txid, revenue=100):
+    return {"postbackTimestamp": ts, "transactionId": txid, "offerName": "offer", "countryCode": "DK",
+            "revenue": revenue, "conversionType": "FTD"}
+
+
+def _tick(store, poller, now):
+    with store.transaction() as tx:
+        cursor = poller.load_cursor(tx)
+    convs = poller.fetch(cursor, now=now)
+    with store.transaction() as tx:
+        new, first = poller.take_new(tx, convs, now=now)
+    return [c.fields.txid for c in new], first
+
+
+def test_late_arrival_inside_overlap_window_is_sent(tmp_path):
+    store = StateStore(tmp_path / ".state.db")
+    fetcher = FakeFetcher()
+    poller = ConversionPoller(fetcher, overlap_minutes=30)
+
+    fetcher.rows = [_row("2026-01-01 12:00:00", "a")]
+    assert _tick(store, poller, datetime(2026, 1, 1, 12, 1)) == ([], True)
+
+    # "late" er indlæst forsinket med et tidspunkt før cursoren, men inden for overlap-vinduet
+    fetcher.rows = [_row("2026-01-01 12:00:00", "a"), _row("2026-01-01 11:45:00", "late"),
+                    _row("2026-01-01 12:05:00", "b")]
+    assert _tick(store, poller, datetime(2026, 1, 1, 12, 6)) == (["late", "b"], False)
+
+
+def test_conversion_already_seen_is_not_resent(tmp_path):
+    store = StateStore(tmp_path / ".state.db")
+    fetcher = FakeFetcher()
+    poller = ConversionPoller(fetcher, overlap_minutes=30)
+
+    fetcher.rows = [_row("2026-01-01 12:00:00", "a")]
+    _tick(store, poller, datetime(2026, 1, 1, 12, 1))
+    with store.transaction() as tx:
+        tx.add_seen_conversions([("tx:seen", "2026-01-01 12:02:00")])
+
+    fetcher.rows = [_row("2026-01-01 12:00:00", "a"), _row("2026-01-01 12:02:00", "seen"),
+                    _row("2026-01-01 12:03:00", "b")]
+    assert _tick(store, poller, datetime(2026, 1, 1, 12, 4)) == (["b"], False)
+    # Næste tick læser samme vindue igen – intet sendes to gange
+    assert _tick(store, poller, datetime(2026, 1, 1, 12, 5)) == ([], False)
@@ -0,0 +1,37 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup import DedupIndex
+
+
+def test_second_claim_is_duplicate(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.db")
+    assert index.claim("tx:1") is True
+    assert index.claim("tx:1") is False
+    assert (index.stats()["hits"], index.stats()["misses"]) == (1, 1)
+
+
+def test_release_lets_key_be_claimed_again(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.db")
+    assert index.claim("tx:1") is True
+    index.release("tx:1")
+    assert index.claim("tx:1") is True
+
+
+def test_claim_survives_new_index_on_same_file(tmp_path):
+    assert DedupIndex(tmp_path / "dedup.db").claim("tx:1") is True
+    # Ny proces: tom LRU, nøglen findes kun i SQLite
+    index = DedupIndex(tmp_path / "dedup.db")
+    assert index.claim("tx:1") is False
+    assert index.claim_many(["tx:1"]) == [False]
+    assert index.stats()["lru_hits"] == 1
+
+
+def test_claim_many_dedups_within_batch(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.db")
+    assert index.claim("tx:0") is True
+    assert index.claim_many(["tx:1", "tx:2", "tx:1", "tx:0", "tx:2"]) == [True, True, False, False, False]
+    stats = index.stats()
+    assert (stats["hits"], stats["lru_hits"], stats["misses"]) == (3, 1, 3)
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ftd_digest import FtdBuffer
+
+
+class FlakySend:
+    """Fejler på det kald der står i `fail_on` (1-indekseret), ellers ok."""
+
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.calls = 0
+        self.sent = []
+
+    def __call__(self, text):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            return False, "HTTP 502"
+        self.sent.append(text)
+        return True, None
+
+
+def _buffer(tmp_path, send):
+    return FtdBuffer(tmp_path / ".state.db", 60, owner_of=lambda c: "Ejer", flag_of=lambda c: c, send=send)
+
+
+def _offers(text):
+    return {line.split(" - ")[1] for line in text.splitlines() if line.startswith("$")}
+
+
+def test_failed_second_chunk_does_not_resend_first(tmp_path):
+    send = FlakySend(fail_on=[2])
+    buf = _buffer(tmp_path, send)
+    # Nok forskellige offers til at den samlede besked deles i to (over 4096 tegn)
+    buf.add([(f"offer-{i:03d}-{'x' * 30}", "DK", 100 + i, 1) for i in range(100)], sent=False)
+
+    with pytest.raises(RuntimeError):
+        buf.flush_due(force=True)
+    assert len(send.sent) == 1
+    first = _offers(send.sent[0])
+    assert buf.stats()["pending_rows"] == 100 - len(first)
+
+    assert buf.flush_due(force=True) == 1
+    assert len(send.sent) == 2
+    second = _offers(send.sent[1])
+    assert not first & second
+    assert len(first | second) == 100
+    assert buf.stats()["pending_rows"] == 0
+    assert buf.flush_due(force=True) == 0
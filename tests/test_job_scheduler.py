@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_scheduler import JobScheduler
+from outbox import connect
+
+
+def test_job_runs_once_per_interval_across_schedulers(tmp_path):
+    runs = []
+    a, b = JobScheduler(tmp_path / ".state.db"), JobScheduler(tmp_path / ".state.db")
+    for sched in (a, b):
+        sched.add("poll", lambda: runs.append(1), interval=60)
+    assert a.run_once(a.jobs["poll"]) is True
+    assert b.run_once(b.jobs["poll"]) is False
+    assert len(runs) == 1
+
+
+def test_tick_that_is_not_due_does_not_wait_for_write_lock(tmp_path):
+    sched = JobScheduler(tmp_path / ".state.db")
+    sched.add("poll", lambda: None, interval=60)
+    assert sched.run_once(sched.jobs["poll"]) is True
+
+    # En anden proces holder skrivelåsen – et tick der ikke er forfaldent skal ikke vente på den
+    other = connect(tmp_path / ".state.db")
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        started = time.monotonic()
+        assert sched.run_once(sched.jobs["poll"]) is False
+        assert time.monotonic() - started < 1
+    finally:
+        other.execute("ROLLBACK")
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbox import Outbox
+
+
+class FakeJob:
+    """Færdigt scheduler-job (TelegramJob har samme felter)."""
+
+    def __init__(self, ok=True):
+        self.ok = ok
+        self.description = None if ok else "fejl"
+        self.status_code = 200 if ok else 500
+
+    def add_done_callback(self, fn):
+        fn(self)
+
+
+def _wait_for(cond, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def _refuse(chat_id, text, priority):
+    raise AssertionError("død worker må ikke sende")
+
+
+def test_unsent_message_is_delivered_by_fresh_outbox_after_lease(tmp_path):
+    path = tmp_path / ".outbox.db"
+    dead = Outbox(path, _refuse, lease_seconds=0.3, flush_interval=0)
+    dead.batch_size = 0  # Worker der dør efter append: claimer aldrig selv
+    msg_id = dead.append("chat", "FTD", claim=True)
+
+    sent = []
+    fresh = Outbox(path, lambda chat_id, text, priority: sent.append((chat_id, text)) or FakeJob(),
+                   flush_interval=0)
+    assert fresh._claim_due(10) == []  # Leasen gælder stadig
+
+    fresh.ensure_started()
+    assert _wait_for(lambda: fresh.counts() == {"done": 1})
+    assert sent == [("chat", "FTD")]
+    assert fresh._conn().execute("SELECT attempts FROM outbox WHERE id = ?", (msg_id,)).fetchone() == (1,)
+
+
+def test_delivered_message_is_not_sent_again(tmp_path):
+    path = tmp_path / ".outbox.db"
+    sent = []
+    first = Outbox(path, lambda chat_id, text, priority: sent.append(text) or FakeJob(), lease_seconds=0.1,
+                   flush_interval=0)
+    first.append("chat", "FTD")
+    assert _wait_for(lambda: first.counts() == {"done": 1})
+
+    time.sleep(0.2)  # Også efter leasen ville være udløbet
+    fresh = Outbox(path, _refuse, lease_seconds=0.1, flush_interval=0)
+    assert fresh._claim_due(10) == []
+    assert sent == ["FTD"]
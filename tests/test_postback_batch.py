@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import postback_batch
+from postback_batch import expand, is_ndjson, parse_batch
+
+A = {"clickid": "a", "payout": "10", "type": "FTD"}
+B = {"clickid": "b", "payout": "20", "type": "FTD"}
+
+
+def test_json_list():
+    assert parse_batch(json.dumps([A, B]).encode(), "application/json") == [A, B]
+    assert expand([A, B]) == [A, B]
+
+
+def test_multi_conversion_object():
+    for key in ("conversions", "data"):
+        payload = {"source": "zapier", key: [A, B]}
+        assert expand(payload) == [A, B]
+        assert parse_batch(json.dumps(payload).encode(), "application/json") == [A, B]
+
+
+def test_single_object_is_not_a_batch():
+    assert expand(A) is None
+    assert expand([A]) is None
+    assert expand({"data": A}) is None
+    assert parse_batch(json.dumps(A).encode(), "application/json") == [A]
+
+
+def test_ndjson_skips_blank_lines_and_marks_bad_lines():
+    body = b"\xef\xbb\xbf" + (json.dumps(A) + "\n\n  \r\n{ikke json\n" + json.dumps(B) + "\n").encode()
+    assert parse_batch(body, "application/x-ndjson; charset=utf-8") == [A, None, B]
+
+
+def test_ndjson_detected_without_content_type():
+    # Flere objekter uden NDJSON Content-Type: json.loads fejler, linjerne parses hver for sig
+    body = (json.dumps(A) + "\n" + json.dumps(B)).encode()
+    assert parse_batch(body, "application/json") == [A, B]
+
+
+def test_invalid_body_raises_value_error():
+    # Endpoints svarer 400 på ValueError
+    with pytest.raises(ValueError):
+        parse_batch(b"clickid=a&payout=10", "application/x-www-form-urlencoded")
+    with pytest.raises(ValueError):
+        parse_batch(b"[1, 2", "application/json")
+
+
+def test_too_many_items_raises_value_error(monkeypatch):
+    monkeypatch.setattr(postback_batch, "POSTBACK_BATCH_MAX", 2)
+    with pytest.raises(ValueError):
+        parse_batch(json.dumps([A, B, A]).encode(), "application/json")
+    with pytest.raises(ValueError):
+        parse_batch(b"{}\n{}\n{}", "application/x-ndjson")
+
+
+def test_is_ndjson():
+    assert is_ndjson("application/x-ndjson")
+    assert is_ndjson("Application/JSONL; charset=utf-8")
+    assert not is_ndjson("application/json")
+    assert not is_ndjson(None)
+
+
+def test_empty_body():
+    assert parse_batch(b"", "application/json") == []
+    assert parse_batch(None) == []
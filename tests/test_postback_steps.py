@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from postback_fields import extract_fields
+
+DATA = {"clickid": "abc", "payout": "50", "type": "FTD", "offer": "Kasino", "country": "DK"}
+
+
+def _run(send_result):
+    """Kør postback_steps med falsk I/O. Returnerer ((svar, status), trin)."""
+    steps = app.postback_steps("query", dict(DATA), extract_fields(DATA, "query"))
+    io = {"claim": True, "release": None, "forward": None, "coalesce": False, "ledger": None,
+          "send": send_result}
+    seen, result = [], None
+    try:
+        while True:
+            step, *_ = steps.send(result)
+            seen.append(step)
+            result = io[step]
+    except StopIteration as done:
+        return done.value, seen
+
+
+def test_async_outbox_send_failure_is_reported(monkeypatch):
+    monkeypatch.setattr(app, "POSTBACK_ASYNC", True)
+    monkeypatch.setattr(app, "_outbox", object())
+    monkeypatch.setattr(app, "_dedup", object())
+    (body, status), seen = _run((False, "Bot token mangler"))
+    assert status == 500 and body["message"] == "Bot token mangler"
+    assert "release" in seen and "ledger" not in seen
+
+
+def test_async_outbox_send_is_queued(monkeypatch):
+    monkeypatch.setattr(app, "POSTBACK_ASYNC", True)
+    monkeypatch.setattr(app, "_outbox", object())
+    monkeypatch.setattr(app, "_dedup", object())
+    (body, status), seen = _run((True, ""))
+    assert (body, status) == ({"status": "queued"}, 202)
+    assert seen[-1] == "ledger" and "release" not in seen
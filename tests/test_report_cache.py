@@ -0,0 +1,43 @@
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report_cache import HourBucketCache
+from voluum_reports import hour_window
+
+
+class FakeFetcher:
+    """Én konvertering per time i hver kampagne-bucket."""
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, group_by, start, end):
+        self.calls.append((start, end))
+        return [{"campaignId": "c1", "conversions": 1, "revenue": 10.0}]
+
+
+def test_window_matches_direct_fetch(tmp_path):
+    now = datetime(2026, 1, 1, 12, 30)
+    fetcher = FakeFetcher()
+    cache = HourBucketCache(tmp_path / ".state.db", fetcher=fetcher, settle_hours=1)
+
+    rows = cache.fetch("campaign", hours_back=24, now=now)
+    # Samme vindue som hour_window: 24 hele timer, uden den åbne time
+    assert (fetcher.calls[0][0], fetcher.calls[-1][1]) == hour_window(24, now)
+    assert len(fetcher.calls) == 24
+    assert rows[0]["conversions"] == 24 and rows[0]["revenue"] == 240.0
+
+
+def test_next_tick_refetches_only_unsettled_hours(tmp_path):
+    fetcher = FakeFetcher()
+    cache = HourBucketCache(tmp_path / ".state.db", fetcher=fetcher, settle_hours=2)
+    cache.fetch("campaign", hours_back=24, now=datetime(2026, 1, 1, 12, 30))
+
+    fetcher.calls.clear()
+    rows = cache.fetch("campaign", hours_back=24, now=datetime(2026, 1, 1, 12, 45))
+    assert fetcher.calls == [("2026-01-01T10:00:00.000Z", "2026-01-01T11:00:00.000Z"),
+                             ("2026-01-01T11:00:00.000Z", "2026-01-01T12:00:00.000Z")]
+    assert rows[0]["conversions"] == 24
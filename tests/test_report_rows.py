@@ -0,0 +1,32 @@
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report_rows import _timestamp, report_rows
+
+EPOCH = datetime(2024, 5, 1, 12, 34, 56, tzinfo=timezone.utc).timestamp()
+
+
+def test_voluum_timestamp_format():
+    assert _timestamp("2024-05-01T12:34:56.000Z") == EPOCH
+    assert _timestamp("2024-05-01T12:34:56.250Z") == EPOCH + 0.25
+    assert _timestamp("2024-05-01T12:34:56Z") == EPOCH
+    assert _timestamp(" 2024-05-01T12:34:56.000z ") == EPOCH
+
+
+def test_other_timestamp_forms():
+    assert _timestamp("2024-05-01T12:34:56+00:00") == EPOCH
+    assert _timestamp("2024-05-01T14:34:56.000+02:00") == EPOCH
+    assert _timestamp("2024-05-01T12:34:56") == EPOCH  # Uden zone: UTC
+    assert _timestamp(EPOCH) == EPOCH
+    assert _timestamp(None) == 0.0
+    assert _timestamp("Z") == 0.0
+    assert _timestamp("i går") == 0.0
+
+
+def test_report_row_updated_from_voluum_row():
+    rows = report_rows([{"campaignId": "c1", "updated": "2024-05-01T12:34:56.000Z"},
+                        {"campaignId": "c2", "created": "2024-05-01T12:34:56.000Z"}])
+    assert [row.updated for row in rows] == [EPOCH, EPOCH]
@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from voluum_reports import _ROW_ALIASES, RowStream
+
+BODY = json.dumps({
+    "totalRows": 3,
+    "columnMappings": [{"key": "offerName", "label": "Offer ] }"}],
+    "rows": [
+        {"offerId": "o1", "offerName": "Kasino \"Æblé\" ] } , \\ ☃", "revenue": 12.5,
+         "conversions": 3, "offer": "o1-alias", "nested": {"a": [1, 2, {"b": "]"}]}},
+        {"offerId": "o2", "offerName": "", "revenue": -0.25e-3, "conversions": 0, "campaign": None,
+         "uniqueClicks": 123456789012},
+        {"offerId": "o3", "offerName": "tab\tnewline\n", "revenue": 1E+2, "conversions": 10, "lander": True},
+    ],
+    "messages": ["slut"],
+}, ensure_ascii=False).encode("utf-8")
+
+# Escapes og tal skrevet som Voluum kan sende dem (json.dumps normaliserer dem ellers)
+BODY = BODY.replace(b'"revenue": 12.5', b'"revenue": 1.25e1').replace(b'"slut"', b'"sl\\u00fct \\/ \\""')
+EXPECTED = json.loads(BODY)
+KEEP = frozenset(("offerId", "revenue") + _ROW_ALIASES)
+
+
+def _parse(chunks, keep=None):
+    stream = RowStream(keep)
+    rows = []
+    for chunk in chunks:
+        rows += stream.feed(chunk)
+    rows += stream.close()
+    return rows, stream.meta
+
+
+def test_split_at_every_byte_matches_json_loads():
+    meta = {k: v for k, v in EXPECTED.items() if k != "rows"}
+    for i in range(len(BODY) + 1):
+        assert _parse([BODY[:i], BODY[i:]]) == (EXPECTED["rows"], meta), f"split ved byte {i}"
+
+
+def test_byte_by_byte_matches_json_loads():
+    rows, meta = _parse([BODY[i:i + 1] for i in range(len(BODY))])
+    assert rows == EXPECTED["rows"]
+    assert meta["totalRows"] == 3 and meta["messages"] == EXPECTED["messages"]
+
+
+def test_keep_drops_all_other_columns():
+    expected = [{k: v for k, v in row.items() if k in KEEP} for row in EXPECTED["rows"]]
+    assert expected[0] == {"offerId": "o1", "revenue": 12.5, "offer": "o1-alias"}
+    for i in range(len(BODY) + 1):
+        rows, meta = _parse([BODY[:i], BODY[i:]], keep=KEEP)
+        assert rows == expected, f"split ved byte {i}"
+        assert meta["totalRows"] == 3
@@ -0,0 +1,99 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_scheduler
+from telegram_scheduler import PRIORITY_ALERT, PRIORITY_FTD, TelegramScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(telegram_scheduler, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def _scheduler(**kwargs):
+    sched = TelegramScheduler("token", **kwargs)
+    sched._pid = os.getpid()  # Ingen leveringstråd – testen kalder _pop_ready/_on_response selv
+    return sched
+
+
+def _pop_all(sched):
+    out = []
+    while True:
+        job, _ = sched._pop_ready()
+        if job is None:
+            return out
+        out.append(job.text)
+
+
+def test_ftd_is_sent_before_alerts(clock):
+    sched = _scheduler(global_rate=100, chat_rate=100, burst=10)
+    sched.submit("1", "alert-1", PRIORITY_ALERT)
+    sched.submit("2", "alert-2", PRIORITY_ALERT)
+    sched.submit("1", "ftd-1", PRIORITY_FTD)
+    sched.submit("2", "ftd-2", PRIORITY_FTD)
+    assert _pop_all(sched) == ["ftd-1", "ftd-2", "alert-1", "alert-2"]
+
+
+def test_chat_rate_limit_parks_only_that_chat(clock):
+    sched = _scheduler(global_rate=100, chat_rate=1, group_rate_per_min=20, burst=1)
+    for i in range(3):
+        sched.submit("1", f"a{i}")
+    sched.submit("-100", "group")
+    sched.submit("2", "b0")
+
+    assert _pop_all(sched) == ["a0", "group", "b0"]
+    job, wait = sched._pop_ready()
+    assert job is None and wait == pytest.approx(1.0)
+
+    clock.now += 1.0
+    assert _pop_all(sched) == ["a1"]
+    clock.now += 1.0
+    assert _pop_all(sched) == ["a2"]
+
+    # Grupper: 20/min -> ét token per 3 s efter "group" blev sendt
+    sched.submit("-100", "group-2")
+    assert _pop_all(sched) == []
+    _, wait = sched._pop_ready()
+    assert wait == pytest.approx(1.0)
+    clock.now += 1.0
+    assert _pop_all(sched) == ["group-2"]
+
+
+def test_429_parks_chat_for_retry_after(clock):
+    sched = _scheduler(global_rate=100, chat_rate=100, burst=10)
+    job = sched.submit("1", "ftd")
+    sched.submit("2", "other")
+
+    popped, _ = sched._pop_ready()
+    assert popped is job
+    popped.attempts += 1
+    sched._on_response(popped, 429, {"parameters": {"retry_after": 5}})
+    assert not job.done
+    assert sched.backlog()["blocked_chats"] == {"1": 5.0}
+
+    assert _pop_all(sched) == ["other"]
+    _, wait = sched._pop_ready()
+    assert wait == pytest.approx(5.0)
+
+    clock.now += 5.0
+    popped, _ = sched._pop_ready()
+    assert popped is job
+    popped.attempts += 1
+    sched._on_response(popped, 200, {"ok": True})
+    assert job.done and job.ok and job.attempts == 2
+    assert (sched.sent, sched.rate_limited) == (1, 1)
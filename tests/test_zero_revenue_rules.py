@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timeseries import SeriesStore
+from zero_revenue_rules import ColumnarReport, Rule, RuleEngine
+
+
+def _offers(n):
+    return [{"offerId": f"o{i}", "offerName": f"name{i}", "offerCountry": f"C{i}", "uniqueClicks": 20, "revenue": 0}
+            for i in range(n)]
+
+
+def test_alerts_keep_label_and_country_when_store_is_full():
+    engine = RuleEngine([Rule("zero", "zero_revenue", clicks=10)])
+    series = {"offer": SeriesStore(capacity=4, max_keys=3)}
+    # Første tick fylder storen med de sidste tre offers – o0..o2 er der så ikke plads til
+    engine.evaluate({"offer": ColumnarReport.from_rows(_offers(6)[3:], "offer")}, {}, {}, series, now=900.0)
+
+    report = ColumnarReport.from_rows(_offers(6), "offer")
+    alerts, _ = engine.evaluate({"offer": report}, {}, {}, series, now=1000.0)
+
+    assert len(alerts) == 3
+    for alert in alerts:
+        i = alert.key[1:]
+        assert (alert.label, alert.country) == (f"name{i}", f"C{i}")
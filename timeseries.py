@@ -0,0 +1,293 @@
+"""
+Ring buffer-tidsserier per offer/kampagne
+=========================================
+Gemmer de seneste `capacity` samples (tid, count, revenue) per key i faste NumPy-arrays
+i stedet for ét snapshot i en dict. count er clicks (zero-revenue) eller konverteringer (FTD-poll).
+
+- Fast hukommelse: højst `max_keys` keys x `capacity` samples (24 bytes per sample);
+  længst usete keys smides ud når der mangler plads.
+- Et sample gemmes kun når count eller revenue har ændret sig – uændrede keys koster intet,
+  og ringen dækker `capacity` ændringer i stedet for `capacity` ticks.
+- "Count siden revenue sidst steg" er O(1): tid/count ved seneste stigning gemmes per key,
+  så en tick der ser ny revenue ikke sletter historikken, og en misset tick ikke ødelægger baseline.
+- "Count/revenue de sidste N minutter" er O(log capacity): binær søgning i ringen.
+- Alle operationer tager arrays af rækker, så en hel report opdateres/spørges på én gang.
+- Persisteres per key i .state.db (tabel timeseries_key): save_series skriver kun de keys der
+  har fået et nyt sample, så state-transaktionen ikke vokser med kontoens størrelse. Hver proces
+  cacher sin kopi og henter kun de keys en anden proces har skrevet siden.
+"""
+
+import os
+
+import numpy as np
+
+TIMESERIES_SAMPLES = int(os.getenv("TIMESERIES_SAMPLES", "48"))
+TIMESERIES_MAX_KEYS = int(os.getenv("TIMESERIES_MAX_KEYS", "5000"))
+
+
+class SeriesStore:
+    """(tid, count, revenue)-samples per key i en ring buffer."""
+
+    def __init__(self, capacity: int = TIMESERIES_SAMPLES, max_keys: int = TIMESERIES_MAX_KEYS):
+        self.capacity = max(2, capacity)
+        self.max_keys = max(1, max_keys)
+        self.index = {}  # key -> række
+        self.keys = []  # række -> key (None = ledig)
+        self._free = []
+        rows = min(64, self.max_keys)
+        self.ts = np.zeros((rows, self.capacity), dtype=np.float64)
+        self.count = np.zeros((rows, self.capacity), dtype=np.int64)
+        self.revenue = np.zeros((rows, self.capacity), dtype=np.float64)
+        self.head = np.zeros(rows, dtype=np.int64)  # Næste skriveposition
+        self.size = np.zeros(rows, dtype=np.int64)
+        self.inc_ts = np.zeros(rows, dtype=np.float64)  # Seneste revenue-stigning
+        self.inc_count = np.zeros(rows, dtype=np.int64)
+        self.seen = np.zeros(rows, dtype=np.float64)  # Seneste record() – til LRU-eviction
+        self.dirty = set()  # Rækker ændret siden sidste save
+        self.removed = set()  # Keys smidt ud siden sidste save
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def reserve(self, keys: int):
+        """Hæv max_keys så mindst `keys` keys kan gemmes (fx hele kampagne-reporten i FTD-diffen)."""
+        self.max_keys = max(self.max_keys, keys)
+
+    # --- Rækker ---------------------------------------------------------------
+
+    def _grow(self, rows: int):
+        old = len(self.head)
+        if rows <= old:
+            return
+        pad = rows - old
+        self.ts = np.vstack([self.ts, np.zeros((pad, self.capacity), dtype=np.float64)])
+        self.count = np.vstack([self.count, np.zeros((pad, self.capacity), dtype=np.int64)])
+        self.revenue = np.vstack([self.revenue, np.zeros((pad, self.capacity), dtype=np.float64)])
+        for name in ("head", "size", "inc_ts", "inc_count", "seen"):
+            arr = getattr(self, name)
+            setattr(self, name, np.concatenate([arr, np.zeros(pad, dtype=arr.dtype)]))
+
+    def _evict(self, n: int, keep: set):
+        """Frigør n rækker: de længst usete (og som ikke er i denne batch)."""
+        used = np.array([r for k, r in self.index.items() if k not in keep], dtype=np.int64)
+        if not len(used):
+            return
+        n = min(n, len(used))
+        for row in used[np.argpartition(self.seen[used], n - 1)[:n]].tolist():
+            key = self.keys[row]
+            del self.index[key]
+            self.removed.add(key)
+            self.dirty.discard(row)
+            self.keys[row] = None
+            self.size[row] = 0
+            self.head[row] = 0
+            self._free.append(row)
+        self.evictions += n
+
+    def rows(self, keys: list, create: bool = True) -> tuple:
+        """Række per key som array + maske for keys der er nye. Ukendte keys = -1 hvis create=False."""
+        missing = [k for k in keys if k not in self.index] if create else []
+        if missing:
+            need = len(missing) - len(self._free) - (self.max_keys - len(self.keys))
+            if need > 0:
+                self._evict(need, set(keys))
+            grow_to = min(self.max_keys, len(self.keys) + max(0, len(missing) - len(self._free)))
+            if grow_to > len(self.head):
+                self._grow(min(self.max_keys, max(grow_to, 2 * len(self.head))))
+            for key in missing[:len(self._free) + self.max_keys - len(self.keys)]:
+                if self._free:
+                    row = self._free.pop()
+                    self.keys[row] = key
+                else:
+                    row = len(self.keys)
+                    self.keys.append(key)
+                self.index[key] = row
+                self.removed.discard(key)
+        get = self.index.get
+        out = np.fromiter((get(k, -1) for k in keys), dtype=np.int64, count=len(keys))
+        new = np.zeros(len(keys), dtype=bool)
+        if missing:
+            new[out >= 0] = self.size[out[out >= 0]] == 0
+        return out, new
+
+    # --- Skriv ----------------------------------------------------------------
+
+    def record(self, keys: list, now: float, count, revenue) -> np.ndarray:
+        """Registrér totaler (for i dag/vinduet) per key. Nyt sample kun for nye keys og ændrede værdier.
+
+        Returnerer rækkerne i samme rækkefølge som keys; -1 for keys der ikke var plads til.
+        """
+        all_rows, new = self.rows(keys)
+        rows = all_rows
+        count = np.asarray(count, dtype=np.int64)
+        revenue = np.asarray(revenue, dtype=np.float64)
+        if (rows < 0).any():  # Flere keys end max_keys i én batch
+            ok = rows >= 0
+            rows, new, count, revenue = rows[ok], new[ok], count[ok], revenue[ok]
+        _, prev_count, prev_rev = self.last(rows)
+        self.seen[rows] = now
+        # Ny key, ny dag (totaler faldet) eller ny revenue -> baseline flyttes hertil
+        moved = new | (revenue > prev_rev) | (revenue < prev_rev) | (count < prev_count)
+        changed = moved | (count != prev_count)
+        rows, count, revenue, moved = rows[changed], count[changed], revenue[changed], moved[changed]
+        pos = self.head[rows]
+        self.ts[rows, pos] = now
+        self.count[rows, pos] = count
+        self.revenue[rows, pos] = revenue
+        self.head[rows] = (pos + 1) % self.capacity
+        self.size[rows] = np.minimum(self.size[rows] + 1, self.capacity)
+        self.inc_ts[rows[moved]] = now
+        self.inc_count[rows[moved]] = count[moved]
+        self.dirty.update(rows.tolist())
+        return all_rows
+
+    def clear(self):
+        removed = self.removed | set(self.index)  # Skal også slettes i .state.db ved næste save
+        self.__init__(self.capacity, self.max_keys)
+        self.removed = removed
+
+    # --- Læs ------------------------------------------------------------------
+
+    def last(self, rows: np.ndarray) -> tuple:
+        """(tid, count, revenue) for seneste sample. NaN/0 for rækker uden samples."""
+        pos = (self.head[rows] - 1) % self.capacity
+        empty = self.size[rows] == 0
+        ts = np.where(empty, np.nan, self.ts[rows, pos])
+        return ts, np.where(empty, 0, self.count[rows, pos]), np.where(empty, np.nan, self.revenue[rows, pos])
+
+    def latest(self, keys: list) -> tuple:
+        """(count, revenue) fra seneste sample per key; 0 for ukendte keys."""
+        rows, _ = self.rows(keys, create=False)
+        known = rows >= 0
+        _, count, revenue = self.last(np.where(known, rows, 0))
+        return np.where(known, count, 0), np.where(known, np.nan_to_num(revenue), 0.0)
+
+    def since_increase(self, rows: np.ndarray, now: float = None) -> tuple:
+        """(count siden revenue sidst steg, sekunder siden) – O(1) per række."""
+        _, count, _ = self.last(rows)
+        since = count - self.inc_count[rows]
+        seconds = (now - self.inc_ts[rows]) if now is not None else None
+        return since, seconds
+
+    def _search(self, rows: np.ndarray, cutoff: float) -> np.ndarray:
+        """Logisk index (0 = ældste) for nyeste sample med tid <= cutoff, -1 hvis ingen. Binær søgning."""
+        size = self.size[rows]
+        start = self.head[rows] - size
+        lo = np.full(len(rows), -1, dtype=np.int64)  # Sidste index kendt <= cutoff
+        hi = size.copy()  # Første index kendt > cutoff
+        while True:
+            active = hi - lo > 1
+            if not active.any():
+                return lo
+            mid = (lo + hi) // 2
+            mid_ts = self.ts[rows, (start + np.where(active, mid, 0)) % self.capacity]
+            below = active & (mid_ts <= cutoff)
+            lo = np.where(below, mid, lo)
+            hi = np.where(active & ~below, mid, hi)
+
+    def delta_since(self, rows: np.ndarray, seconds: float, now: float) -> tuple:
+        """(count, revenue) i de sidste `seconds` sekunder – eller siden ældste sample hvis historikken er kortere."""
+        _, count, revenue = self.last(rows)
+        idx = np.maximum(self._search(rows, now - seconds), 0)
+        pos = (self.head[rows] - self.size[rows] + idx) % self.capacity
+        base_count = self.count[rows, pos]
+        base_rev = self.revenue[rows, pos]
+        # Totalerne er nulstillet i vinduet (ny dag): så er alt siden nulstillingen nyt
+        reset = (base_count > count) | (base_rev > revenue)
+        return (np.where(reset, count, count - base_count),
+                np.where(reset, revenue, revenue - base_rev))
+
+    # --- Persistens -----------------------------------------------------------
+
+    def _pack(self, row: int) -> bytes:
+        """Én keys samples (ældste først) + baseline som rå bytes."""
+        size = int(self.size[row])
+        order = (self.head[row] - size + np.arange(size)) % self.capacity
+        header = np.array([size, self.inc_ts[row], self.inc_count[row], self.seen[row]], dtype=np.float64)
+        return b"".join((header.tobytes(), self.ts[row, order].tobytes(), self.count[row, order].tobytes(),
+                         self.revenue[row, order].tobytes()))
+
+    def take_changes(self) -> tuple:
+        """([(key, data)] for ændrede keys, [fjernede keys]) siden sidste kald."""
+        upserts = [(self.keys[row], self._pack(row)) for row in sorted(self.dirty)]
+        removed = sorted(self.removed)
+        self.dirty.clear()
+        self.removed.clear()
+        return upserts, removed
+
+    def apply(self, changes: list):
+        """Indlæs keys skrevet af save_series (evt. fra en anden proces). Tæller ikke som ændringer."""
+        if not changes:
+            return
+        rows, _ = self.rows([key for key, _ in changes])
+        for row, (key, data) in zip(rows.tolist(), changes):
+            if row < 0:
+                continue
+            header = np.frombuffer(data, dtype=np.float64, count=4)
+            saved = int(header[0])
+            take = min(saved, self.capacity)
+            skip = saved - take  # Kapaciteten kan være ændret siden: behold de nyeste samples
+            offset = 32
+            for name, dtype in (("ts", np.float64), ("count", np.int64), ("revenue", np.float64)):
+                values = np.frombuffer(data, dtype=dtype, count=saved, offset=offset)
+                getattr(self, name)[row, :take] = values[skip:]
+                offset += saved * 8
+            self.size[row] = take
+            self.head[row] = take % self.capacity
+            self.inc_ts[row] = header[1]
+            self.inc_count[row] = int(header[2])
+            self.seen[row] = header[3]
+        self.dirty.clear()
+        self.removed.clear()
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self.index),
+            "capacity": self.capacity,
+            "max_keys": self.max_keys,
+            "bytes": self.ts.nbytes + self.count.nbytes + self.revenue.nbytes,
+            "evictions": self.evictions,
+        }
+
+
+# Per proces: navn -> (version i .state.db, SeriesStore)
+_cache = {}
+
+
+def load_series(tx, name: str, max_keys: int = None) -> SeriesStore:
+    """Hent serien inden for state-transaktionen (genbruger proces-kopien hvis den er aktuel).
+
+    Kopien tages ud af cachen indtil save_series(), så en tick der fejler ikke efterlader
+    en halvt opdateret serie i processen. max_keys: mindst så mange keys (standard TIMESERIES_MAX_KEYS).
+    """
+    max_keys = max(max_keys or 0, TIMESERIES_MAX_KEYS)
+    version, cached = _cache.pop(name, (None, None))
+    head = tx.series_head(name)
+    if head is None:
+        return SeriesStore(max_keys=max_keys)
+    current, created = head
+    if cached is not None and version is not None and created <= version <= current:
+        # Kun de keys andre processer har skrevet siden vores kopi
+        cached.reserve(max_keys)
+        if version < current:
+            cached.apply(tx.load_series_rows(name, version))
+        return cached
+    store = SeriesStore(max_keys=max_keys)
+    store.apply(tx.load_series_rows(name))
+    return store
+
+
+def save_series(tx, name: str, store: SeriesStore):
+    """Skriv de keys der er ændret siden sidst (O(ændringer), ikke O(keys))."""
+    upserts, removed = store.take_changes()
+    if upserts or removed:
+        version = tx.save_series_rows(name, upserts, removed)
+    else:
+        head = tx.series_head(name)
+        version = head[0] if head else None
+    _cache[name] = (version, store)
+
+
+def series_stats() -> dict:
+    return {name: store.stats() for name, (_, store) in _cache.items()}
@@ -0,0 +1,229 @@
+"""
+Tracing af postbacks
+====================
+Let vægt spans per trin i en postback (normalize, revenue, dedup, forward, format, telegram),
+så man kan se hvilket trin/upstream der giver den lange hale i latency.
+
+- De seneste TRACE_BUFFER_SIZE traces per worker ligger i en ring buffer (deque med maxlen).
+- Hver worker skriver sin buffer til .state.db (tabel trace_buffer) hvert TRACE_FLUSH_SECONDS,
+  når der er nye traces; /diagnose fletter alle workers sammen (nyeste først).
+- Sampling: TRACE_SAMPLE_RATE (0-1) afgør ved start om en request traces. Uden trace er
+  span() en no-op, så omkostningen under høj last kan skrues ned.
+- Aktuel trace følger konteksten (contextvars), så det virker i Flask-tråde, baggrundskøen
+  og ASGI-coroutines.
+"""
+
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+
+from outbox import connect
+
+logger = logging.getLogger(__name__)
+
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "5"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trace_buffer (
+    owner TEXT PRIMARY KEY,
+    updated REAL NOT NULL,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+_current = ContextVar("trace", default=None)
+_NOOP = nullcontext()
+
+
+class Trace:
+    __slots__ = ("id", "kind", "at", "started", "total_ms", "status", "reason", "message", "spans", "attrs",
+                 "stored")
+
+    def __init__(self, kind: str, attrs: dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.at = datetime.utcnow().isoformat()
+        self.started = time.perf_counter()
+        self.total_ms = None
+        self.status = None
+        self.reason = ""
+        self.message = None
+        self.spans = []
+        self.attrs = attrs
+        self.stored = False
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "at": self.at,
+            "status": self.status,
+            "reason": self.reason,
+            "message": self.message,
+            "total_ms": self.total_ms,
+            "spans": dict(self.spans),
+            **self.attrs,
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "started")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.spans.append((self.name, round((time.perf_counter() - self.started) * 1000, 3)))
+        if self.trace.stored:
+            buffer.touch()  # Fx forward fra baggrundskøen efter svaret er sendt
+        return False
+
+
+class TraceBuffer:
+    """Ring buffer af færdige traces for denne proces + fletning på tværs af processer."""
+
+    def __init__(self, path: Path, size: int = 200, flush_interval: float = 5):
+        self.path = path
+        self.size = size
+        self.flush_interval = flush_interval
+        self.traces = deque(maxlen=size)
+        self._dirty = False
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    @property
+    def owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, trace: Trace):
+        self.traces.append(trace)
+        self._dirty = True
+
+    def touch(self):
+        """En trace i bufferen er ændret (fx leveret fra baggrundskøen)."""
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        data = json.dumps([t.to_dict() for t in list(self.traces)])
+        try:
+            self._conn().execute("INSERT OR REPLACE INTO trace_buffer (owner, updated, data) VALUES (?, ?, ?)",
+                                 (self.owner, time.time(), data))
+        except sqlite3.Error as e:
+            self._dirty = True
+            logger.error(f"Trace flush fejl: {e}")
+
+    def ensure_started(self):
+        """Start flush-tråden i denne proces (fork-sikkert)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                self.traces.clear()  # Forælderens traces hører til forælderen
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="trace-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def recent(self, status: str = None, limit: int = 50, max_age: float = 24 * 3600) -> list:
+        """Nyeste traces fra alle workers (evt. kun med `status`)."""
+        self.flush()
+        out = []
+        rows = self._conn().execute("SELECT owner, data FROM trace_buffer WHERE updated >= ?",
+                                    (time.time() - max_age,)).fetchall()
+        for owner, data in rows:
+            try:
+                traces = json.loads(data)
+            except ValueError:
+                continue
+            for t in traces:
+                if status and t.get("status") != status:
+                    continue
+                t["worker"] = owner
+                out.append(t)
+        out.sort(key=lambda t: t["at"], reverse=True)
+        return out[:limit]
+
+
+buffer = TraceBuffer(Path(__file__).parent / ".state.db", size=TRACE_BUFFER_SIZE, flush_interval=TRACE_FLUSH_SECONDS)
+
+
+def start(kind: str, **attrs):
+    """Start en trace for denne request (None hvis den ikke samples) og gør den aktuel."""
+    trace = Trace(kind, attrs) if TRACE_SAMPLE_RATE >= 1 or random.random() < TRACE_SAMPLE_RATE else None
+    _current.set(trace)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def use(trace):
+    """Gør `trace` aktuel (fx i baggrundskøen der leverer en postback)."""
+    _current.set(trace)
+
+
+def span(name: str):
+    """with span("forward"): ... – tid for trinnet i den aktuelle trace (no-op uden trace)."""
+    trace = _current.get()
+    return _NOOP if trace is None else _Span(trace, name)
+
+
+def annotate(**attrs):
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def finish(status: str, reason: str = "", message=None):
+    """Sæt udfald og samlet tid. Kan kaldes igen når baggrundskøen har leveret."""
+    trace = _current.get()
+    if trace is None:
+        return
+    trace.status = status
+    trace.reason = reason
+    trace.message = message if message is None or isinstance(message, (str, int, float)) else str(message)
+    trace.total_ms = round((time.perf_counter() - trace.started) * 1000, 3)
+    if trace.stored:
+        buffer.touch()
+    else:
+        trace.stored = True
+        buffer.add(trace)
@@ -0,0 +1,233 @@
+"""
+Delt Voluum session-token
+=========================
+Cacher Voluum session-token med udløbstid, så app.py, voluum_poll.py og
+send_latest.py ikke logger ind ved hvert kald.
+
+- Token genbruges indtil kort før udløb og fornyes i baggrunden.
+- Single-flight: samtidige kald venter på ét login i stedet for at logge ind hver især.
+- request() logger automatisk ind igen og gentager én gang ved 401.
+- Token gemmes i .voluum_token.json, så gunicorn-workers og scripts deler det.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+import http_clients
+import metrics
+
+logger = logging.getLogger(__name__)
+
+VOLUUM_API_BASE = os.getenv("VOLUUM_API_BASE", "https://api.voluum.com").rstrip("/")
+AUTH_URL = f"{VOLUUM_API_BASE}/auth/session"
+TOKEN_FILE = Path(__file__).parent / ".voluum_token.json"
+
+
+class VoluumTokenManager:
+    """Thread-safe cache af Voluum session-token."""
+
+    def __init__(self, email=None, password=None, access_key_id=None, access_key_secret=None,
+                 refresh_margin: float = 300, default_ttl: float = 3600, token_file: Path = None,
+                 background_refresh: bool = True):
+        self.email = email
+        self.password = password
+        self.access_key_id = access_key_id
+        self.access_key_secret = access_key_secret
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.token_file = token_file
+        self.background_refresh = background_refresh
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()          # beskytter _token/_expires_at
+        self._login_lock = threading.Lock()    # single-flight login
+        self._refresher_pid = None
+        self._wake = threading.Event()
+        self.logins = 0
+        self._load_file()
+
+    def has_credentials(self) -> bool:
+        return bool((self.access_key_id and self.access_key_secret) or (self.email and self.password))
+
+    def _auth_payload(self) -> dict:
+        # Access key foretrækkes (som i voluum_poll.py)
+        if self.access_key_id and self.access_key_secret:
+            return {"accessKeyId": self.access_key_id, "accessKeySecret": self.access_key_secret}
+        return {"email": self.email, "password": self.password}
+
+    def _valid_token(self, margin: float = 0):
+        with self._lock:
+            if self._token and time.time() < self._expires_at - margin:
+                return self._token
+        return None
+
+    def _set_token(self, token: str, expires_at: float):
+        with self._lock:
+            self._token = token
+            self._expires_at = expires_at
+        self._wake.set()
+
+    def _load_file(self):
+        if not self.token_file or not self.token_file.exists():
+            return
+        try:
+            data = json.loads(self.token_file.read_text())
+            if data.get("token") and float(data.get("expires_at", 0)) > time.time():
+                self._set_token(data["token"], float(data["expires_at"]))
+        except Exception:
+            pass
+
+    def _save_file(self, token: str, expires_at: float):
+        if not self.token_file:
+            return
+        try:
+            tmp = self.token_file.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps({"token": token, "expires_at": expires_at}))
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.token_file)
+        except Exception as e:
+            logger.warning(f"Kunne ikke gemme Voluum token: {e}")
+
+    def _parse_expiry(self, data: dict) -> float:
+        exp = data.get("expirationTimestamp")
+        if exp:
+            try:
+                return datetime.fromisoformat(str(exp).replace("Z", "+00:00")).timestamp()
+            except ValueError:
+                pass
+        return time.time() + self.default_ttl
+
+    def _login(self) -> str:
+        """Log ind hos Voluum. Kaldes kun med _login_lock holdt."""
+        # En anden worker/proces kan have fornyet token imens – tjek filen først
+        self._load_file()
+        token = self._valid_token(self.refresh_margin)
+        if token:
+            return token
+        try:
+            with metrics.stage("voluum_auth"):
+                r = http_clients.get_client("voluum").post(AUTH_URL, json=self._auth_payload(),
+                                                           headers={"Content-Type": "application/json"}, timeout=15)
+            r.raise_for_status()
+            data = r.json()
+        except requests.RequestException as e:
+            logger.error(f"Voluum auth fejl: {e}")
+            raise
+        token = data.get("token")
+        if not token:
+            raise requests.RequestException("Voluum auth svar uden token")
+        expires_at = self._parse_expiry(data)
+        self._set_token(token, expires_at)
+        self._save_file(token, expires_at)
+        self.logins += 1
+        logger.info("Voluum token hentet")
+        return token
+
+    def get_token(self) -> str:
+        """Returnér gyldigt token – logger kun ind hvis det mangler eller er udløbet.
+
+        Rejser requests.RequestException hvis login fejler.
+        """
+        if self.background_refresh:
+            self._ensure_refresher()
+        token = self._valid_token()
+        if token:
+            return token
+        with self._login_lock:
+            token = self._valid_token()
+            if token:
+                return token
+            return self._login()
+
+    def peek_token(self):
+        """Gyldigt token fra cachen uden at logge ind (None hvis get_token() skal logge ind)."""
+        return self._valid_token()
+
+    def invalidate(self, token: str):
+        """Glem token (fx efter 401) – kun hvis det stadig er det aktuelle."""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0.0
+        if self.token_file and self.token_file.exists():
+            try:
+                if json.loads(self.token_file.read_text()).get("token") == token:
+                    self.token_file.unlink()
+            except Exception:
+                pass
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """HTTP-kald mod Voluum med cwauth-token. Ved 401 logges ind igen og kaldet gentages én gang."""
+        headers = dict(kwargs.pop("headers", None) or {})
+        token = self.get_token()
+        headers["cwauth-token"] = token
+        client = http_clients.get_client("voluum")
+        r = client.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 401:
+            logger.info("Voluum 401 - fornyer token")
+            r.close()  # Frigiv forbindelsen (stream=True læser ikke body)
+            self.invalidate(token)
+            headers["cwauth-token"] = self.get_token()
+            r = client.request(method, url, headers=headers, **kwargs)
+        return r
+
+    def _ensure_refresher(self):
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        threading.Thread(target=self._refresh_loop, name="voluum-token-refresh", daemon=True).start()
+
+    def _refresh_loop(self):
+        """Forny token i baggrunden refresh_margin sekunder før udløb."""
+        while True:
+            with self._lock:
+                expires_at = self._expires_at
+            if not expires_at:
+                # Intet token endnu – vent til første get_token() har logget ind
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            delay = expires_at - self.refresh_margin - time.time()
+            if delay > 0:
+                self._wake.clear()
+                if self._wake.wait(delay):
+                    continue  # Nyt token sat – beregn ny ventetid
+            try:
+                with self._login_lock:
+                    if not self._valid_token(self.refresh_margin):
+                        self._login()
+            except Exception:
+                time.sleep(30)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_token_manager() -> VoluumTokenManager:
+    """Delt token manager for processen – konfigureres fra .env ved første kald."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = VoluumTokenManager(
+                    email=os.getenv("VOLUUM_EMAIL"),
+                    password=os.getenv("VOLUUM_PASSWORD"),
+                    access_key_id=os.getenv("VOLUUM_ACCESS_KEY_ID"),
+                    access_key_secret=os.getenv("VOLUUM_ACCESS_KEY_SECRET"),
+                    refresh_margin=float(os.getenv("VOLUUM_TOKEN_REFRESH_MARGIN", "300")),
+                    default_ttl=float(os.getenv("VOLUUM_TOKEN_TTL", "3600")),
+                    token_file=TOKEN_FILE,
+                    background_refresh=os.getenv("VOLUUM_TOKEN_BACKGROUND_REFRESH", "true").lower() == "true",
+                )
+    return _manager
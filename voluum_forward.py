@@ -0,0 +1,384 @@
+"""
+Voluum forward med kø, circuit breaker og persistent retry
+==========================================================
+/postback videresender konverteringen til VOLUUM_FORWARD_URL. Det sker ikke længere inline:
+
+- submit() lægger forwarden i en bounded kø med egen worker-pulje (FORWARD_WORKERS,
+  FORWARD_QUEUE_SIZE). Er køen fuld, gemmes forwarden direkte til retry – postbacken venter aldrig.
+- Circuit breaker: efter FORWARD_BREAKER_FAILURES fejl (timeout, 5xx/429 eller svar langsommere end
+  FORWARD_BREAKER_SLOW_SECONDS) i træk åbner den i FORWARD_BREAKER_OPEN_SECONDS. Imens sendes intet
+  – forwards gemmes til retry. Derefter half-open: én probe ad gangen; lykkes den, lukker breakeren,
+  ellers åbner den igen med dobbelt så lang pause (højst 10 min).
+- Fejlede forwards gemmes i .state.db (tabel forward_retry) og prøves igen med eksponentiel backoff
+  (også efter genstart), så Voluum stadig får alle konverteringer. Rækker claimes med en lease,
+  så flere workers ikke sender samme forward. Efter FORWARD_MAX_ATTEMPTS forsøg markeres de "dead".
+- 4xx (undtagen 429) prøves ikke igen – requesten bliver ikke bedre af at blive gentaget.
+
+Breakeren er per proces; tilstanden ses i / (health) og /diagnose.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+import http_clients
+import metrics
+import tracing
+from outbox import connect
+from workqueue import WorkQueue
+
+logger = logging.getLogger(__name__)
+
+FORWARD_WORKERS = int(os.getenv("FORWARD_WORKERS", "4"))
+FORWARD_QUEUE_SIZE = int(os.getenv("FORWARD_QUEUE_SIZE", "1000"))
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", "10"))
+FORWARD_BREAKER_FAILURES = int(os.getenv("FORWARD_BREAKER_FAILURES", "5"))
+FORWARD_BREAKER_SLOW_SECONDS = float(os.getenv("FORWARD_BREAKER_SLOW_SECONDS", "3"))
+FORWARD_BREAKER_OPEN_SECONDS = float(os.getenv("FORWARD_BREAKER_OPEN_SECONDS", "30"))
+FORWARD_MAX_ATTEMPTS = int(os.getenv("FORWARD_MAX_ATTEMPTS", "50"))
+
+STATUS_PENDING = "pending"
+STATUS_SENDING = "sending"
+STATUS_DEAD = "dead"
+
+BREAKER_OPEN = "breaker åben"
+QUEUE_FULL = "forward-kø fuld"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS forward_retry (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS forward_retry_due ON forward_retry (status, next_attempt_at);
+"""
+
+
+class CircuitBreaker:
+    """closed -> open (efter N fejl i træk) -> half_open (én probe) -> closed/open."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, slow_seconds: float = 3, open_seconds: float = 30,
+                 max_open_seconds: float = 600):
+        self.failure_threshold = max(1, failure_threshold)
+        self.slow_seconds = slow_seconds
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_seconds = open_seconds
+        self._open_until = 0.0
+        self._probing = False
+        self.opened_at = None
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Må der sendes nu? I half_open får kun én kalder lov (proben)."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self._open_until:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok: bool, seconds: float):
+        """Resultat af et kald der fik lov af allow(). Langsomme svar tæller som fejl."""
+        success = ok and seconds <= self.slow_seconds
+        with self._lock:
+            was_probe = self.state == self.HALF_OPEN
+            self._probing = False
+            if success:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    logger.info("Voluum forward breaker lukket igen")
+                self.state = self.CLOSED
+                self.open_seconds = self.base_open_seconds
+                return
+            self.failures += 1
+            if was_probe or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                if was_probe:
+                    self.open_seconds = min(self.max_open_seconds, self.open_seconds * 2)
+                self.state = self.OPEN
+                self._open_until = time.monotonic() + self.open_seconds
+                self.opened_at = time.time()
+                self.opens += 1
+                logger.warning(f"Voluum forward breaker åben i {self.open_seconds:.0f}s "
+                               f"({self.failures} fejl/langsomme svar i træk)")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "open_seconds": self.open_seconds,
+                "retry_in": round(max(0.0, self._open_until - time.monotonic()), 1) if self.state == self.OPEN else 0,
+                "opened_at": self.opened_at,
+                "opens": self.opens,
+                "rejected": self.rejected,
+            }
+
+
+class VoluumForwarder:
+    """Kø + worker-pulje + breaker + persistent retry for forwards til `url`/postback."""
+
+    def __init__(self, url: str, path: Path, workers: int = 4, queue_size: int = 1000, timeout: float = 10,
+                 breaker: CircuitBreaker = None, max_attempts: int = 50, base_backoff: float = 10,
+                 max_backoff: float = 900, lease_seconds: float = 120, retry_batch: int = 20):
+        self.url = url.rstrip("/")
+        self.path = path
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self.retry_batch = retry_batch
+        self._queue = WorkQueue("forward", self._handle, workers=workers, maxsize=queue_size)
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._wake = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.persisted = 0
+        self.retried = 0
+        conn = connect(path)
+        conn.executescript(_SCHEMA)
+        conn.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def ensure_started(self):
+        """Start retry-tråden i denne proces (fork-sikkert)."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._retry_loop, name="forward-retry", daemon=True).start()
+
+    # --- Hot path -------------------------------------------------------------
+
+    def submit(self, fwd: dict):
+        """Læg forwarden i køen (blokerer aldrig). Fuld kø -> direkte til retry-tabellen."""
+        self.ensure_started()
+        if not self._queue.submit({"forward": fwd, "trace": tracing.current()}):
+            self.persist(fwd, QUEUE_FULL)
+
+    def submit_many(self, fwds: list):
+        """submit() for en batch: workerne sender samtidigt, overløb gemmes til retry i én transaktion."""
+        self.ensure_started()
+        trace = tracing.current()
+        overflow = [fwd for fwd in fwds if not self._queue.submit({"forward": fwd, "trace": trace})]
+        if overflow:
+            self.persist_many(overflow, QUEUE_FULL)
+
+    def _handle(self, job: dict):
+        tracing.use(job.get("trace"))
+        self.send(job["forward"])
+
+    # --- Afsendelse -----------------------------------------------------------
+
+    def request_kwargs(self, fwd: dict) -> dict:
+        kwargs = {"params": fwd["args"]}
+        if fwd["method"] != "GET":
+            kwargs.update(data=fwd["form"] or None, json=fwd["json"])
+        return {"method": fwd["method"], "url": f"{self.url}/postback", **kwargs}
+
+    def settle(self, code, seconds: float, error: str = None) -> bool:
+        """Registrér et forsøg i breaker og tællere. True hvis forwarden skal prøves igen senere."""
+        retry = code is None or code >= 500 or code == 429
+        self.breaker.record(not retry, seconds)
+        if retry:
+            self.failed += 1
+            logger.error(f"Voluum forward fejl: {error or code}")
+        else:
+            self.sent += 1
+            if code >= 400:
+                logger.warning(f"Voluum forward afvist med {code} - prøves ikke igen")
+            else:
+                logger.info(f"Forwarded to Voluum: {code}")
+        return retry
+
+    def attempt(self, fwd: dict) -> tuple:
+        """Ét forsøg hvis breakeren tillader det. Returnerer (leveret, fejlbesked)."""
+        if not self.breaker.allow():
+            return False, BREAKER_OPEN
+        started = time.perf_counter()
+        code, error = None, None
+        try:
+            with metrics.stage("voluum_forward"), tracing.span("forward"):
+                code = http_clients.get_client("forward").request(timeout=self.timeout,
+                                                                  **self.request_kwargs(fwd)).status_code
+        except requests.RequestException as e:
+            error = str(e)
+        retry = self.settle(code, time.perf_counter() - started, error)
+        return not retry, error or (str(code) if retry else None)
+
+    def send(self, fwd: dict):
+        ok, error = self.attempt(fwd)
+        if not ok:
+            self.persist(fwd, error)
+
+    # --- Persistent retry ---------------------------------------------------
+
+    def persist(self, fwd: dict, error: str):
+        self.persist_many([fwd], error)
+
+    def persist_many(self, fwds: list, error: str):
+        now = time.time()
+        # Ikke sendt endnu (breaker åben / kø fuld) -> retry-tråden tager dem med det samme
+        delay = 0 if error in (BREAKER_OPEN, QUEUE_FULL) else self.base_backoff
+        try:
+            self._conn().executemany(
+                "INSERT INTO forward_retry (request, created_at, next_attempt_at, last_error) VALUES (?, ?, ?, ?)",
+                [(json.dumps(fwd), now, now + delay, error) for fwd in fwds])
+            self.persisted += len(fwds)
+        except sqlite3.Error as e:
+            logger.error(f"Forward retry kunne ikke gemmes - {len(fwds)} konverteringer går tabt: {e}")
+
+    def _claim_due(self, limit: int) -> list:
+        conn = self._conn()
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, request, attempts FROM forward_retry "
+                "WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_until < ?) "
+                "ORDER BY id LIMIT ?", (STATUS_PENDING, now, STATUS_SENDING, now, limit)).fetchall()
+            if rows:
+                conn.executemany("UPDATE forward_retry SET status = ?, lease_until = ? WHERE id = ?",
+                                 [(STATUS_SENDING, now + self.lease_seconds, r[0]) for r in rows])
+            conn.execute("COMMIT")
+            return rows
+        except sqlite3.Error as e:
+            logger.error(f"Forward retry claim fejl: {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            return []
+
+    def _release(self, ids: list):
+        """Giv claimede rækker tilbage uden at tælle et forsøg (breakeren lukkede for os)."""
+        if ids:
+            self._conn().executemany("UPDATE forward_retry SET status = ?, lease_until = 0 WHERE id = ?",
+                                     [(STATUS_PENDING, i) for i in ids])
+
+    def _mark_failed(self, row_id: int, attempts: int, error: str):
+        attempts += 1
+        conn = self._conn()
+        if attempts >= self.max_attempts:
+            conn.execute("UPDATE forward_retry SET status = ?, attempts = ?, last_error = ? WHERE id = ?",
+                         (STATUS_DEAD, attempts, error, row_id))
+            logger.error(f"Voluum forward {row_id} opgivet efter {attempts} forsøg: {error}")
+            return
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1))
+        conn.execute("UPDATE forward_retry SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?, "
+                     "lease_until = 0 WHERE id = ?", (STATUS_PENDING, attempts, error, time.time() + delay, row_id))
+
+    def retry_due(self) -> int:
+        """Prøv forfaldne forwards igen (stopper når breakeren åbner). Returnerer antal leveret."""
+        delivered = 0
+        rows = self._claim_due(self.retry_batch)
+        for i, (row_id, request, attempts) in enumerate(rows):
+            try:
+                fwd = json.loads(request)
+            except ValueError:
+                self._mark_failed(row_id, self.max_attempts, "ugyldig request")
+                continue
+            ok, error = self.attempt(fwd)
+            if ok:
+                self._conn().execute("DELETE FROM forward_retry WHERE id = ?", (row_id,))
+                delivered += 1
+                self.retried += 1
+            elif error == BREAKER_OPEN:
+                self._release([r[0] for r in rows[i:]])
+                break
+            else:
+                self._mark_failed(row_id, attempts, error)
+        return delivered
+
+    def _retry_loop(self):
+        while True:
+            try:
+                if self.breaker.stats()["retry_in"] <= 0:  # Ingen grund til at claime mens breakeren er åben
+                    if self.retry_due():
+                        continue  # Flere kan være klar – ingen pause mens vi indhenter
+            except sqlite3.Error as e:
+                logger.error(f"Forward retry fejl: {e}")
+            self._wake.wait(2.0)
+            self._wake.clear()
+
+    # --- Status ---------------------------------------------------------------
+
+    def counts(self) -> dict:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM forward_retry GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+    def health(self) -> dict:
+        """Kort status til / (health check)."""
+        breaker = self.breaker.stats()
+        return {"breaker": breaker["state"], "retry_in": breaker["retry_in"], "queued": self._queue.depth(),
+                "retry_pending": self.counts().get(STATUS_PENDING, 0)}
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.stats(),
+            "queue": self._queue.stats(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "persisted": self.persisted,
+            "retried": self.retried,
+            "retry_backlog": self.counts(),
+        }
+
+
+_forwarder = None
+_forwarder_lock = threading.Lock()
+
+
+def get_forwarder():
+    """Delt forwarder for VOLUUM_FORWARD_URL (None hvis den ikke er sat)."""
+    global _forwarder
+    url = os.getenv("VOLUUM_FORWARD_URL", "").rstrip("/")
+    if not url:
+        return None
+    if _forwarder is None:
+        with _forwarder_lock:
+            if _forwarder is None:
+                _forwarder = VoluumForwarder(
+                    url, Path(__file__).parent / ".state.db",
+                    workers=FORWARD_WORKERS, queue_size=FORWARD_QUEUE_SIZE, timeout=FORWARD_TIMEOUT,
+                    breaker=CircuitBreaker(FORWARD_BREAKER_FAILURES, FORWARD_BREAKER_SLOW_SECONDS,
+                                           FORWARD_BREAKER_OPEN_SECONDS),
+                    max_attempts=FORWARD_MAX_ATTEMPTS)
+    return _forwarder
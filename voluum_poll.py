@@ -9,15 +9,21 @@ Brug: python3 voluum_poll.py
 
 import os
 import time
-import json
 import logging
-from datetime import datetime, timedelta
-from pathlib import Path
+from datetime import datetime
 
 import requests
 from dotenv import load_dotenv
 
-load_dotenv()
+load_dotenv()  # Før de lokale moduler, der læser deres config ved import
+
+from report_cache import get_report_cache, get_report_ttl_cache
+from report_rows import ReportRow, report_rows
+from state_store import SCOPE_VOLUUM_POLL, get_state_store
+from telegram_scheduler import get_scheduler
+from timeseries import load_series, save_series
+from voluum_auth import get_token_manager
+from voluum_reports import hour_window
 
 # Config
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -27,36 +33,23 @@ VOLUUM_PASSWORD = os.getenv("VOLUUM_PASSWORD")
 VOLUUM_ACCESS_KEY_ID = os.getenv("VOLUUM_ACCESS_KEY_ID")
 VOLUUM_ACCESS_KEY_SECRET = os.getenv("VOLUUM_ACCESS_KEY_SECRET")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "30"))  # sekunder - tjek oftere
+REPORT_CACHE_ENABLED = os.getenv("REPORT_CACHE_ENABLED", "true").lower() == "true"
 
-# Fil til at huske sidst sete kampagne-statistik (sammenlign for nye FTD)
-STATE_FILE = Path(__file__).parent / ".voluum_state.json"
+# Sidst sete kampagne-statistik (sammenlign for nye FTD) ligger i .state.db (scope "voluum_poll")
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
 def get_voluum_token():
-    """Hent session token fra Voluum API."""
-    url = "https://api.voluum.com/auth/session"
-    
-    if VOLUUM_ACCESS_KEY_ID and VOLUUM_ACCESS_KEY_SECRET:
-        payload = {
-            "accessKeyId": VOLUUM_ACCESS_KEY_ID,
-            "accessKeySecret": VOLUUM_ACCESS_KEY_SECRET,
-        }
-    elif VOLUUM_EMAIL and VOLUUM_PASSWORD:
-        payload = {"email": VOLUUM_EMAIL, "password": VOLUUM_PASSWORD}
-    else:
+    """Hent session token fra Voluum API (cachet og delt via voluum_auth)."""
+    voluum = get_token_manager()
+    if not voluum.has_credentials():
         logger.error("Manglende Voluum credentials - brug VOLUUM_EMAIL/PASSWORD eller VOLUUM_ACCESS_KEY_ID/SECRET")
         return None
-
     try:
-        r = requests.post(url, json=payload, timeout=15, headers={"Content-Type": "application/json"})
-        r.raise_for_status()
-        data = r.json()
-        return data.get("token")
+        return voluum.get_token()
     except requests.RequestException as e:
-        logger.error(f"Voluum auth fejl: {e}")
         if hasattr(e, "response") and e.response is not None:
             try:
                 err = e.response.json()
@@ -66,64 +59,37 @@ def get_voluum_token():
         return None
 
 
-def fetch_voluum_report(token, hours_back=24):
-    """Hent kampagne-report fra Voluum API. Voluum kræver tid rundet til hele timer."""
-    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-    from_time = (now - timedelta(hours=hours_back)).strftime("%Y-%m-%dT%H:00:00.000Z")
-    to_time = now.strftime("%Y-%m-%dT%H:00:00.000Z")
-    
-    url = f"https://api.voluum.com/report?from={from_time}&to={to_time}&tz=UTC&groupBy=campaign"
-    headers = {"cwauth-token": token, "Content-Type": "application/json"}
-    
-    all_rows = []
-    offset = 0
-    limit = 100
-    
-    while True:
-        try:
-            r = requests.get(f"{url}&limit={limit}&offset={offset}", timeout=30, headers=headers)
-            if r.status_code != 200:
-                logger.error(f"Voluum fejl {r.status_code}: {r.text[:200]}")
-                return []
-            data = r.json()
-            rows = data.get("rows", [])
-            if not rows:
-                break
-            all_rows.extend(rows)
-            if len(rows) < limit or data.get("truncated") is False:
-                break
-            offset += limit
-        except requests.RequestException as e:
-            logger.error(f"Voluum report fejl: {e}")
-            return []
-    
-    return all_rows
+def fetch_voluum_report(hours_back=24):
+    """Hent kampagne-report fra Voluum API (alle sider, hentet samtidigt). Voluum kræver tid rundet til hele timer.
+
+    Med REPORT_CACHE_ENABLED genbruges afsluttede timer, og kun de seneste REPORT_CACHE_SETTLE_HOURS hentes igen.
+    Returnerer [ReportRow] (totaler, offer og land regnet én gang).
+    """
+    try:
+        if REPORT_CACHE_ENABLED:
+            return report_rows(get_report_cache().fetch("campaign", hours_back=hours_back))
+        return get_report_ttl_cache().fetch_rows("campaign", *hour_window(hours_back))
+    except requests.RequestException as e:
+        logger.error(f"Voluum report fejl: {e}")
+        return []
 
 
 def send_telegram(message: str) -> bool:
-    """Send besked til Telegram."""
+    """Send besked til Telegram (via den rate-limitede scheduler)."""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         return False
-    
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    try:
-        r = requests.post(url, json={
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": message,
-            "parse_mode": "HTML",
-        }, timeout=10)
-        r.raise_for_status()
-        return True
-    except requests.RequestException as e:
-        logger.error(f"Telegram fejl: {e}")
+    job = get_scheduler().send(TELEGRAM_CHAT_ID, message)
+    if job.done and not job.ok:
+        logger.error(f"Telegram fejl: {job.description}")
         return False
+    return True
 
 
-def format_campaign_delta(row: dict, delta_conv: int, delta_rev: float) -> str:
+def format_campaign_delta(row: ReportRow, delta_conv: int, delta_rev: float) -> str:
     """Format kampagne-delta til Telegram (alle konverteringer med revenue)."""
-    campaign = row.get("campaignName", "N/A")
-    country = row.get("campaignCountry", "N/A")
-    source = row.get("trafficSourceName", "N/A")
+    campaign = row.campaign_name or "N/A"
+    country = row.campaign_country or "N/A"
+    source = row.source or "N/A"
     return f"""🎉 <b>NYE KONVERTERINGER!</b> 🎉
 
 📢 <b>Campaign:</b> {campaign}
@@ -136,58 +102,50 @@ def format_campaign_delta(row: dict, delta_conv: int, delta_rev: float) -> str:
 ⏰ <b>Tid:</b> {datetime.now().strftime('%Y-%m-%d %H:%M')}"""
 
 
-def get_last_state() -> dict:
-    """Hent sidst gemt kampagne-statistik."""
-    if not STATE_FILE.exists():
-        return {}
-    try:
-        return json.loads(STATE_FILE.read_text())
-    except Exception:
-        return {}
-
-
-def save_state(state: dict):
-    """Gem kampagne-statistik til næste sammenligning."""
-    STATE_FILE.write_text(json.dumps(state, indent=0))
-
-
-def poll_once(token: str):
+def poll_once():
     """Kør én poll-runde - sammenlign med sidst og send notifikationer ved nye FTD."""
-    rows = fetch_voluum_report(token, hours_back=4)  # 4t window for hurtigere opdatering
-    last = get_last_state()
-    current = {}
-    is_first_run = len(last) == 0  # Første kørsel - gem kun baseline, send ingen notifikationer
-    
-    for row in rows:
-        cid = row.get("campaignId")
-        if not cid:
-            continue
-        
-        # Alle konverteringer: conversions + customConversions1+2
-        conv = int(row.get("conversions", 0) or 0)
-        c1 = int(row.get("customConversions1", 0) or 0)
-        c2 = int(row.get("customConversions2", 0) or 0)
-        total_conv = conv + c1 + c2
-        
-        # Al revenue: allConversionsRevenue + customRevenue1+2
-        rev_main = float(row.get("allConversionsRevenue", 0) or row.get("revenue", 0) or 0)
-        rev_c1 = float(row.get("customRevenue1", 0) or 0)
-        rev_c2 = float(row.get("customRevenue2", 0) or 0)
-        total_rev = rev_main + rev_c1 + rev_c2
-        
-        current[cid] = {"conversions": total_conv, "revenue": total_rev}
-        
-        prev = last.get(cid, {"conversions": 0, "revenue": 0})
-        delta_conv = total_conv - prev.get("conversions", 0)
-        delta_rev = total_rev - prev.get("revenue", 0)
-        
-        # Send når der er nye konverteringer og/eller ny revenue (og ikke første kørsel)
-        if not is_first_run and (delta_conv > 0 or delta_rev > 0):
-            msg = format_campaign_delta(row, delta_conv, delta_rev)
-            if send_telegram(msg):
-                logger.info(f"FTD notifikation sendt: {row.get('campaignName')} (+{delta_conv} conv)")
-    
-    save_state(current)
+    rows = fetch_voluum_report(hours_back=4)  # 4t window for hurtigere opdatering
+    to_send = []
+    rows = [row for row in report_rows(rows) if row.campaign_id]
+    now = time.time()
+    with get_state_store().transaction() as tx:
+        # Plads til hele reporten – en kampagne uden baseline ville ellers blive meldt igen hver tick
+        series = load_series(tx, SCOPE_VOLUUM_POLL, max_keys=len(rows))
+        legacy = tx.load_campaign_totals(SCOPE_VOLUUM_POLL)
+        if legacy:
+            # Engangs-import af totalerne fra før tidsserierne
+            series.reserve(len(legacy))
+            if not len(series):
+                series.record(list(legacy), now, [v["conversions"] for v in legacy.values()],
+                              [v["revenue"] for v in legacy.values()])
+            tx.clear_campaign_totals(SCOPE_VOLUUM_POLL)
+        is_first_run = len(series) == 0  # Første kørsel - gem kun baseline, send ingen notifikationer
+        cids = [row.campaign_id for row in rows]
+        prev_conv, prev_rev = series.latest(cids)
+        recorded = series.record(cids, now, [row.conversions for row in rows], [row.revenue for row in rows])
+        untracked = recorded < 0
+        if untracked.any():
+            logger.warning(f"{int(untracked.sum())} kampagner fik ingen baseline (tidsserien er fuld) - springes over")
+
+        for i, row in enumerate(rows):
+            if untracked[i]:
+                continue
+            # Alle konverteringer og al revenue (summeret én gang i ReportRow)
+            total_conv = row.conversions
+            total_rev = row.revenue
+            delta_conv = total_conv - int(prev_conv[i])
+            delta_rev = total_rev - float(prev_rev[i])
+
+            # Send når der er nye konverteringer og/eller ny revenue (og ikke første kørsel)
+            if not is_first_run and (delta_conv > 0 or delta_rev > 0):
+                to_send.append((row, delta_conv, format_campaign_delta(row, delta_conv, delta_rev)))
+
+        save_series(tx, SCOPE_VOLUUM_POLL, series)
+
+    # Send efter commit, så state-låsen ikke holdes mens vi venter på Telegram
+    for row, delta_conv, msg in to_send:
+        if send_telegram(msg):
+            logger.info(f"FTD notifikation sendt: {row.campaign_name} (+{delta_conv} conv)")
 
 
 def main():
@@ -203,9 +161,9 @@ def main():
     logger.info(f"Starter Voluum FTD polling (interval: {POLL_INTERVAL}s)")
     
     while True:
-        token = get_voluum_token()
-        if token:
-            poll_once(token)
+        # Token er cachet – der logges kun ind når det er ved at udløbe
+        if get_voluum_token():
+            poll_once()
         else:
             logger.warning("Kunne ikke hente Voluum token - prøver igen om %ds", POLL_INTERVAL)
         
@@ -215,17 +173,16 @@ def main():
 if __name__ == "__main__":
     import sys
     if "--reset" in sys.argv:
-        if STATE_FILE.exists():
-            STATE_FILE.unlink()
-            print("✅ State nulstillet - ny baseline ved næste kørsel")
-        else:
-            print("Ingen state fil at nulstille")
+        with get_state_store().transaction() as tx:
+            tx.clear_campaign_totals(SCOPE_VOLUUM_POLL)
+            tx.delete_series(SCOPE_VOLUUM_POLL)
+        print("✅ State nulstillet - ny baseline ved næste kørsel")
     elif "--test-auth" in sys.argv:
         token = get_voluum_token()
         if token:
             print("✅ Voluum auth OK - token hentet")
-            rows = fetch_voluum_report(token, hours_back=24)
-            total_conv = sum(int(r.get("conversions", 0) or 0) + int(r.get("customConversions1", 0) or 0) + int(r.get("customConversions2", 0) or 0) for r in rows)
+            rows = fetch_voluum_report(hours_back=24)
+            total_conv = sum(r.conversions for r in rows)
             print(f"   Kampagner (sidste 24t): {len(rows)}")
             print(f"   Total konverteringer: {total_conv}")
         else:
@@ -0,0 +1,315 @@
+"""
+Paginerede Voluum reports
+=========================
+Henter hele /report uanset antal rækker. Første side fortæller `totalRows`; resten
+af siderne hentes samtidigt fra en lille trådpulje og flettes i rækkefølge.
+
+- fetch() returnerer en liste, iter_rows() streamer rækkerne side for side.
+- conversions() henter konverteringsloggen (én række per konvertering) på samme måde.
+- Mangler `totalRows` i svaret, hentes sider i bølger af `max_workers` indtil en kort side.
+- Alle kald går gennem voluum_auth (delt token, retry ved 401) og http_clients (keep-alive).
+
+Store konti: svaret hentes gzip-komprimeret og parses inkrementelt fra streamen (RowStream), så en side
+aldrig ligger som hel tekst plus fuldt dict-træ i hukommelsen. Med VOLUUM_REPORT_COLUMNS beder vi kun
+om REPORT_COLUMNS (Voluums `column`-parameter), og hver række skæres ned til de felter koden læser.
+Afviser Voluum kolonnelisten (400), hentes alle kolonner resten af processens levetid.
+"""
+
+import codecs
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import metrics
+from voluum_auth import VOLUUM_API_BASE, get_token_manager
+
+logger = logging.getLogger(__name__)
+
+REPORT_URL = f"{VOLUUM_API_BASE}/report"
+CONVERSIONS_URL = f"{VOLUUM_API_BASE}/report/conversions"  # Konverteringslog (én række per konvertering)
+TIME_FORMAT = "%Y-%m-%dT%H:00:00.000Z"  # Voluum kræver hele timer
+
+VOLUUM_REPORT_COLUMNS = os.getenv("VOLUUM_REPORT_COLUMNS", "true").lower() == "true"
+STREAM_CHUNK = 64 * 1024
+
+# Felter vi læser fra /report-rækker (app, voluum_poll, send_latest, zero_revenue_rules, report_cache)
+REPORT_COLUMNS = (
+    "campaignId", "campaignName", "campaignNamePostfix", "campaignCountry", "trafficSourceName",
+    "offerId", "offerName", "offerCountry", "countryCode",
+    "conversions", "customConversions1", "customConversions2", "uniqueClicks",
+    "revenue", "allConversionsRevenue", "customRevenue1", "customRevenue2",
+    "created", "updated",
+)
+# Ældre/alternative feltnavne som koden falder tilbage på – beholdes lokalt, men bedes ikke om
+_ROW_ALIASES = ("offer", "campaign", "lander")
+
+_WS = " \t\r\n"
+
+
+class RowStream:
+    """Inkrementel parser af et Voluum-svar {"totalRows": N, "rows": [{...}, ...]}.
+
+    feed(bytes) returnerer de rækker der er blevet komplette, close() resten. Andre top-level
+    felter (totalRows, ...) havner i `meta`. keep: behold kun disse felter i hver række.
+    """
+
+    def __init__(self, keep: frozenset = None):
+        self.keep = keep
+        self.meta = {}
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+
+    def feed(self, data: bytes, final: bool = False) -> list:
+        self._buf = self._buf[self._pos:] + self._text.decode(data, final)
+        self._pos = 0
+        rows = []
+        self._parse(rows, final)
+        return rows
+
+    def close(self) -> list:
+        rows = self.feed(b"", final=True)
+        if self._state != "done":
+            raise ValueError("Voluum-svaret sluttede midt i JSON")
+        return rows
+
+    def _value(self, pos: int, final: bool):
+        """(værdi, slut) eller None hvis værdien ikke er kommet helt endnu."""
+        buf = self._buf
+        try:
+            value, end = self._decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        # Et tal lige i enden af bufferen kan fortsætte i næste chunk
+        if end == len(buf) and not final:
+            return None
+        return value, end
+
+    def _parse(self, rows: list, final: bool):
+        buf, pos, n = self._buf, self._pos, len(self._buf)
+        keep = self.keep
+        while True:
+            while pos < n and buf[pos] in _WS:
+                pos += 1
+            if pos >= n:
+                break
+            c, state = buf[pos], self._state
+            if state == "rows":
+                if c == ",":
+                    pos += 1
+                    continue
+                if c == "]":
+                    pos += 1
+                    self._state = "key"
+                    continue
+                got = self._value(pos, final)
+                if got is None:
+                    break
+                row, pos = got
+                if keep is not None and isinstance(row, dict):
+                    row = {k: v for k, v in row.items() if k in keep}
+                rows.append(row)
+            elif state == "key":
+                if c == ",":
+                    pos += 1
+                    continue
+                if c == "}":
+                    pos += 1
+                    self._state = "done"
+                    continue
+                got = self._value(pos, final)
+                if got is None:
+                    break
+                self._key, pos = got
+                self._state = "colon"
+            elif state == "colon":
+                if c != ":":
+                    raise ValueError(f"Ugyldigt Voluum-svar ved tegn {pos}")
+                pos += 1
+                self._state = "value"
+            elif state == "value":
+                if self._key == "rows" and c == "[":
+                    pos += 1
+                    self._state = "rows"
+                    continue
+                got = self._value(pos, final)
+                if got is None:
+                    break
+                self.meta[self._key], pos = got
+                self._state = "key"
+            elif state == "start":
+                if c != "{":
+                    raise ValueError("Voluum-svaret er ikke et JSON-objekt")
+                pos += 1
+                self._state = "key"
+            else:  # done – ignorer resten
+                pos = n
+        self._pos = pos
+
+
+def hour_window(hours_back: float = 24, now: datetime = None) -> tuple:
+    """(from, to) for de sidste `hours_back` hele timer."""
+    now = (now or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+    return (now - timedelta(hours=hours_back)).strftime(TIME_FORMAT), now.strftime(TIME_FORMAT)
+
+
+def today_window(now: datetime = None) -> tuple:
+    """(from, to) fra midnat UTC til seneste hele time."""
+    now = (now or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+    return now.replace(hour=0).strftime(TIME_FORMAT), now.strftime(TIME_FORMAT)
+
+
+class ReportFetcher:
+    """Henter alle sider af en Voluum report med begrænset samtidighed."""
+
+    def __init__(self, token_manager=None, page_size: int = 500, max_workers: int = 4, timeout: float = 30,
+                 columns: tuple = None):
+        self.token_manager = token_manager
+        self.page_size = page_size
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.columns = columns
+        self.columns_rejected = False
+        self._keep = frozenset(tuple(columns) + _ROW_ALIASES) if columns else None
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self.reports = 0
+        self.pages = 0
+        self.last_total = 0
+        self.last_seconds = 0.0
+
+    def _executor(self) -> ThreadPoolExecutor:
+        # Tråde overlever ikke et gunicorn fork – opret puljen i den proces der bruger den
+        if self._pool_pid != os.getpid():
+            with self._lock:
+                if self._pool_pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix="voluum-report")
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def _get(self, url: str, query: dict):
+        voluum = self.token_manager or get_token_manager()
+        return voluum.request("GET", url, params=query, timeout=self.timeout, stream=True,
+                              headers={"Content-Type": "application/json", "Accept-Encoding": "gzip, deflate"})
+
+    def _page(self, url: str, params: dict, offset: int, keep: frozenset = None) -> dict:
+        query = {**params, "limit": self.page_size, "offset": offset}
+        if self.columns_rejected:
+            # Allerede afvist (evt. af en side der blev planlagt samtidig) – spar det fejlede kald
+            query.pop("column", None)
+        resp = self._get(url, query)
+        if resp.status_code == 400 and "column" in query:
+            resp.close()
+            if not self.columns_rejected:
+                logger.warning("Voluum afviste column-parametrene - henter alle kolonner fremover")
+                self.columns_rejected = True
+            query.pop("column")
+            resp = self._get(url, query)
+        try:
+            resp.raise_for_status()
+            stream = RowStream(keep)
+            rows = []
+            for chunk in resp.iter_content(STREAM_CHUNK):
+                rows.extend(stream.feed(chunk))
+            rows.extend(stream.close())
+        finally:
+            resp.close()
+        self.pages += 1
+        return {**stream.meta, "rows": rows}
+
+    def iter_rows(self, group_by: str, from_t: str, to_t: str, **filters):
+        """Stream alle rækker i Voluums rækkefølge. Rejser requests.RequestException ved fejl."""
+        params = {"from": from_t, "to": to_t, "tz": "UTC", "groupBy": group_by, **filters}
+        if self.columns and not self.columns_rejected:
+            params["column"] = list(self.columns)
+        return self._iter(REPORT_URL, params, group_by, self._keep)
+
+    def conversions(self, from_t: str, to_t: str, **filters) -> list:
+        """Konverteringsloggen for perioden (alle sider)."""
+        params = {"from": from_t, "to": to_t, "tz": "UTC", **filters}
+        return list(self._iter(CONVERSIONS_URL, params, "conversions"))
+
+    def _iter(self, url: str, params: dict, label: str, keep: frozenset = None):
+        started = time.monotonic()
+        first = self._page(url, params, 0, keep)
+        rows = first.get("rows") or []
+        total = first.get("totalRows")
+        self.reports += 1
+        count = len(rows)
+        yield from rows
+
+        if total is not None:
+            offsets = range(self.page_size, int(total), self.page_size)
+            futures = [self._executor().submit(self._page, url, params, off, keep) for off in offsets]
+            try:
+                for fut in futures:
+                    page_rows = fut.result().get("rows") or []
+                    count += len(page_rows)
+                    yield from page_rows
+            finally:
+                for fut in futures:
+                    fut.cancel()
+        else:
+            # Ukendt total: hent i bølger indtil en side er kortere end page_size
+            offset = self.page_size
+            more = len(rows) >= self.page_size
+            while more:
+                offsets = [offset + i * self.page_size for i in range(self.max_workers)]
+                pages = list(self._executor().map(lambda off: self._page(url, params, off, keep), offsets))
+                for page in pages:
+                    page_rows = page.get("rows") or []
+                    count += len(page_rows)
+                    yield from page_rows
+                    if len(page_rows) < self.page_size:
+                        more = False
+                        break
+                offset += len(offsets) * self.page_size
+
+        self.last_total = count
+        self.last_seconds = time.monotonic() - started
+        metrics.observe_stage("report_fetch", self.last_seconds)
+        if total is not None and count < int(total):
+            logger.warning(f"Voluum report {label}: {count} af {total} rækker (data ændrede sig undervejs?)")
+
+    def fetch(self, group_by: str, from_t: str, to_t: str, **filters) -> list:
+        """Hele reporten som liste."""
+        return list(self.iter_rows(group_by, from_t, to_t, **filters))
+
+    def stats(self) -> dict:
+        return {
+            "page_size": self.page_size,
+            "max_workers": self.max_workers,
+            "columns": None if not self.columns or self.columns_rejected else len(self.columns),
+            "reports": self.reports,
+            "pages": self.pages,
+            "last_rows": self.last_total,
+            "last_seconds": round(self.last_seconds, 3),
+        }
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_report_fetcher() -> ReportFetcher:
+    """Delt report-fetcher for processen – konfigureres fra .env ved første kald."""
+    global _fetcher
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                _fetcher = ReportFetcher(
+                    page_size=int(os.getenv("VOLUUM_REPORT_PAGE_SIZE", "500")),
+                    max_workers=int(os.getenv("VOLUUM_REPORT_WORKERS", "4")),
+                    columns=REPORT_COLUMNS if VOLUUM_REPORT_COLUMNS else None,
+                )
+    return _fetcher
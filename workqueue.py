@@ -0,0 +1,135 @@
+"""
+In-process arbejdskø
+====================
+En simpel kø med en pulje af worker-tråde. Bruges til at levere postbacks
+(Voluum forward + Telegram) i baggrunden, så /postback kan svare med det samme.
+
+Tråde startes først ved første submit() – det gør køen sikker at oprette på
+modulniveau under gunicorn (workers forkes før tråde startes).
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """Bounded kø + N worker-tråde der kalder handler(job) for hvert job."""
+
+    def __init__(self, name: str, handler, workers: int = 4, maxsize: int = 1000, sample_size: int = 500):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._busy = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        # (ventetid i kø, behandlingstid) i sekunder for de seneste jobs
+        self._samples = deque(maxlen=sample_size)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._threads:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            logger.info(f"Arbejdskø '{self.name}' startet med {self.workers} workers")
+
+    def submit(self, job) -> bool:
+        """Læg job i køen. Returnerer False hvis køen er fuld."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.monotonic(), job))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def _run(self):
+        while True:
+            enqueued_at, job = self._queue.get()
+            started = time.monotonic()
+            with self._lock:
+                self._busy += 1
+            ok = True
+            try:
+                self.handler(job)
+            except Exception as e:
+                ok = False
+                logger.exception(f"Arbejdskø '{self.name}' job fejlede: {e}")
+            finished = time.monotonic()
+            with self._lock:
+                self._busy -= 1
+                if ok:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+                self._samples.append((started - enqueued_at, finished - started))
+            self._queue.task_done()
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def join(self, timeout: float = None) -> bool:
+        """Vent til køen er tom (til scripts/tests). Returnerer True hvis tømt."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self) -> dict:
+        """Kødybde og drain-tider – brug til at dimensionere antal workers."""
+        with self._lock:
+            samples = list(self._samples)
+            busy = self._busy
+            counts = {
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+            }
+        depth = self.depth()
+        waits = sorted(s[0] for s in samples)
+        services = sorted(s[1] for s in samples)
+
+        def _pct(vals, p):
+            if not vals:
+                return 0.0
+            return round(vals[min(len(vals) - 1, int(len(vals) * p))] * 1000, 1)
+
+        avg_service = sum(services) / len(services) if services else 0.0
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "busy": busy,
+            "depth": depth,
+            "maxsize": self._queue.maxsize,
+            **counts,
+            "wait_ms_p50": _pct(waits, 0.50),
+            "wait_ms_p95": _pct(waits, 0.95),
+            "service_ms_p50": _pct(services, 0.50),
+            "service_ms_p95": _pct(services, 0.95),
+            # Estimeret tid før nuværende kø er tømt med nuværende pulje
+            "est_drain_seconds": round(depth * avg_service / self.workers, 2),
+        }
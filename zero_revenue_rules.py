@@ -0,0 +1,257 @@
+"""
+Regelmotor for zero-revenue alerts
+==================================
+Reglerne (tærskler, ventetid, scope og cooldown) kommer fra config i stedet for at være
+hard-codet i /cron/zero-revenue:
+
+    ZERO_REVENUE_RULES='[{"name": "zero", "type": "zero_revenue", "clicks": 60, "wait_hours": 1.5},
+                         {"name": "dry", "type": "since_revenue", "clicks": 125, "wait_hours": 1, "scope": "country"}]'
+
+eller ZERO_REVENUE_RULES_FILE=sti/til/rules.json. Uden config bruges de to gamle regler
+(CLICK_THRESHOLD/WAIT_HOURS og CLICK_THRESHOLD_HIGH/WAIT_HOURS_HIGH) per offer.
+
+- type "zero_revenue": 0 revenue i dag og mindst `clicks` clicks.
+- type "since_revenue": har omsat, men mindst `clicks` clicks siden revenue sidst steg.
+- type "window": mindst `clicks` clicks og ingen ny revenue inden for de sidste `window_minutes`.
+- scope: "offer", "campaign" (kræver campaign-report) eller "country" (offers summeret per land).
+- Betingelsen skal holde i `wait_hours` før der sendes; derefter højst én alert per
+  scope-enhed per `cooldown_hours` (uden cooldown: én per dag).
+
+Reporten indlæses én gang i kolonner (NumPy), og alle regler evalueres som array-operationer.
+Historikken (clicks siden sidste revenue-stigning, clicks/revenue i et vindue) kommer fra
+ring buffer-tidsserierne i timeseries.py – én serie per scope.
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from report_rows import row_revenue
+
+logger = logging.getLogger(__name__)
+
+RULE_TYPES = ("zero_revenue", "since_revenue", "window")
+SCOPES = ("offer", "campaign", "country")
+
+# Report-felter per scope: (id, navn, land)
+_SCOPE_FIELDS = {
+    "offer": (("offerId",), ("offerName", "offer"), ("offerCountry", "campaignCountry")),
+    "campaign": (("campaignId",), ("campaignName", "campaign"), ("campaignCountry", "countryCode")),
+}
+
+
+class Rule:
+    __slots__ = ("name", "type", "clicks", "wait_hours", "scope", "cooldown_hours", "window_minutes")
+
+    def __init__(self, name: str, type: str, clicks: int, wait_hours: float = 0, scope: str = "offer",
+                 cooldown_hours: float = None, window_minutes: float = 60):
+        if type not in RULE_TYPES:
+            raise ValueError(f"Ukendt regeltype '{type}' (regel {name}) - brug {', '.join(RULE_TYPES)}")
+        if scope not in SCOPES:
+            raise ValueError(f"Ukendt scope '{scope}' (regel {name}) - brug {', '.join(SCOPES)}")
+        self.name = name
+        self.type = type
+        self.clicks = int(clicks)
+        self.wait_hours = float(wait_hours)
+        self.scope = scope
+        self.cooldown_hours = None if cooldown_hours is None else float(cooldown_hours)
+        self.window_minutes = float(window_minutes)
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def default_rules(click_threshold: int, wait_hours: float, click_threshold_high: int,
+                  wait_hours_high: float) -> list:
+    """De to oprindelige regler (per offer, én alert per dag)."""
+    return [
+        Rule("zero_revenue", "zero_revenue", click_threshold, wait_hours),
+        Rule("since_revenue", "since_revenue", click_threshold_high, wait_hours_high),
+    ]
+
+
+def load_rules(defaults: list) -> list:
+    """Regler fra ZERO_REVENUE_RULES (JSON) eller ZERO_REVENUE_RULES_FILE, ellers `defaults`."""
+    raw = os.getenv("ZERO_REVENUE_RULES", "").strip()
+    path = os.getenv("ZERO_REVENUE_RULES_FILE", "").strip()
+    if not raw and path:
+        with open(path, encoding="utf-8") as f:
+            raw = f.read()
+    if not raw:
+        return defaults
+    try:
+        specs = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"ZERO_REVENUE_RULES er ikke gyldig JSON: {e}")
+    rules = [Rule(**{"name": f"rule{i + 1}", **spec}) for i, spec in enumerate(specs)]
+    names = [r.name for r in rules]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Regelnavne skal være unikke: {names}")
+    return rules
+
+
+def _first(row: dict, keys: tuple):
+    for k in keys:
+        v = row.get(k)
+        if v:
+            return v
+    return ""
+
+
+class ColumnarReport:
+    """En report som parallelle kolonner: keys, labels, countries (object) + clicks, revenue."""
+
+    __slots__ = ("keys", "labels", "countries", "clicks", "revenue")
+
+    def __init__(self, keys, labels, countries, clicks, revenue):
+        self.keys = keys
+        self.labels = labels
+        self.countries = countries
+        self.clicks = clicks
+        self.revenue = revenue
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_rows(cls, rows: list, scope: str = "offer") -> "ColumnarReport":
+        """Ét gennemløb af rækkerne; rækker uden ID springes over."""
+        id_keys, label_keys, country_keys = _SCOPE_FIELDS[scope]
+        keys, labels, countries, clicks, revenue = [], [], [], [], []
+        for row in rows:
+            key = _first(row, id_keys)
+            if not key:
+                continue
+            keys.append(str(key))
+            labels.append(_first(row, label_keys) or "?")
+            countries.append(_first(row, country_keys))
+            clicks.append(int(row.get("uniqueClicks", 0) or 0))
+            revenue.append(row_revenue(row))
+        return cls(np.array(keys, dtype=object), np.array(labels, dtype=object),
+                   np.array(countries, dtype=object), np.array(clicks, dtype=np.int64),
+                   np.array(revenue, dtype=np.float64))
+
+    def by_country(self) -> "ColumnarReport":
+        """Summer clicks og revenue per land."""
+        countries = np.where(self.countries == "", "?", self.countries).astype(str)
+        uniq, inverse = np.unique(countries, return_inverse=True)
+        clicks = np.bincount(inverse, weights=self.clicks, minlength=len(uniq)).astype(np.int64)
+        revenue = np.bincount(inverse, weights=self.revenue, minlength=len(uniq))
+        uniq = uniq.astype(object)
+        labels = np.array([f"Alle offers i {c}" for c in uniq], dtype=object)
+        return ColumnarReport(uniq, labels, uniq, clicks, revenue)
+
+
+class Alert:
+    __slots__ = ("rule", "scope", "key", "label", "country", "clicks")
+
+    def __init__(self, rule: Rule, key: str, label: str, country: str, clicks: int):
+        self.rule = rule
+        self.scope = rule.scope
+        self.key = key
+        self.label = label
+        self.country = country
+        self.clicks = clicks
+
+
+def _scatter(pos: dict, mapping: dict, default=np.nan):
+    """mapping lagt ud på report-rækkerne (pos: key -> række) som float-array; default hvor den mangler.
+
+    Løber kun over mapping (pending/alerts er små), ikke over hele reporten.
+    """
+    out = np.full(len(pos), default, dtype=np.float64)
+    if mapping:
+        hits = [(pos[k], v) for k, v in mapping.items() if k in pos]
+        if hits:
+            idx, vals = zip(*hits)
+            out[list(idx)] = vals
+    return out
+
+
+class RuleEngine:
+    """Evaluerer alle regler mod én tick's reports.
+
+    State (fra/til state_store):
+      pending[rule][key] = tidspunkt betingelsen først holdt
+      alerts[scope][key] = tidspunkt for sidste alert
+      series[scope] = SeriesStore med (tid, clicks, revenue) per key – opdateres med denne tick
+    """
+
+    def __init__(self, rules: list):
+        self.rules = rules
+        self.scopes = sorted({r.scope for r in rules})
+        self.last_seconds = 0.0
+        self.ticks = 0
+
+    def needs_campaign_report(self) -> bool:
+        return "campaign" in self.scopes
+
+    def evaluate(self, reports: dict, pending: dict, alerts: dict, series: dict, now: float) -> tuple:
+        """Returnerer (alerts der skal sendes, nye pending).
+
+        reports: {"offer": ColumnarReport, "campaign": ColumnarReport} – country afledes af offer.
+        """
+        started = time.perf_counter()
+        if "country" in self.scopes and "country" not in reports and "offer" in reports:
+            reports = {**reports, "country": reports["offer"].by_country()}
+        fired = []
+        new_pending = {}
+        for scope in self.scopes:
+            report = reports.get(scope)
+            if report is None:
+                logger.warning(f"Zero-revenue: ingen report for scope '{scope}' - regler springes over")
+                continue
+            keys = report.keys
+            labels = report.labels
+            countries = report.countries
+            clicks = report.clicks
+            revenue = report.revenue
+            key_list = keys.tolist()
+            pos = dict(zip(key_list, range(len(key_list))))
+
+            store = series[scope]
+            rows = store.record(key_list, now, clicks, revenue)
+            if (rows < 0).any():
+                logger.warning(f"Zero-revenue: flere {scope}s end TIMESERIES_MAX_KEYS - resten springes over")
+                ok = rows >= 0
+                rows, keys, clicks, revenue = rows[ok], keys[ok], clicks[ok], revenue[ok]
+                labels, countries = labels[ok], countries[ok]
+                key_list = keys.tolist()
+                pos = dict(zip(key_list, range(len(key_list))))
+            clicks_since, _ = store.since_increase(rows)
+
+            last_alert = _scatter(pos, alerts.get(scope, {}))
+            for rule in (r for r in self.rules if r.scope == scope):
+                if rule.type == "zero_revenue":
+                    cond = (clicks >= rule.clicks) & (revenue <= 0)
+                elif rule.type == "since_revenue":
+                    cond = (revenue > 0) & (clicks_since >= rule.clicks)
+                else:
+                    win_clicks, win_rev = store.delta_since(rows, rule.window_minutes * 60, now)
+                    cond = (win_clicks >= rule.clicks) & (win_rev <= 0)
+                if rule.cooldown_hours is None:
+                    blocked = ~np.isnan(last_alert)
+                else:
+                    blocked = (now - last_alert) < rule.cooldown_hours * 3600  # NaN -> False
+                cond &= ~blocked
+
+                # Timeren starter første tick betingelsen holder og nulstilles når den ikke gør
+                first_seen = np.where(cond, _scatter(pos, pending.get(rule.name, {}), now), np.nan)
+                due = cond & ((now - first_seen) >= rule.wait_hours * 3600)
+                keep = cond & ~due
+                new_pending[rule.name] = dict(zip(keys[keep].tolist(), first_seen[keep].tolist()))
+
+                idx = np.flatnonzero(due)
+                last_alert[idx] = now  # Max én alert per enhed per tick på tværs af regler
+                for i in idx.tolist():
+                    fired.append(Alert(rule, keys[i], labels[i], countries[i], int(clicks[i])))
+        self.ticks += 1
+        self.last_seconds = time.perf_counter() - started
+        return fired, new_pending
+
+    def stats(self) -> dict:
+        return {"rules": [r.to_dict() for r in self.rules], "ticks": self.ticks,
+                "last_ms": round(self.last_seconds * 1000, 3)}